@@ -0,0 +1,91 @@
+"""Seed reproducible benchmark datasets through the application's own models.
+
+A dataset is fully described by a DatasetSpec, and the same spec with the
+same seed always produces the same rows, so results from different commits
+can be compared.
+"""
+import dataclasses
+import datetime
+import random
+
+from src.models import Task, User, assignees_table, db, task_progress_table
+
+STATUSES = ['pending', 'in_progress', 'review', 'completed']
+
+@dataclasses.dataclass
+class DatasetSpec:
+    tasks: int = 1_000
+    users: int = 100
+    max_assignees: int = 3  # per task
+    assignee_skew: float = 1.2  # Zipf exponent: a few users get most of the assignments
+    logs_per_task: int = 4  # task_logs rows per task
+    seed: int = 1234
+
+PRESETS = {
+    '1k': DatasetSpec(),
+    '10k': DatasetSpec(tasks=10_000, users=500),
+    '100k': DatasetSpec(tasks=100_000, users=2_000),
+    'skewed': DatasetSpec(tasks=10_000, users=1_000, max_assignees=8, assignee_skew=2.0),
+    'heavy-logs': DatasetSpec(tasks=10_000, users=500, logs_per_task=50),
+}
+
+BATCH_SIZE = 2_000
+
+def _zipf_weights(n: int, skew: float):
+    return [1.0 / (rank ** skew) for rank in range(1, n + 1)]
+
+def seed(spec: DatasetSpec, password: str = 'benchmark'):
+    """Insert spec.users users, spec.tasks tasks, their assignees and task_logs; call inside an app context.
+
+    Users and tasks go through the ORM models; the association and log tables
+    are filled with batched Core inserts, the same way the app writes them.
+    """
+    rng = random.Random(spec.seed)
+    epoch = datetime.datetime(2024, 1, 1)
+
+    for start in range(0, spec.users, BATCH_SIZE):
+        db.session.add_all(
+            User(username=f'bench_user_{i}', email=f'bench_user_{i}@example.com', password=password)
+            for i in range(start, min(start + BATCH_SIZE, spec.users))
+        )
+        db.session.commit()
+    user_ids = [row.id for row in db.session.query(User.id).order_by(User.id)]
+    weights = _zipf_weights(len(user_ids), spec.assignee_skew)
+
+    for start in range(0, spec.tasks, BATCH_SIZE):
+        tasks = [
+            Task(
+                title=f'bench_task_{i}',
+                description=f'Benchmark task {i} ' + 'lorem ipsum ' * rng.randint(1, 20),
+                deadline=(epoch + datetime.timedelta(days=rng.randint(0, 720))).date(),
+                status=rng.choice(STATUSES),
+                created_by_user=rng.choice(user_ids)
+            )
+            for i in range(start, min(start + BATCH_SIZE, spec.tasks))
+        ]
+        db.session.add_all(tasks)
+        db.session.flush()
+
+        pairs = []
+        logs = []
+        for task in tasks:
+            chosen = set(rng.choices(user_ids, weights, k=rng.randint(0, spec.max_assignees)))
+            pairs.extend({'user_id': u, 'task_id': task.id, 'created_at': epoch} for u in chosen)
+
+            moment = epoch + datetime.timedelta(minutes=rng.randint(0, 60 * 24 * 365))
+            for _ in range(spec.logs_per_task):
+                moment += datetime.timedelta(minutes=rng.randint(5, 60 * 24 * 7))
+                logs.append({'task_id': task.id, 'status': rng.choice(STATUSES), 'timestamp': moment})
+
+        if pairs:
+            db.session.execute(assignees_table.insert(), pairs)
+        if logs:
+            db.session.execute(task_progress_table.insert(), logs)
+        db.session.commit()
+
+    return {
+        'users': spec.users,
+        'tasks': spec.tasks,
+        'task_assignees': db.session.query(assignees_table).count(),
+        'task_logs': db.session.query(task_progress_table).count(),
+    }
@@ -0,0 +1,422 @@
+"""Benchmark every route of the tasks and users blueprints against a seeded dataset.
+
+Run from the repository root:
+
+    python -m benchmarks.endpoints --dataset 1k --output bench.json
+    python -m benchmarks.endpoints --dataset 100k --target gunicorn --concurrency 16
+    python -m benchmarks.endpoints --dataset 100k --target uvicorn --concurrency 64 --routes "GET *"
+    python -m benchmarks.endpoints --target http://127.0.0.1:5000 --no-seed
+    python -m benchmarks.endpoints --baseline main.json --max-regression 0.2 --max-p95-ms 250
+
+The dataset is seeded into a fresh SQLite file (or --database-uri) and every
+route is exercised --iterations times, reads first, then writes, with
+deletes only touching rows created during the run. Results (latency
+percentiles, throughput, status codes) are written as JSON; when a baseline
+or thresholds are given, the exit status is 1 if any route breaches them.
+"""
+import argparse
+import concurrent.futures
+import dataclasses
+import datetime
+import fnmatch
+import http.client
+import itertools
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from benchmarks import datasets
+
+class FlaskTarget:
+    """Sends requests through the Flask test client, in process"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method: str, path: str, body=None):
+        response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.get_data()
+
+class HttpTarget:
+    """Sends requests to a running server over keep-alive HTTP connections (one per thread)"""
+
+    def __init__(self, base_url: str):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, 'conn', None) is None:
+            self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        return self._local.conn
+
+    def request(self, method: str, path: str, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        payload = json.dumps(body) if body is not None else None
+        conn = self._connection()
+        try:
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self._local.conn = None
+            return 0, b''
+
+class Workload:
+    """Picks ids and builds unique payloads so writes never collide with seeded or earlier rows"""
+
+    def __init__(self, rng: random.Random, task_ids: list, user_ids: list):
+        self.rng = rng
+        self.task_ids = task_ids
+        self.user_ids = user_ids
+        self.counter = itertools.count()
+        self.run_tag = datetime.datetime.utcnow().strftime('%H%M%S%f')
+        self.created_tasks = []
+        self.created_users = []
+        self.created_usernames = []  # as created, before users.update renames some of them
+        self.assigned_pairs = []
+
+    def task(self):
+        return self.rng.choice(self.task_ids)
+
+    def user(self):
+        return self.rng.choice(self.user_ids)
+
+    def users(self, k: int = 5):
+        return self.rng.sample(self.user_ids, min(k, len(self.user_ids)))
+
+    def unique(self, prefix: str):
+        return f'{prefix}_{self.run_tag}_{next(self.counter)}'
+
+    def new_task(self):
+        return {
+            'created_by_user': self.user(),
+            'title': self.unique('bench_created'),
+            'description': 'Created by the endpoint benchmark',
+            'deadline': '2030-01-01',
+            'status': 'pending'
+        }
+
+    def new_user(self):
+        name = self.unique('bench_created')
+        return {'username': name, 'email': f'{name}@example.com', 'password': 'benchmark'}
+
+    def created_user(self):
+        return self.rng.choice(self.created_users) if self.created_users else self.user()
+
+    def pop(self, items: list, fallback):
+        return items.pop() if items else fallback()
+
+def _record_id(key: str, into: str):
+    def record(workload, status, body):
+        if status in (200, 201):
+            getattr(workload, into).append(json.loads(body)[key])
+    return record
+
+def _record_user(workload, status, body):
+    if status in (200, 201):
+        user = json.loads(body)
+        workload.created_users.append(user['user_id'])
+        workload.created_usernames.append(user['username'])
+
+def _record_pair(workload, status, body, pair):
+    if status == 200:
+        workload.assigned_pairs.append(pair)
+
+@dataclasses.dataclass
+class Route:
+    endpoint: str
+    method: str
+    build: object  # Workload -> (path, json body, callback or None)
+
+def _assign(w):
+    pair = (w.task(), w.user())
+    return f'/tasks/{pair[0]}/assign_to/{pair[1]}', None, lambda w, s, b: _record_pair(w, s, b, pair)
+
+def _unassign(w):
+    task_id, user_id = w.pop(w.assigned_pairs, lambda: (w.task(), w.user()))
+    return f'/tasks/{task_id}/unassign_user/{user_id}', None, None
+
+SEARCH_TERMS = ['lorem', 'ipsum', 'benchmark', 'task', 'lorem ipsum']
+
+# Reads first, then writes; deletes last so they only remove rows created above.
+ROUTES = [
+    Route('tasks.index', 'GET', lambda w: ('/tasks?limit=100', None, None)),
+    Route('tasks.export', 'GET', lambda w: ('/tasks/export', None, None)),
+    Route('tasks.search', 'GET', lambda w: (f'/tasks/search?q={urllib.parse.quote(w.rng.choice(SEARCH_TERMS))}&snippet=1', None, None)),
+    Route('tasks.show', 'GET', lambda w: (f'/tasks/{w.task()}', None, None)),
+    Route('tasks.timeline', 'GET', lambda w: (f'/tasks/{w.task()}/timeline', None, None)),
+    Route('tasks.changes', 'GET', lambda w: ('/tasks/changes?after=0&timeout=0', None, None)),
+    Route('tasks.summary', 'GET', lambda w: ('/tasks/summary', None, None)),
+    Route('tasks.status_durations', 'GET', lambda w: ('/tasks/stats/durations?group_by=status,period', None, None)),
+    Route('tasks.users_assigned_task', 'GET', lambda w: (f'/tasks/{w.task()}/users_assigned_task', None, None)),
+    Route('users.index', 'GET', lambda w: ('/users?limit=100', None, None)),
+    Route('users.export', 'GET', lambda w: ('/users/export', None, None)),
+    Route('users.show', 'GET', lambda w: (f'/users/{w.user()}', None, None)),
+    Route('users.tasks_assigned', 'GET', lambda w: (f'/users/{w.user()}/tasks_assigned', None, None)),
+    Route('tasks.create', 'POST', lambda w: ('/tasks', w.new_task(), _record_id('task_id', 'created_tasks'))),
+    Route('users.create', 'POST', lambda w: ('/users', w.new_user(), _record_user)),
+    Route('users.verify', 'POST', lambda w: (
+        '/users/verify', {'username': w.rng.choice(w.created_usernames), 'password': 'benchmark'}, None
+    ) if w.created_usernames else None),
+    Route('tasks.update', 'PATCH', lambda w: (f'/tasks/{w.task()}', {'title': w.unique('bench_updated')}, None)),
+    Route('users.update', 'PATCH', lambda w: (
+        f'/users/{w.created_user()}',
+        {'username': w.unique('bench_updated'), 'email': w.unique('bench_updated') + '@example.com'},
+        None
+    )),
+    Route('tasks.assign_task', 'POST', _assign),
+    Route('tasks.bulk_assignees', 'POST', lambda w: (f'/tasks/{w.task()}/assignees', {'user_ids': w.users()}, None)),
+    Route('users.bulk_tasks_assigned', 'POST', lambda w: (
+        f'/users/{w.user()}/tasks_assigned', {'task_ids': w.rng.sample(w.task_ids, min(5, len(w.task_ids)))}, None
+    )),
+    Route('tasks.unassign_user', 'PATCH', _unassign),
+    Route('tasks.bulk_assignees', 'DELETE', lambda w: (f'/tasks/{w.task()}/assignees', {'user_ids': w.users()}, None)),
+    Route('users.bulk_tasks_assigned', 'DELETE', lambda w: (
+        f'/users/{w.user()}/tasks_assigned', {'task_ids': w.rng.sample(w.task_ids, min(5, len(w.task_ids)))}, None
+    )),
+    Route('tasks.delete', 'DELETE', lambda w: (f'/tasks/{w.created_tasks.pop()}', None, None) if w.created_tasks else None),
+    Route('users.delete', 'DELETE', lambda w: (f'/users/{w.created_users.pop()}', None, None) if w.created_users else None),
+]
+
+def _percentile(sorted_ms: list, q: float):
+    if len(sorted_ms) == 1:
+        return sorted_ms[0]
+    return statistics.quantiles(sorted_ms, n=100, method='inclusive')[int(q) - 1]
+
+def run_route(target, workload: Workload, route: Route, iterations: int, concurrency: int):
+    requests = [r for r in (route.build(workload) for _ in range(iterations)) if r is not None]
+    if not requests:
+        return None
+
+    def send(req):
+        path, body, callback = req
+        start = time.perf_counter()
+        status, data = target.request(route.method, path, body)
+        elapsed = time.perf_counter() - start
+        return status, data, elapsed, callback
+
+    wall_start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(send, requests))
+    wall = time.perf_counter() - wall_start
+
+    statuses = {}
+    latencies = []
+    for status, data, elapsed, callback in outcomes:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        latencies.append(elapsed * 1000)
+        if callback is not None:
+            callback(workload, status, data)
+
+    latencies.sort()
+    return {
+        'endpoint': route.endpoint,
+        'method': route.method,
+        'requests': len(outcomes),
+        'errors': sum(n for s, n in statuses.items() if s == '0' or s.startswith('5')),
+        'status_codes': statuses,
+        'mean_ms': round(statistics.fmean(latencies), 3),
+        'p50_ms': round(_percentile(latencies, 50), 3),
+        'p95_ms': round(_percentile(latencies, 95), 3),
+        'p99_ms': round(_percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3),
+        'throughput_rps': round(len(outcomes) / wall, 2),
+    }
+
+def uncovered_endpoints(app):
+    """Endpoints of the tasks/users blueprints that have no Route, so new routes are not silently skipped"""
+    covered = {r.endpoint for r in ROUTES}
+    return sorted({
+        rule.endpoint for rule in app.url_map.iter_rules()
+        if rule.endpoint.split('.')[0] in ('tasks', 'users') and rule.endpoint not in covered
+    })
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _start_server(command: list, database_uri: str, extra_env: dict, port: int, name: str):
+    env = dict(os.environ, FLASK_SQLALCHEMY_DATABASE_URI=database_uri, **extra_env)
+    proc = subprocess.Popen(command, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'{name} exited during startup')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return proc, f'http://127.0.0.1:{port}'
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f'{name} did not start listening within 30s')
+
+def start_gunicorn(database_uri: str, extra_env: dict):
+    port = _free_port()
+    extra_env = dict(extra_env, GUNICORN_BIND=f'127.0.0.1:{port}', GUNICORN_ACCESSLOG='')
+    command = [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', 'wsgi:app']
+    return _start_server(command, database_uri, extra_env, port, 'gunicorn')
+
+def start_uvicorn(database_uri: str, extra_env: dict, workers: int = 1):
+    """Serve asgi.py: the async read endpoints, with the Flask app behind them for the rest"""
+    port = _free_port()
+    command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port),
+               '--workers', str(workers), '--no-access-log']
+    return _start_server(command, database_uri, extra_env, port, 'uvicorn')
+
+def check_thresholds(results: dict, args, baseline: dict):
+    """Return a list of human readable threshold breaches"""
+    failures = []
+    per_route = dict(t.split('=', 1) for t in args.threshold)
+    for key, result in results['routes'].items():
+        limit = float(per_route.get(key, per_route.get(result['endpoint'], args.max_p95_ms or 0)))
+        if limit and result['p95_ms'] > limit:
+            failures.append(f'{key}: p95 {result["p95_ms"]}ms > {limit}ms')
+        if result['errors'] > args.max_errors:
+            failures.append(f'{key}: {result["errors"]} server errors')
+        before = (baseline or {}).get('routes', {}).get(key)
+        if before and args.max_regression is not None:
+            allowed = before['p95_ms'] * (1 + args.max_regression)
+            if result['p95_ms'] > allowed:
+                failures.append(f'{key}: p95 {result["p95_ms"]}ms vs baseline {before["p95_ms"]}ms '
+                                f'(> +{args.max_regression:.0%})')
+    return failures
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dataset', choices=datasets.PRESETS, default='1k')
+    parser.add_argument('--tasks', type=int, help='override the preset task count')
+    parser.add_argument('--users', type=int, help='override the preset user count')
+    parser.add_argument('--max-assignees', type=int)
+    parser.add_argument('--assignee-skew', type=float)
+    parser.add_argument('--logs-per-task', type=int)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--database-uri', help='database to seed and benchmark (default: a fresh SQLite file)')
+    parser.add_argument('--no-seed', action='store_true', help='use the data already in --database-uri / --target')
+    parser.add_argument('--target', default='flask',
+                        help='"flask" (test client), "gunicorn" or "uvicorn" (spawned locally, wsgi.py/asgi.py) or a base URL')
+    parser.add_argument('--iterations', type=int, default=200, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=1, help='parallel clients (HTTP targets only)')
+    parser.add_argument('--routes', default='*', help='glob over "METHOD endpoint" keys, e.g. "GET tasks.*"')
+    parser.add_argument('--no-response-cache', action='store_true', help='run with RESPONSE_CACHE_MAX_ENTRIES=0')
+    parser.add_argument('--pbkdf2-iterations', type=int, help='password hashing cost used by the app under test')
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--baseline', help='results JSON from an earlier run to compare against')
+    parser.add_argument('--max-regression', type=float, help='allowed p95 growth over the baseline, e.g. 0.2')
+    parser.add_argument('--max-p95-ms', type=float, help='fail any route whose p95 exceeds this')
+    parser.add_argument('--threshold', action='append', default=[], metavar='ROUTE=MS',
+                        help='per-route p95 limit, by "METHOD endpoint" or endpoint; repeatable')
+    parser.add_argument('--max-errors', type=int, default=0, help='server errors (5xx or no response) allowed per route')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    from src import create_app
+    from src.models import Task, User, db
+
+    spec = dataclasses.replace(datasets.PRESETS[args.dataset], **{
+        field: getattr(args, field) for field in ('tasks', 'users', 'max_assignees', 'assignee_skew', 'logs_per_task', 'seed')
+        if getattr(args, field) is not None
+    })
+
+    workdir = tempfile.mkdtemp(prefix='task-bench-')
+    database_uri = args.database_uri or f'sqlite:///{os.path.join(workdir, "bench.db")}'
+    config = {'SQLALCHEMY_DATABASE_URI': database_uri}
+    extra_env = {}
+    if args.no_response_cache:
+        config['RESPONSE_CACHE_MAX_ENTRIES'] = extra_env['FLASK_RESPONSE_CACHE_MAX_ENTRIES'] = 0
+    if args.pbkdf2_iterations:
+        config['PASSWORD_PBKDF2_ITERATIONS'] = extra_env['FLASK_PASSWORD_PBKDF2_ITERATIONS'] = args.pbkdf2_iterations
+    extra_env = {k: str(v) for k, v in extra_env.items()}
+
+    app = create_app(config)
+    server = None
+    with app.app_context():
+        if not args.no_seed:
+            db.create_all()
+            print(f'seeding {spec} ...', file=sys.stderr)
+            counts = datasets.seed(spec)
+            print(f'seeded {counts}', file=sys.stderr)
+        task_ids = [row.id for row in db.session.query(Task.id)]
+        user_ids = [row.id for row in db.session.query(User.id)]
+
+        missing = uncovered_endpoints(app)
+        if missing:
+            print(f'warning: no benchmark request defined for {", ".join(missing)}', file=sys.stderr)
+
+    try:
+        if args.target == 'flask':
+            target = FlaskTarget(app)
+            concurrency = 1  # the test client runs requests on the calling thread
+        else:
+            if args.target == 'gunicorn':
+                server, base_url = start_gunicorn(database_uri, extra_env)
+            elif args.target == 'uvicorn':
+                server, base_url = start_uvicorn(database_uri, extra_env)
+            else:
+                base_url = args.target
+            target = HttpTarget(base_url)
+            concurrency = args.concurrency
+
+        workload = Workload(random.Random(spec.seed), task_ids, user_ids)
+        results = {
+            'meta': {
+                'commit': _git_commit(),
+                'started_at': datetime.datetime.utcnow().isoformat() + 'Z',
+                'target': args.target,
+                'database': database_uri.split(':', 1)[0],
+                'dataset': dataclasses.asdict(spec),
+                'iterations': args.iterations,
+                'concurrency': concurrency,
+                'response_cache': not args.no_response_cache,
+            },
+            'routes': {},
+        }
+
+        print(f"{'route':<40} {'n':>5} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>9} {'err':>4}")
+        for route in ROUTES:
+            key = f'{route.method} {route.endpoint}'
+            if not fnmatch.fnmatch(key, args.routes):
+                continue
+            result = run_route(target, workload, route, args.iterations, concurrency)
+            if result is None:
+                continue
+            results['routes'][key] = result
+            print(f"{key:<40} {result['requests']:>5} {result['p50_ms']:>8.2f}ms {result['p95_ms']:>8.2f}ms "
+                  f"{result['p99_ms']:>8.2f}ms {result['throughput_rps']:>9.1f} {result['errors']:>4}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+    failures = check_thresholds(results, args, baseline)
+    for failure in failures:
+        print(f'FAIL {failure}', file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,293 @@
+"""Replay recorded API calls as a configurable load against a running server.
+
+Run from the repository root against a local server:
+
+    python -m benchmarks.loadgen --url http://127.0.0.1:5000 --duration 60 --concurrency 16
+    python -m benchmarks.loadgen --mode open --rate 200 --ramp-up 10 --duration 60
+    python -m benchmarks.loadgen --recorded calls.jsonl --mix "GET /tasks/{task}=10" --mix "POST /tasks=1"
+
+The workload is built from the requests in Insomnia_export.json and/or a
+JSONL file of recorded calls (one {"method", "path" or "url", "body"} object
+per line; other lines are skipped). Ids in paths become placeholders that are
+filled with ids that exist on the server, and unique fields (title, username,
+email) are rewritten so creates never collide. Deletes only target rows
+created by the run.
+
+Closed-loop mode keeps --concurrency clients busy back to back. Open-loop
+mode starts requests at a fixed arrival rate whether or not earlier ones have
+finished, and measures latency from the scheduled start, so time spent queued
+behind busy sync workers shows up in the percentiles.
+"""
+import argparse
+import collections
+import concurrent.futures
+import dataclasses
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+from benchmarks.endpoints import HttpTarget, _percentile
+
+# a numeric path segment is a user id or a task id depending on the segment before it
+ID_KINDS = {'users': 'user', 'tasks': 'task', 'assign_to': 'user', 'unassign_user': 'user'}
+UNIQUE_FIELDS = ('title', 'username')
+
+@dataclasses.dataclass
+class Template:
+    method: str
+    path: str  # e.g. /tasks/{task}/assign_to/{user}
+    body: dict = None
+    weight: float = 1.0
+
+    @property
+    def key(self):
+        return f'{self.method} {self.path}'
+
+def _template_path(raw_path: str):
+    segments = raw_path.split('/')
+    for i, segment in enumerate(segments):
+        if segment.isdigit() and i > 0 and segments[i - 1] in ID_KINDS:
+            segments[i] = '{' + ID_KINDS[segments[i - 1]] + '}'
+    return '/'.join(segments)
+
+def _to_template(method: str, url: str, body):
+    path = urllib.parse.urlsplit(re.sub(r'\{\{.*?\}\}', '', url)).path or '/'
+    if isinstance(body, str):
+        body = json.loads(body) if body.strip() else None
+    return Template(method.upper(), _template_path(path), body)
+
+def load_insomnia(path: str):
+    with open(path) as fp:
+        export = json.load(fp)
+    return [
+        _to_template(r['method'], r['url'], (r.get('body') or {}).get('text'))
+        for r in export.get('resources', []) if r.get('_type') == 'request'
+    ]
+
+def load_recorded(path: str):
+    templates, skipped = [], 0
+    with open(path) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            target = record.get('path') or record.get('url')
+            if not record.get('method') or not target:
+                skipped += 1
+                continue
+            templates.append(_to_template(record['method'], target, record.get('body')))
+    if skipped:
+        print(f'{path}: skipped {skipped} lines that are not recorded requests', file=sys.stderr)
+    return templates
+
+def merge_templates(templates: list, mix: list):
+    """Collapse identical templates, weighting each by how often it was recorded, then apply --mix overrides"""
+    merged = {}
+    for template in templates:
+        if template.key in merged:
+            merged[template.key].weight += 1
+        else:
+            merged[template.key] = dataclasses.replace(template)
+    for item in mix:
+        key, _, weight = item.rpartition('=')
+        method, _, path = key.partition(' ')
+        template = merged.setdefault(key, Template(method.upper(), path))
+        template.weight = float(weight)
+    return [t for t in merged.values() if t.weight > 0]
+
+class IdPool:
+    """Ids known to exist on the server, plus the rows this run created (the only ones it deletes)"""
+
+    def __init__(self, target, rng: random.Random):
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.existing = {'task': self._fetch(target, '/tasks', 'tasks', 'task_id'),
+                         'user': self._fetch(target, '/users', 'users', 'user_id')}
+        self.created = {'task': [], 'user': []}
+        self.counter = itertools.count()
+        self.run_tag = f'{int(time.time())}{rng.randrange(1000):03d}'
+
+    @staticmethod
+    def _fetch(target, path: str, key: str, id_key: str, limit: int = 5000):
+        ids, cursor = [], None
+        while len(ids) < limit:
+            status, body = target.request('GET', f'{path}?limit=1000' + (f'&after={cursor}' if cursor else ''))
+            if status != 200:
+                break
+            page = json.loads(body)
+            ids.extend(item[id_key] for item in page[key])
+            cursor = page.get('next_cursor')
+            if not cursor:
+                break
+        return ids
+
+    def pick(self, kind: str, for_delete: bool = False):
+        with self.lock:
+            if for_delete:
+                return self.created[kind].pop() if self.created[kind] else None
+            choices = self.existing[kind] or self.created[kind]
+            return self.rng.choice(choices) if choices else None
+
+    def record_created(self, kind: str, new_id: int):
+        with self.lock:
+            self.created[kind].append(new_id)
+
+    def unique(self, prefix: str):
+        return f'{prefix}_load_{self.run_tag}_{next(self.counter)}'
+
+def render(template: Template, ids: IdPool):
+    """Fill a template's placeholders; returns (path, body) or None if no suitable id exists yet"""
+    is_delete = template.method == 'DELETE'
+    path = template.path
+    for kind in ('task', 'user'):
+        placeholder = '{' + kind + '}'
+        while placeholder in path:
+            value = ids.pick(kind, for_delete=is_delete and path.endswith(placeholder))
+            if value is None:
+                return None
+            path = path.replace(placeholder, str(value), 1)
+
+    body = dict(template.body) if template.body else None
+    if body:
+        for field in UNIQUE_FIELDS:
+            if field in body:
+                body[field] = ids.unique(field)
+        if 'email' in body:
+            body['email'] = ids.unique('email') + '@example.com'
+        if 'created_by_user' in body:
+            body['created_by_user'] = ids.pick('user')
+    return path, body
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.statuses = collections.defaultdict(collections.Counter)
+
+    def add(self, key: str, status: int, latency_ms: float):
+        with self.lock:
+            self.latencies[key].append(latency_ms)
+            self.statuses[key][status] += 1
+
+    def report(self, elapsed: float):
+        rows = {}
+        for key, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            statuses = self.statuses[key]
+            errors = sum(n for s, n in statuses.items() if s == 0 or s >= 500)
+            rows[key] = {
+                'requests': len(latencies),
+                'error_rate': round(errors / len(latencies), 4),
+                'client_error_rate': round(sum(n for s, n in statuses.items() if 400 <= s < 500) / len(latencies), 4),
+                'status_codes': {str(s): n for s, n in statuses.items()},
+                'p50_ms': round(_percentile(latencies, 50), 3),
+                'p95_ms': round(_percentile(latencies, 95), 3),
+                'p99_ms': round(_percentile(latencies, 99), 3),
+                'throughput_rps': round(len(latencies) / elapsed, 2),
+            }
+        return rows
+
+def issue(target, template: Template, ids: IdPool, recorder: Recorder, scheduled: float = None):
+    rendered = render(template, ids)
+    if rendered is None:
+        return
+    path, body = rendered
+    start = time.perf_counter()
+    status, data = target.request(template.method, path, body)
+    recorder.add(template.key, status, (time.perf_counter() - (scheduled or start)) * 1000)
+
+    if template.method == 'POST' and status in (200, 201) and template.path in ('/tasks', '/users'):
+        created = json.loads(data)
+        kind = 'task' if template.path == '/tasks' else 'user'
+        ids.record_created(kind, created[f'{kind}_id'])
+
+def run_closed(target, templates, ids, recorder, rng, args):
+    """--concurrency clients send back to back; client i starts after i/concurrency of the ramp-up"""
+    deadline = time.perf_counter() + args.duration
+    weights = [t.weight for t in templates]
+    choose_lock = threading.Lock()
+
+    def client(index: int):
+        time.sleep(args.ramp_up * index / args.concurrency)
+        while time.perf_counter() < deadline:
+            with choose_lock:
+                template = rng.choices(templates, weights)[0]
+            issue(target, template, ids, recorder)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(client, range(args.concurrency)))
+
+def run_open(target, templates, ids, recorder, rng, args):
+    """Start requests at --rate per second (ramping up linearly), independent of response times"""
+    weights = [t.weight for t in templates]
+    start = time.perf_counter()
+    deadline = start + args.duration
+    next_at = start
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_in_flight) as pool:
+        while next_at < deadline:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            template = rng.choices(templates, weights)[0]
+            pool.submit(issue, target, template, ids, recorder, next_at)
+
+            elapsed = next_at - start
+            rate = args.rate * min(1.0, elapsed / args.ramp_up) if args.ramp_up else args.rate
+            next_at += 1.0 / max(rate, 1.0)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='base URL of the server under load')
+    parser.add_argument('--insomnia', default='Insomnia_export.json', help='Insomnia export to take requests from ("" to skip)')
+    parser.add_argument('--recorded', action='append', default=[], help='JSONL file of recorded calls; repeatable')
+    parser.add_argument('--mix', action='append', default=[], metavar='"METHOD /path=WEIGHT"',
+                        help='set the weight of a request template, e.g. "GET /tasks/{task}=10"; 0 removes it')
+    parser.add_argument('--mode', choices=['closed', 'open'], default='closed')
+    parser.add_argument('--concurrency', type=int, default=8, help='clients in closed-loop mode')
+    parser.add_argument('--rate', type=float, default=50.0, help='arrivals per second in open-loop mode')
+    parser.add_argument('--max-in-flight', type=int, default=256, help='outstanding requests allowed in open-loop mode')
+    parser.add_argument('--ramp-up', type=float, default=0.0, help='seconds to reach full concurrency/rate')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to generate load for')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', help='write the per-endpoint report as JSON here')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+
+    templates = load_insomnia(args.insomnia) if args.insomnia else []
+    for path in args.recorded:
+        templates.extend(load_recorded(path))
+    templates = merge_templates(templates, args.mix)
+    if not templates:
+        print('no requests to replay', file=sys.stderr)
+        return 1
+
+    target = HttpTarget(args.url)
+    ids = IdPool(target, rng)
+    recorder = Recorder()
+    print(f"replaying {len(templates)} request templates against {args.url} "
+          f"({len(ids.existing['task'])} tasks, {len(ids.existing['user'])} users)", file=sys.stderr)
+
+    start = time.perf_counter()
+    (run_open if args.mode == 'open' else run_closed)(target, templates, ids, recorder, rng, args)
+    report = recorder.report(time.perf_counter() - start)
+
+    print(f"{'request':<45} {'n':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'err%':>6} {'4xx%':>6}")
+    for key, row in report.items():
+        print(f"{key:<45} {row['requests']:>6} {row['p50_ms']:>8.1f}ms {row['p95_ms']:>8.1f}ms {row['p99_ms']:>8.1f}ms "
+              f"{row['error_rate'] * 100:>6.1f} {row['client_error_rate'] * 100:>6.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'mode': args.mode, 'url': args.url, 'duration': args.duration, 'endpoints': report}, fp, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""Micro-benchmark: password hashes per second for each algorithm/cost setting.
+
+Run from the repository root:
+
+    python -m benchmarks.password_hashing --seconds 2 --workers 4
+
+Single-thread numbers show the CPU cost of one hash (i.e. the latency added
+to POST /users and password PATCHes); pool numbers show the throughput one
+gunicorn worker gets from a PasswordHasher with that many threads.
+"""
+import argparse
+import concurrent.futures
+import time
+
+from src.passwords import PasswordHasher, make_hash
+
+SETTINGS = [
+    ('pbkdf2_sha256', (100_000,)),
+    ('pbkdf2_sha256', (310_000,)),
+    ('pbkdf2_sha256', (600_000,)),
+    ('scrypt', (2 ** 14, 8, 1)),
+    ('scrypt', (2 ** 15, 8, 1)),
+    ('scrypt', (2 ** 16, 8, 1)),
+]
+
+def single_thread_rate(algorithm: str, cost: tuple, seconds: float):
+    done = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        make_hash('correct horse battery staple', algorithm, cost)
+        done += 1
+    return done / (time.perf_counter() - start)
+
+def pool_rate(algorithm: str, cost: tuple, seconds: float, workers: int):
+    kwargs = {'pbkdf2_iterations': cost[0]} if algorithm == 'pbkdf2_sha256' else {'scrypt_cost': cost}
+    hasher = PasswordHasher(algorithm, workers=workers, queue_limit=workers, **kwargs)
+
+    def client():
+        done = 0
+        while time.perf_counter() - start < seconds:
+            hasher.hash('correct horse battery staple')
+            done += 1
+        return done
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as clients:
+        done = sum(clients.map(lambda _: client(), range(workers)))
+    elapsed = time.perf_counter() - start
+    hasher.shutdown()
+    return done / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=2.0, help='time spent on each setting')
+    parser.add_argument('--workers', type=int, default=2, help='PasswordHasher pool size')
+    args = parser.parse_args()
+
+    print(f"{'algorithm':<15} {'cost':<16} {'ms/hash':>9} {'hashes/s':>10} {'pool hashes/s':>14}")
+    for algorithm, cost in SETTINGS:
+        rate = single_thread_rate(algorithm, cost, args.seconds)
+        pooled = pool_rate(algorithm, cost, args.seconds, args.workers)
+        cost_text = ','.join(str(c) for c in cost)
+        print(f'{algorithm:<15} {cost_text:<16} {1000 / rate:>9.1f} {rate:>10.1f} {pooled:>14.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Micro-benchmark: per-row cost of serializing task/user lists through the ORM and through the column projection.
+
+Run from the repository root:
+
+    python -m benchmarks.serialization --preset 10k
+    python -m benchmarks.serialization --preset 100k --rows 50000 --database-uri postgresql://postgres@localhost/bench
+
+Each path fetches the same rows and renders them to JSON the way GET /tasks
+and GET /users do (the ORM path serializes Task objects, whose dynamic
+assignee collections are read with one query per task). CPU time is process time per row; allocations are the
+tracemalloc peak while the list is fetched and rendered, divided by the
+number of rows. The JSON of both paths is compared
+byte for byte.
+"""
+import argparse
+import dataclasses
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import select
+
+from benchmarks import datasets
+
+def _measure(render, repeat: int):
+    """(best CPU seconds, tracemalloc peak bytes, output) of render()"""
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.process_time()
+        render()
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    gc.collect()
+    tracemalloc.start()
+    output = render()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, output
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--preset', choices=sorted(datasets.PRESETS), default='10k')
+    parser.add_argument('--rows', type=int, help='rows per list (default: every task)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per path; the fastest is reported')
+    parser.add_argument('--database-uri', help='defaults to a temporary SQLite file')
+    args = parser.parse_args(argv)
+
+    from flask import jsonify
+    from src import create_app
+    from src.api.projection import select_tasks, select_users, serialize_tasks, serialize_users
+    from src.models import Task, User, db
+
+    spec = dataclasses.replace(datasets.PRESETS[args.preset], logs_per_task=0)
+    rows = args.rows or spec.tasks
+    database_uri = args.database_uri or f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='serialization-bench-'), 'bench.db')}"
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_uri, 'TASK_LOG_MODE': 'trigger', 'SQL_INSTRUMENTATION': False})
+
+    def orm(model, options=()):
+        def render():
+            try:
+                objects = db.session.scalars(select(model).options(*options).order_by(model.id).limit(rows)).all()
+                return jsonify([o.serialize() for o in objects]).get_data()
+            finally:
+                db.session.remove()  # a fresh identity map each run, as in a request
+        return render
+
+    def projection(stmt, serialize, id_column):
+        def render():
+            try:
+                return jsonify(serialize(db.session.execute(stmt.order_by(id_column).limit(rows)).all())).get_data()
+            finally:
+                db.session.remove()
+        return render
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        datasets.seed(spec)
+        paths = [
+            ('tasks', orm(Task), projection(select_tasks(), serialize_tasks, Task.id)),
+            ('users', orm(User), projection(select_users(), serialize_users, User.id)),
+        ]
+
+        print(f"{'list':<6} {'path':<11} {'rows':>7} {'us/row':>8} {'peak B/row':>11}  identical")
+        for name, orm_render, projection_render in paths:
+            results = [('orm', _measure(orm_render, args.repeat)), ('projection', _measure(projection_render, args.repeat))]
+            identical = results[0][1][2] == results[1][1][2]
+            for label, (cpu, peak, _) in results:
+                count = min(rows, spec.tasks if name == 'tasks' else spec.users)
+                print(f"{name:<6} {label:<11} {count:>7} {cpu / count * 1e6:>8.1f} {peak / count:>11.0f}  "
+                      f"{'yes' if identical else 'NO'}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
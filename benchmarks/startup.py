@@ -0,0 +1,58 @@
+"""Measure how long create_app takes, cold (fresh interpreter) and warm (modules already imported).
+
+Run from the repository root:
+
+    python -m benchmarks.startup --runs 10
+    python -m benchmarks.startup --testing   # SQLite config, no Postgres driver needed
+
+Cold time is what each gunicorn worker pays without preload_app; warm time is
+the part of create_app that is not import cost.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+COLD_SNIPPET = '''
+import time
+start = time.perf_counter()
+from src import create_app
+create_app({config})
+print(time.perf_counter() - start)
+'''
+
+def cold_runs(runs: int, config: str):
+    timings = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', COLD_SNIPPET.format(config=config)],
+                             check=True, capture_output=True, text=True)
+        timings.append(float(out.stdout.strip().splitlines()[-1]))
+    return timings
+
+def warm_runs(runs: int, test_config):
+    from src import create_app
+    create_app(test_config)  # pay the imports once
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        create_app(test_config)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def report(label: str, timings: list):
+    ms = sorted(t * 1000 for t in timings)
+    print(f'{label:<6} runs={len(ms):<4} min={ms[0]:8.1f}ms  median={statistics.median(ms):8.1f}ms  max={ms[-1]:8.1f}ms')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--testing', action='store_true', help='build the app with the SQLite testing config')
+    args = parser.parse_args()
+
+    test_config = {'TESTING': True} if args.testing else None
+    report('cold', cold_runs(args.runs, repr(test_config)))
+    report('warm', warm_runs(args.runs, test_config))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Compare PATCH /tasks/<id> write throughput with task_logs written by triggers and by the app.
+
+Run from the repository root:
+
+    python -m benchmarks.task_log_writes --requests 2000
+    python -m benchmarks.task_log_writes --target gunicorn --concurrency 16 --requests 5000
+    python -m benchmarks.task_log_writes --database-uri postgresql://postgres@localhost/bench_{mode}
+
+Each mode gets its own freshly seeded database ({mode} in --database-uri is
+replaced by the mode name). In trigger mode the triggers from
+postgres_database_schema/tasks_table.sql (or their SQLite equivalent) are
+installed; in app mode the app's batched writer logs the changes instead.
+Every request changes the task's status, so each one produces a log row,
+and the number of rows logged is reported to show both modes record the same.
+"""
+import argparse
+import dataclasses
+import json
+import os
+import random
+import sys
+import tempfile
+
+from benchmarks import datasets
+from benchmarks.endpoints import FlaskTarget, HttpTarget, Route, Workload, run_route, start_gunicorn
+
+MODES = ['trigger', 'app']
+
+TRIGGER_DDL = {
+    'postgresql': [
+        """CREATE OR REPLACE FUNCTION public.log_task_status() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO task_logs (task_id, status, timestamp) VALUES (NEW.id, NEW.status, NOW());
+            RETURN NEW;
+        END; $$""",
+        """CREATE OR REPLACE FUNCTION public.update_task_progress() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF NEW.status <> OLD.status THEN
+                INSERT INTO task_logs (task_id, status, timestamp) VALUES (NEW.id, NEW.status, NOW());
+            END IF;
+            RETURN NEW;
+        END; $$""",
+        'DROP TRIGGER IF EXISTS log_task_status_trigger ON tasks',
+        'CREATE TRIGGER log_task_status_trigger AFTER INSERT ON tasks FOR EACH ROW EXECUTE FUNCTION public.log_task_status()',
+        'DROP TRIGGER IF EXISTS status_update_trigger ON tasks',
+        'CREATE TRIGGER status_update_trigger AFTER UPDATE OF status ON tasks FOR EACH ROW EXECUTE FUNCTION public.update_task_progress()',
+    ],
+    'sqlite': [
+        """CREATE TRIGGER IF NOT EXISTS log_task_status_trigger AFTER INSERT ON tasks WHEN new.status IS NOT NULL BEGIN
+            INSERT INTO task_logs (task_id, status, timestamp) VALUES (new.id, new.status, datetime('now'));
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS status_update_trigger AFTER UPDATE OF status ON tasks
+        WHEN new.status IS NOT old.status AND new.status IS NOT NULL BEGIN
+            INSERT INTO task_logs (task_id, status, timestamp) VALUES (new.id, new.status, datetime('now'));
+        END""",
+    ],
+}
+
+def _change_status(w: Workload):
+    task_id = w.task()
+    return f'/tasks/{task_id}', {'title': w.titles[task_id], 'status': w.unique('status')}, None
+
+def run_mode(mode: str, args, spec: datasets.DatasetSpec, workdir: str):
+    from src import create_app
+    from src.models import Task, db, task_log_writer, task_progress_table
+
+    database_uri = (args.database_uri or f'sqlite:///{os.path.join(workdir, "{mode}.db")}').replace('{mode}', mode)
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_uri, 'TASK_LOG_MODE': mode, 'RESPONSE_CACHE_MAX_ENTRIES': 0})
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        datasets.seed(spec)
+        if mode == 'trigger':
+            with db.engine.begin() as connection:
+                for statement in TRIGGER_DDL[db.engine.dialect.name]:
+                    connection.exec_driver_sql(statement)
+        elif task_log_writer() is not None:
+            task_log_writer().flush()  # the seeded tasks' creation rows are not part of the measurement
+        titles = dict(db.session.query(Task.id, Task.title))
+        logs_before = db.session.query(task_progress_table).count()
+
+    server = None
+    try:
+        if args.target == 'flask':
+            target, concurrency = FlaskTarget(app), 1
+        else:
+            server, base_url = start_gunicorn(database_uri, {'FLASK_TASK_LOG_MODE': mode,
+                                                             'FLASK_RESPONSE_CACHE_MAX_ENTRIES': '0'})
+            target, concurrency = HttpTarget(base_url), args.concurrency
+
+        workload = Workload(random.Random(spec.seed), list(titles), [])
+        workload.titles = titles
+        result = run_route(target, workload, Route('tasks.update', 'PATCH', _change_status), args.requests, concurrency)
+    finally:
+        if server is not None:
+            server.terminate()  # workers write what they still buffer on the way out
+            server.wait(timeout=30)
+
+    with app.app_context():
+        writer = task_log_writer()
+        if writer is not None:
+            writer.flush()
+        result['task_logs_written'] = db.session.query(task_progress_table).count() - logs_before
+        result['writer'] = writer.stats() if writer is not None else None
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000, help='PATCH requests per mode')
+    parser.add_argument('--tasks', type=int, default=1000, help='tasks in the seeded dataset')
+    parser.add_argument('--target', choices=['flask', 'gunicorn'], default='flask')
+    parser.add_argument('--concurrency', type=int, default=8, help='parallel clients (gunicorn target only)')
+    parser.add_argument('--database-uri', help='database per mode; "{mode}" is replaced by the mode name')
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--output', help='write results JSON here')
+    args = parser.parse_args(argv)
+
+    spec = dataclasses.replace(datasets.PRESETS['1k'], tasks=args.tasks, logs_per_task=0)
+    workdir = tempfile.mkdtemp(prefix='task-log-bench-')
+    results = {}
+    print(f"{'mode':<10} {'n':>6} {'p50':>9} {'p95':>9} {'req/s':>9} {'logged':>7}")
+    for mode in args.modes.split(','):
+        result = results[mode] = run_mode(mode, args, spec, workdir)
+        print(f"{mode:<10} {result['requests']:>6} {result['p50_ms']:>8.2f}ms {result['p95_ms']:>8.2f}ms "
+              f"{result['throughput_rps']:>9.1f} {result['task_logs_written']:>7}")
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
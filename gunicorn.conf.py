@@ -0,0 +1,57 @@
+# Gunicorn settings for the task management API; every value can be overridden with a GUNICORN_* variable.
+#
+# Each worker process gets its own connection pool, so the database sees up to
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections.
+import multiprocessing
+import os
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+def _env_bool(name, default):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# Requests spend most of their time waiting on Postgres, so by default each
+# process runs a few threads and the process count follows the usual 2n+1 rule.
+workers = _env_int('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1)
+threads = _env_int('GUNICORN_THREADS', 4)
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread' if threads > 1 else 'sync')
+
+timeout = _env_int('GUNICORN_TIMEOUT', 30)
+graceful_timeout = _env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+keepalive = _env_int('GUNICORN_KEEPALIVE', 5)
+max_requests = _env_int('GUNICORN_MAX_REQUESTS', 0)
+max_requests_jitter = _env_int('GUNICORN_MAX_REQUESTS_JITTER', 0)
+
+# Importing the app once in the master makes forks cheap and shares its memory copy-on-write.
+preload_app = _env_bool('GUNICORN_PRELOAD_APP', True)
+
+accesslog = os.environ.get('GUNICORN_ACCESSLOG', '-')
+
+def post_fork(server, worker):
+    """Give every worker fresh connection pools.
+
+    With preload_app the engines were created in the master; any connection it
+    opened must not be reused by a child, so the pools are replaced without
+    closing the parent's sockets (dispose(close=False)).
+    """
+    if not preload_app:
+        return
+    from src.models import db
+    from wsgi import app
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+def worker_exit(server, worker):
+    """Write the task_logs rows the app-side writer still buffers before the worker goes away"""
+    from src.models import task_log_writer
+    from wsgi import app
+
+    with app.app_context():
+        writer = task_log_writer()
+        if writer is not None:
+            writer.flush()
@@ -0,0 +1,74 @@
+"""Incrementally maintained time-in-status rollups over task_logs
+
+Revision ID: 3f9a6d1c7e52
+Revises: 8c4d0e6f2a17
+Create Date: 2026-10-18 15:03:27.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a6d1c7e52'
+down_revision = '8c4d0e6f2a17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # an increasing id on task_logs is the high-water mark the rollups are refreshed from;
+    # existing rows are numbered in log order
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('ALTER TABLE task_logs ADD COLUMN id bigint GENERATED BY DEFAULT AS IDENTITY')
+        op.execute("""
+            UPDATE task_logs SET id = numbered.n
+            FROM (SELECT ctid, row_number() OVER (ORDER BY "timestamp", task_id) AS n FROM task_logs) numbered
+            WHERE task_logs.ctid = numbered.ctid
+        """)
+        op.execute("SELECT setval(pg_get_serial_sequence('task_logs', 'id'), COALESCE(MAX(id), 1)) FROM task_logs")
+        op.create_primary_key('task_logs_pkey', 'task_logs', ['id'])
+    else:
+        with op.batch_alter_table('task_logs', recreate='always') as batch_op:
+            batch_op.add_column(sa.Column('id', sa.Integer(), primary_key=True), insert_before='task_id')
+    op.create_index('ix_task_logs_task_id_timestamp', 'task_logs', ['task_id', 'timestamp'])
+
+    op.create_table('task_status_durations',
+    sa.Column('task_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=50), nullable=False),
+    sa.Column('period', sa.Date(), nullable=False),
+    sa.Column('seconds', sa.Float(), nullable=False),
+    sa.Column('visits', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['task_id'], ['tasks.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('task_id', 'status', 'period')
+    )
+    op.create_index('ix_task_status_durations_status_period', 'task_status_durations', ['status', 'period'])
+    op.create_table('task_status_state',
+    sa.Column('task_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=50), nullable=False),
+    sa.Column('entered_at', sa.DateTime(), nullable=False),
+    sa.Column('first_logged_at', sa.DateTime(), nullable=False),
+    sa.Column('completed_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['task_id'], ['tasks.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('task_id')
+    )
+    op.create_table('rollup_watermarks',
+    sa.Column('name', sa.String(length=50), nullable=False),
+    sa.Column('last_id', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('rollup_watermarks')
+    op.drop_table('task_status_state')
+    op.drop_index('ix_task_status_durations_status_period', table_name='task_status_durations')
+    op.drop_table('task_status_durations')
+
+    op.drop_index('ix_task_logs_task_id_timestamp', table_name='task_logs')
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_constraint('task_logs_pkey', 'task_logs', type_='primary')
+        op.drop_column('task_logs', 'id')
+    else:
+        with op.batch_alter_table('task_logs', recreate='always') as batch_op:
+            batch_op.drop_column('id')
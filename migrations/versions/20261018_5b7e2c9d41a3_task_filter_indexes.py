@@ -0,0 +1,41 @@
+"""Composite indexes for task filtering, sorting and assignee lookups
+
+Revision ID: 5b7e2c9d41a3
+Revises: adc28fac1c16
+Create Date: 2026-10-18 10:12:41.518302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e2c9d41a3'
+down_revision = 'adc28fac1c16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # B-tree (column, id) indexes serve equality/range filters and the matching keyset-paginated sort
+    op.create_index('ix_tasks_status_id', 'tasks', ['status', 'id'])
+    op.create_index('ix_tasks_deadline_id', 'tasks', ['deadline', 'id'])
+    op.create_index('ix_tasks_created_by_user_id', 'tasks', ['created_by_user', 'id'])
+
+    # the (user_id, task_id) primary key cannot serve lookups that start from a task
+    op.create_index('ix_task_assignees_task_id_user_id', 'task_assignees', ['task_id', 'user_id'])
+
+    # the hand-made hash index on tasks.status (see README) is superseded by ix_tasks_status_id,
+    # which also serves range and ordered scans
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP INDEX IF EXISTS idx_tasks_status_hash')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE INDEX IF NOT EXISTS idx_tasks_status_hash ON tasks USING hash (status)')
+
+    op.drop_index('ix_task_assignees_task_id_user_id', table_name='task_assignees')
+    op.drop_index('ix_tasks_created_by_user_id', table_name='tasks')
+    op.drop_index('ix_tasks_deadline_id', table_name='tasks')
+    op.drop_index('ix_tasks_status_id', table_name='tasks')
@@ -0,0 +1,25 @@
+"""Horizons on task_events, replacing the advisory lock that made ids commit in order
+
+Revision ID: a9c3f5e1d702
+Revises: e5a2c7b19f48
+Create Date: 2026-10-18 22:04:17.390514
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9c3f5e1d702'
+down_revision = 'e5a2c7b19f48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing rows keep NULL: they were written under the lock and are already settled
+    op.add_column('task_events', sa.Column('horizon', sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('task_events', 'horizon')
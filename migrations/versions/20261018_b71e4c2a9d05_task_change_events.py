@@ -0,0 +1,33 @@
+"""Task change events behind the /tasks/changes stream
+
+Revision ID: b71e4c2a9d05
+Revises: 3f9a6d1c7e52
+Create Date: 2026-10-18 17:41:09.215734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b71e4c2a9d05'
+down_revision = '3f9a6d1c7e52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('task_events',
+    sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('task_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_task_events_created_at', 'task_events', ['created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_task_events_created_at', table_name='task_events')
+    op.drop_table('task_events')
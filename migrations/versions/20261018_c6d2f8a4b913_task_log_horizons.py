@@ -0,0 +1,53 @@
+"""Horizons on task_logs, so the rollups never pass a log row that commits late; stored completion times
+
+Revision ID: c6d2f8a4b913
+Revises: a9c3f5e1d702
+Create Date: 2026-10-18 23:41:09.218734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6d2f8a4b913'
+down_revision = 'a9c3f5e1d702'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing rows keep NULL: they are counted as settled, as they were under the settle delay
+    op.add_column('task_logs', sa.Column('horizon', sa.BigInteger(), nullable=True))
+    op.add_column('task_status_state', sa.Column('completion_seconds', sa.Float(), nullable=True))
+    op.create_index('ix_task_status_state_completion_seconds', 'task_status_state', ['completion_seconds'])
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('UPDATE task_status_state SET completion_seconds = extract(epoch FROM completed_at - first_logged_at) '
+                   'WHERE completed_at IS NOT NULL')
+        # rows written by the log_task_status/update_task_progress triggers get their horizon here: a BEFORE
+        # trigger runs once the id default is drawn, and in a volatile function the assignment below takes a
+        # new snapshot. The app's writer sets the horizon itself.
+        op.execute("""
+            CREATE OR REPLACE FUNCTION public.task_logs_horizon() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                IF NEW.horizon IS NULL THEN
+                    NEW.horizon := pg_snapshot_xmax(pg_current_snapshot())::text::bigint;
+                END IF;
+                RETURN NEW;
+            END; $$
+        """)
+        op.execute('CREATE TRIGGER task_logs_horizon_trigger BEFORE INSERT ON task_logs '
+                   'FOR EACH ROW EXECUTE FUNCTION public.task_logs_horizon()')
+    else:
+        op.execute("UPDATE task_status_state SET completion_seconds = "
+                   "(julianday(completed_at) - julianday(first_logged_at)) * 86400.0 WHERE completed_at IS NOT NULL")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP TRIGGER IF EXISTS task_logs_horizon_trigger ON task_logs')
+        op.execute('DROP FUNCTION IF EXISTS public.task_logs_horizon()')
+    op.drop_index('ix_task_status_state_completion_seconds', table_name='task_status_state')
+    op.drop_column('task_status_state', 'completion_seconds')
+    op.drop_column('task_logs', 'horizon')
@@ -0,0 +1,42 @@
+"""Background jobs queue
+
+Revision ID: e5a2c7b19f48
+Revises: d4e8a1f0c392
+Create Date: 2026-10-18 21:26:53.604188
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a2c7b19f48'
+down_revision = 'd4e8a1f0c392'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('jobs',
+    sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.Column('kind', sa.String(length=50), nullable=False),
+    sa.Column('key', sa.String(length=128), nullable=False),
+    sa.Column('payload', sa.JSON(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('max_attempts', sa.Integer(), nullable=False),
+    sa.Column('visible_at', sa.DateTime(), nullable=False),
+    sa.Column('progress', sa.JSON(), nullable=True),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_jobs_status_visible_at', 'jobs', ['status', 'visible_at'])
+    op.create_index('ix_jobs_key', 'jobs', ['key'])
+
+
+def downgrade():
+    op.drop_index('ix_jobs_key', table_name='jobs')
+    op.drop_index('ix_jobs_status_visible_at', table_name='jobs')
+    op.drop_table('jobs')
@@ -44,21 +44,70 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
-        SQLALCHEMY_ECHO=True
+        SQLALCHEMY_ECHO=False,  # logging every statement is too slow outside debugging
+        DB_POOL_SIZE=5,  # connections kept open per gunicorn worker
+        DB_MAX_OVERFLOW=10,  # extra connections allowed under bursts
+        DB_POOL_TIMEOUT=10,  # seconds to wait for a free connection
+        DB_POOL_RECYCLE=1800,  # seconds before a connection is replaced
+        DB_POOL_PRE_PING=True,  # detect connections dropped by the server before using them
+        DB_STATEMENT_TIMEOUT_MS=30_000,  # Postgres statement_timeout; 0 disables it
+        SQL_INSTRUMENTATION=True,  # per-request query counts in Server-Timing headers and log lines
+        SQL_DETECT_N_PLUS_ONE=False,  # warn about statements repeated within one request
+        SQL_N_PLUS_ONE_THRESHOLD=5,
+        RESPONSE_CACHE_MAX_ENTRIES=1024,  # 0 disables the response cache
+        RESPONSE_CACHE_TTL=10.0,  # seconds; also bounds staleness across gunicorn workers
+        USER_CACHE_SLOTS=4096,  # user records shared by task serialization across workers (288 bytes each); 0 disables it
+        USER_CACHE_TTL=60.0,  # seconds a cached user record is used; bounds staleness from writes on other hosts
+        USER_CACHE_PATH=None,  # file mapped by every process sharing the cache; None shares it with workers forked from this process
+        PASSWORD_HASH_ALGORITHM='pbkdf2_sha256',  # or 'scrypt'
+        PASSWORD_PBKDF2_ITERATIONS=600_000,
+        PASSWORD_SCRYPT_COST=(2 ** 14, 8, 1),  # n, r, p
+        PASSWORD_HASH_WORKERS=2,  # hashes computed at once per gunicorn worker
+        PASSWORD_HASH_QUEUE_LIMIT=16,  # hashes allowed to wait before requests get 503
+        PASSWORD_HASH_TIMEOUT=30.0,  # seconds a request waits for its hash before getting 503
+        ROLLUP_BATCH_SIZE=50_000,  # task_logs rows folded into the status rollups per transaction
+        ROLLUP_REFRESH_INTERVAL=30.0,  # seconds between refreshes triggered by reads; -1 leaves it to `flask data rollup`
+        TASK_LOG_MODE='auto',  # who writes task_logs: 'trigger' (database), 'app' (batched writer) or 'auto' (trigger if installed)
+        TASK_LOG_BATCH_SIZE=500,  # buffered status changes that trigger a write in app mode
+        TASK_LOG_FLUSH_INTERVAL=1.0,  # seconds a status change may wait in the buffer; 0 writes after every commit
+        ASYNC_DATABASE_URI=None,  # async read app (asgi.py); defaults to the database above via aiosqlite/asyncpg
+        ASGI_WSGI_THREADS=8,  # threads running the Flask app for requests asgi.py has no async view for
+        CHANGE_FEED_BACKEND='auto',  # wakes /tasks/changes subscribers: 'local' (this process) or 'postgres' (LISTEN/NOTIFY); 'auto' picks by database
+        CHANGE_FEED_HEARTBEAT=15.0,  # seconds between keepalives; also how often other workers' events are polled for locally
+        CHANGE_FEED_MAX_SECONDS=300.0,  # longest a stream stays open before the client reconnects with Last-Event-ID
+        CHANGE_FEED_RETENTION=86400.0,  # seconds task_events are kept for clients resuming a stream
+        JOB_INLINE_LIMIT=1000,  # deletes cascading to at most this many rows run in the request; larger ones are queued (0 queues all)
+        JOB_BATCH_SIZE=1000,  # rows a job deletes per transaction
+        JOB_VISIBILITY_TIMEOUT=60.0,  # seconds a claimed job is leased for between batches; then another worker may take it
+        JOB_MAX_ATTEMPTS=5,  # attempts before a job is marked failed
+        JOB_RETRY_DELAY=5.0,  # seconds before the first retry, doubled for every further attempt
+        JOB_POLL_INTERVAL=1.0,  # seconds an idle worker waits before looking for jobs again
+        ADMISSION_CONTROL=True,  # per-route-class concurrency limits and load shedding in front of the views
+        ADMISSION_CONCURRENCY={'expensive': 2, 'cheap': 32},  # requests of each class served at once per worker process
+        ADMISSION_QUEUE_BUDGET=1.0,  # seconds a request may wait, in front of the app (X-Request-Start) and for a slot, before a 503
+        ADMISSION_RATE={},  # per-client token buckets by class, e.g. {'expensive': (5.0, 20)}: requests/second and burst; 429 beyond
+        ADMISSION_ROUTE_CLASSES={},  # endpoint -> class overrides, e.g. {'users.show': 'expensive'} or 'exempt'
+        ADMISSION_CLIENT_HEADER=None,  # header identifying the client for ADMISSION_RATE (e.g. X-Forwarded-For); else the peer address
+        DATABASE_REPLICA_URIS=[],  # read replicas serving read-only GETs round-robin; empty reads everything from the primary
+        REPLICA_STICKY_SECONDS=5.0,  # a client that wrote reads from the primary this long; also the replica lag the cache allows for
+        REPLICA_CHECK_INTERVAL=5.0,  # seconds between health checks of each replica per worker process
+        REPLICA_MAX_LAG=None  # Postgres replicas replaying more than this many seconds behind are skipped; None only pings
     )
 
     if test_config is None:
-        # Load the default config when not testing
+        # Load the default config when not testing: instance/config.py, then FLASK_* environment variables
+        # (e.g. FLASK_SQLALCHEMY_DATABASE_URI, FLASK_DB_POOL_SIZE=20, FLASK_SQLALCHEMY_ECHO=true)
         app.config.from_pyfile('config.py', silent=True)
-        # Set the default database URI for non-testing environments
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://postgres@localhost:5432/task_management_system'
+        app.config.from_prefixed_env()
     else:
         # Load the test config if passed in
         app.config.update(test_config)
 
-    if app.config.get('TESTING'):
-        # Configure app for testing
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+    # Fall back to SQLite for testing and local Postgres otherwise, then derive the engine/pool options
+    from .config import database_uri, engine_options, replica_binds
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri(app.config)
+    app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {}, **replica_binds(app.config))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
 
     # Ensure the instance folder exists
     try:
@@ -67,13 +116,53 @@ def create_app(test_config=None):
         pass
 
     # Set up the database
-    from .models import db
+    from .models import db, init_task_log_writer
     db.init_app(app)
     migrate = Migrate(app, db)
+    init_task_log_writer(app)
+
+    # Shed or throttle requests before any other work is done for them
+    from . import admission
+    admission.init_app(app)
+
+    # Send read-only requests to the read replicas, if any
+    from . import replicas
+    replicas.init_app(app)
+
+    # Count statements and database time per request
+    from . import instrumentation
+    instrumentation.init_app(app)
+
+    # Set up the response cache for GET endpoints
+    from . import cache
+    cache.init_app(app)
+
+    # Set up the user records shared by task serialization
+    from . import user_cache
+    user_cache.init_app(app)
+
+    # Set up the password hashing pool
+    from . import passwords
+    passwords.init_app(app)
+
+    # Set up the time-in-status rollups refreshed from task_logs
+    from . import rollups
+    rollups.init_app(app)
+
+    # Set up the change feed behind /tasks/changes
+    from . import changes
+    changes.init_app(app)
 
     # Register blueprints
-    from .api import users, tasks 
+    from .api import users, tasks, stats, jobs
     app.register_blueprint(users.bp)
     app.register_blueprint(tasks.bp)
+    app.register_blueprint(stats.bp)
+    app.register_blueprint(jobs.bp)
+
+    # Register CLI commands (flask data import/export, flask jobs work)
+    from .cli import data_cli, jobs_cli
+    app.cli.add_command(data_cli)
+    app.cli.add_command(jobs_cli)
 
     return app
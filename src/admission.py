@@ -0,0 +1,232 @@
+from flask import current_app, g, jsonify, request
+
+import asyncio
+import collections
+import math
+import threading
+import time
+
+# Admission control: decide, before a view runs, whether this worker should serve the
+# request now, let it wait briefly, or turn it away. Requests are sorted into route
+# classes. The expensive class holds the endpoints whose cost grows with the data
+# (lists, exports, search, stats); everything else is cheap. Each class has its own
+# concurrency limit per worker process, so a burst of GET /tasks can only take
+# ADMISSION_CONCURRENCY['expensive'] threads and GET /users/<id> keeps the rest. A
+# request waits for a slot for at most ADMISSION_QUEUE_BUDGET seconds, counting the
+# time it already spent queued in front of the app (X-Request-Start), and is then shed
+# with 503. Optional per-client token buckets answer 429. Both carry Retry-After.
+
+EXPENSIVE_ENDPOINTS = frozenset({
+    'tasks.index', 'tasks.export', 'tasks.search', 'tasks.summary', 'tasks.status_durations', 'tasks.timeline',
+    'tasks.bulk_assignees', 'users.index', 'users.export', 'users.tasks_assigned', 'users.bulk_tasks_assigned',
+})
+EXEMPT = 'exempt'  # never limited: the change feed stream (long-lived by design) and the stats used to tune the limits
+EXEMPT_ENDPOINTS = frozenset({'tasks.changes', 'static'})
+EXEMPT_BLUEPRINTS = frozenset({'stats'})
+ASYNC_POLL_INTERVAL = 0.005  # seconds between looks for a free slot in enter_async()
+
+def route_class(endpoint: str, overrides: dict):
+    """The class a request for `endpoint` is admitted under (ADMISSION_ROUTE_CLASSES can move any endpoint)"""
+    if endpoint in overrides:
+        return overrides[endpoint]
+    if endpoint in EXEMPT_ENDPOINTS or (endpoint or '').partition('.')[0] in EXEMPT_BLUEPRINTS:
+        return EXEMPT
+    return 'expensive' if endpoint in EXPENSIVE_ENDPOINTS else 'cheap'
+
+def upstream_wait(header: str, now: float):
+    """Seconds since X-Request-Start (t=<seconds>, or integer ms/us as proxies write it); 0 without a usable header"""
+    if not header:
+        return 0.0
+    try:
+        start = float(header.strip().removeprefix('t='))
+    except ValueError:
+        return 0.0
+    if start > 1e14:  # microseconds
+        start /= 1e6
+    elif start > 1e11:  # milliseconds
+        start /= 1e3
+    return max(0.0, now - start)
+
+class Gate:
+    """Lets at most `limit` requests of a class run at once; the others wait up to a deadline"""
+
+    def __init__(self, limit: int = None):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def enter(self, timeout: float):
+        """Take a slot, waiting at most `timeout` seconds for one; False if none came free"""
+        with self._cond:
+            if self.limit is not None and self.active >= self.limit:
+                if timeout <= 0:
+                    return False
+                self.waiting += 1
+                try:
+                    if not self._cond.wait_for(lambda: self.active < self.limit, timeout):
+                        return False
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            return True
+
+    async def enter_async(self, timeout: float):
+        """enter() for asyncio callers: polls for a slot rather than blocking the event loop's thread"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.waiting += 1
+        try:
+            while not self.enter(0):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                await asyncio.sleep(min(ASYNC_POLL_INTERVAL, remaining))
+            return True
+        finally:
+            with self._cond:
+                self.waiting -= 1
+
+    def leave(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+class TokenBuckets:
+    """Per-client token buckets: `rate` requests per second on average, bursts of up to `burst`.
+
+    Only the `max_clients` most recently seen clients are remembered; a
+    forgotten client starts again with a full bucket.
+    """
+
+    def __init__(self, rate: float, burst: int, max_clients: int = 10_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = collections.OrderedDict()  # client -> (tokens, monotonic time of the last update)
+        self._lock = threading.Lock()
+
+    def take(self, client: str):
+        """Spend a token for `client`; returns 0.0 if it had one, else seconds until it will"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[client] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+class AdmissionControl:
+    """Per-worker admission state: a Gate and optional TokenBuckets per route class, and their counters"""
+
+    COUNTERS = ('admitted', 'throttled', 'shed_busy', 'shed_late')
+
+    def __init__(self, concurrency: dict, rates: dict, queue_budget: float, route_classes: dict = None,
+                 client_header: str = None, max_clients: int = 10_000):
+        self.queue_budget = queue_budget
+        self.route_classes = dict(route_classes or {})
+        self.client_header = client_header
+        classes = set(concurrency) | set(rates) | {'cheap', 'expensive'} | set(self.route_classes.values())
+        classes.discard(EXEMPT)
+        self.gates = {name: Gate(concurrency.get(name)) for name in classes}
+        self.buckets = {name: TokenBuckets(*rates[name], max_clients=max_clients) for name in classes if rates.get(name)}
+        self.counts = {name: dict.fromkeys(self.COUNTERS, 0) for name in classes}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str, counter: str):
+        with self._lock:
+            self.counts[name][counter] += 1
+
+    def _client(self):
+        if self.client_header:
+            value = request.headers.get(self.client_header, '').split(',')[0].strip()
+            if value:
+                return value
+        return request.remote_addr or ''
+
+    def _screen(self):
+        """(class, seconds it may wait for a slot, None), or (class, None, the 503/429 response) before any waiting"""
+        name = route_class(request.endpoint, self.route_classes)
+        if name == EXEMPT:
+            return name, None, None
+
+        budget = self.queue_budget - upstream_wait(request.headers.get('X-Request-Start'), time.time())
+        if budget <= 0:  # it waited in front of the app for longer than it may wait in total
+            self._count(name, 'shed_late')
+            return name, None, _refuse(503, 'Server is overloaded; the request waited too long to be served', 1)
+
+        buckets = self.buckets.get(name)
+        if buckets is not None:
+            wait = buckets.take(self._client())
+            if wait > 0:
+                self._count(name, 'throttled')
+                return name, None, _refuse(429, 'Too many requests; slow down', wait)
+        return name, budget, None
+
+    def _entered(self, name: str, entered: bool):
+        if not entered:
+            self._count(name, 'shed_busy')
+            return _refuse(503, 'Server is overloaded; try again shortly', 1)
+        g.admission_class = name
+        self._count(name, 'admitted')
+        return None
+
+    def admit(self):
+        """None to serve the request (holding a slot until release()), or the 503/429 response to send instead"""
+        name, budget, refusal = self._screen()
+        if budget is None:
+            return refusal
+        return self._entered(name, self.gates[name].enter(budget))
+
+    async def admit_async(self):
+        """admit() for the asyncio views of asgi.py (inside their Flask request context)"""
+        name, budget, refusal = self._screen()
+        if budget is None:
+            return refusal
+        return self._entered(name, await self.gates[name].enter_async(budget))
+
+    def release(self, exc=None):
+        name = g.pop('admission_class', None)
+        if name is not None:
+            self.gates[name].leave()
+
+    def stats(self):
+        result = {}
+        for name, gate in self.gates.items():
+            buckets = self.buckets.get(name)
+            with self._lock:
+                counts = dict(self.counts[name])
+            result[name] = dict(counts, limit=gate.limit, active=gate.active, waiting=gate.waiting,
+                                rate=buckets.rate if buckets else None, burst=buckets.burst if buckets else None)
+        return result
+
+def _refuse(status: int, message: str, retry_after: float):
+    return jsonify({'message': message}), status, {'Retry-After': str(max(1, math.ceil(retry_after)))}
+
+def get_admission():
+    return current_app.extensions.get('admission')
+
+def init_app(app):
+    """Install admission control in front of every view (unless ADMISSION_CONTROL is off).
+
+    Registered before the other request hooks, so a shed request costs no
+    database work at all.
+    """
+    if not app.config['ADMISSION_CONTROL']:
+        return
+    admission = AdmissionControl(
+        app.config['ADMISSION_CONCURRENCY'],
+        app.config['ADMISSION_RATE'],
+        app.config['ADMISSION_QUEUE_BUDGET'],
+        app.config['ADMISSION_ROUTE_CLASSES'],
+        app.config['ADMISSION_CLIENT_HEADER'],
+    )
+    app.extensions['admission'] = admission
+    app.before_request(admission.admit)
+    app.teardown_request(admission.release)
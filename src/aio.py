@@ -0,0 +1,325 @@
+from flask import abort, g, jsonify, request
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+from .api.delta import VERSION_HEADER, changed_tasks_query, check_since, delta_page, delta_result, pruned_query, since_arg, version_query
+from .api.pagination import page_args, page_query, page_result
+from .api.projection import assignees_query, group_assignees, needs_assignees, select_tasks, serialize_tasks
+from .api.tasks import filtered_tasks, sort_arg
+from .changes import astream, stream_args
+from .config import async_database_uri, async_engine_options, async_replica_uris
+from .models import Task, User, assignee_ids_query, cached_users, fill_users, group_assignee_ids, users_query
+from .user_cache import get_user_cache
+
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import sys
+
+# asyncio variants of the read endpoints. Each builds its statement with the same
+# helpers as the Flask view (inside a Flask request context, so request.args,
+# abort() and jsonify() behave the same), awaits it on an AsyncSession and
+# serializes the same columns, so the JSON is byte for byte what the view returns.
+# Tasks are read as column projections with their assignees in one more query:
+# an AsyncSession cannot lazy load, and the assignee collections cannot be eager loaded.
+
+async def assignees_by_task(session, task_ids: list):
+    """projection.assignees_by_task on `session`: the user records from the shared user cache when it is on"""
+    if get_user_cache() is None:
+        return group_assignees(await session.execute(assignees_query(task_ids)))
+    pairs = (await session.execute(assignee_ids_query(task_ids))).all()
+    found, missing, generation = cached_users(user_id for _, user_id in pairs)
+    if missing:
+        fill_users(found, await session.execute(users_query(missing)), generation)
+    return group_assignee_ids(pairs, found)
+
+async def serialize_task_rows(session, rows):
+    """serialize_tasks(rows), reading the assignees on `session` when the rows do not carry them"""
+    assigned = None
+    if needs_assignees(rows):
+        assigned = await assignees_by_task(session, [row.id for row in rows])
+    return serialize_tasks(rows, assigned)
+
+async def task_delta(session, stmt, since: int, limit: int):
+    check_since(since, await session.scalar(pruned_query()))
+    version = await session.scalar(version_query())
+    rows = (await session.execute(changed_tasks_query(since, version, limit))).all()
+    ids, version, more = delta_page(rows, limit, version)
+    tasks = (await session.execute(stmt.where(Task.id.in_(ids)).order_by(Task.id))).all() if ids else []
+    return delta_result(ids, await serialize_task_rows(session, tasks), version, more)
+
+async def task_index(session):
+    limit, after = page_args()
+    since = since_arg()
+    stmt = filtered_tasks(select_tasks())
+    if since is not None:
+        if after is not None:
+            abort(400, "since cannot be combined with after; page a delta by passing its version as since")
+        return jsonify(await task_delta(session, stmt, since, limit))
+    column, descending = sort_arg()
+    version = await session.scalar(version_query())
+    rows = (await session.execute(page_query(stmt, column, limit, after, Task.id, descending))).all()
+    tasks, next_cursor = page_result(rows, column, limit, Task.id)
+    return jsonify({'tasks': await serialize_task_rows(session, tasks), 'next_cursor': next_cursor}), {VERSION_HEADER: str(version)}
+
+async def user_index(session):
+    limit, after = page_args()
+    rows = (await session.scalars(page_query(select(User), User.id, limit, after))).all()
+    users, next_cursor = page_result(rows, User.id, limit)
+    return jsonify({'users': [u.serialize() for u in users], 'next_cursor': next_cursor})
+
+async def task_changes(flask_app, scope, receive, send):
+    """GET /tasks/changes as a coroutine, so idle subscribers cost no thread"""
+    feed = flask_app.extensions['change_feed']
+    after_id, timeout = stream_args()
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no'),
+    ]})
+
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    watcher = asyncio.ensure_future(disconnected())
+    chunks = astream(feed, after_id, timeout)
+    try:
+        while True:
+            chunk = asyncio.ensure_future(chunks.__anext__())
+            await asyncio.wait({chunk, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not chunk.done():  # the client went away while the stream was idle
+                chunk.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await chunk
+                return
+            try:
+                body = chunk.result().encode('utf-8')
+            except StopAsyncIteration:
+                break
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        await chunks.aclose()
+
+# Flask endpoint -> async view; these GETs are answered without the WSGI app. The views
+# behind the response cache (@cached: ETags, 304s, shared invalidation) are not here,
+# so they go to the fallback and behave exactly as under wsgi.py.
+VIEWS = {
+    'tasks.index': task_index,
+    'users.index': user_index,
+}
+
+# Flask endpoint -> async streaming view, which sends its own response
+STREAMS = {
+    'tasks.changes': task_changes,
+}
+
+class AsyncReadApp:
+    """ASGI app answering the read endpoints in VIEWS on an async engine.
+
+    A request waiting on the database costs a suspended coroutine, not a
+    worker thread, so one process can hold many slow clients at once.
+    GET /tasks/changes streams from STREAMS the same way, so an idle
+    subscriber is a suspended coroutine too. Every other request goes to `fallback` (an ASGI app, e.g. the Flask app
+    wrapped by create_asgi_app) or gets a 404.
+    """
+
+    def __init__(self, flask_app, fallback=None):
+        self.flask_app = flask_app
+        self.fallback = fallback
+        uri = async_database_uri(flask_app.config, flask_app.instance_path)
+        self.engine = create_async_engine(uri, **async_engine_options(flask_app.config, uri))
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+        # replica bind key -> engine, routed to by the app's ReplicaRouter as the Flask views are
+        self.replica_engines = {
+            key: create_async_engine(uri, **async_engine_options(flask_app.config, uri))
+            for key, uri in async_replica_uris(flask_app.config, flask_app.instance_path).items()
+        }
+        self.replica_sessions = {key: async_sessionmaker(engine, expire_on_commit=False)
+                                 for key, engine in self.replica_engines.items()}
+        self.urls = flask_app.url_map.bind('localhost')
+
+    def _match(self, scope):
+        if scope['type'] != 'http' or scope['method'] not in ('GET', 'HEAD'):
+            return None, None
+        try:
+            return self.urls.match(scope['path'], method='GET')
+        except (HTTPException, RequestRedirect):
+            return None, None
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispose(self):
+        for engine in (self.engine, *self.replica_engines.values()):
+            await engine.dispose()
+
+    async def _session_factory(self):
+        """The sessions of the replica the ReplicaRouter picks for this request, or of the primary"""
+        router = self.flask_app.extensions.get('replicas')
+        key = None
+        if router is not None and router.may_use_replica():
+            from .models import db
+            if router.checks_due():  # a health check connects synchronously; keep it off the event loop's thread
+                key = await asyncio.to_thread(router.choose, db.engines)
+            else:
+                key = router.choose(db.engines)
+            router.count(key)
+        elif router is not None:
+            router.count()
+        g.read_replica = key  # as the Flask views set it, so replica_lag_allowance() applies (e.g. to the user cache)
+        return self.replica_sessions[key] if key is not None else self.sessions
+
+    def _request_context(self, scope):
+        headers = [(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope.get('headers', [])]
+        return self.flask_app.test_request_context(scope['path'], method=scope['method'],
+                                                   query_string=scope.get('query_string', b'').decode('latin-1'), headers=headers,
+                                                   environ_base={'REMOTE_ADDR': (scope.get('client') or ('', 0))[0]})
+
+    async def _render(self, scope, view, view_args):
+        admission = self.flask_app.extensions.get('admission')
+        with self._request_context(scope):
+            refusal = await admission.admit_async() if admission is not None else None
+            try:
+                if refusal is not None:  # shed or throttled by the same limits as the Flask views
+                    response = self.flask_app.make_response(refusal)
+                else:
+                    async with (await self._session_factory())() as session:
+                        response = self.flask_app.make_response(await view(session, **view_args))
+            except HTTPException as e:
+                response = e.get_response(request.environ)
+            finally:
+                if admission is not None:
+                    admission.release()
+            body = b'' if scope['method'] == 'HEAD' else response.get_data()
+            return response.status_code, response.get_wsgi_headers(request.environ), body
+
+    async def _stream(self, scope, receive, send, view):
+        with self._request_context(scope):
+            try:
+                return await view(self.flask_app, scope, receive, send)
+            except HTTPException as e:  # raised before the response started, e.g. a malformed Last-Event-ID
+                response = e.get_response(request.environ)
+                headers = response.get_wsgi_headers(request.environ)
+                await self._send(send, response.status_code, headers, response.get_data())
+
+    async def _send(self, send, status: int, headers, body: bytes):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers.items()],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+
+        endpoint, view_args = self._match(scope)
+        if endpoint in STREAMS and scope['method'] == 'GET':
+            return await self._stream(scope, receive, send, STREAMS[endpoint])
+        view = VIEWS.get(endpoint)
+        if view is None:
+            if self.fallback is not None:
+                return await self.fallback(scope, receive, send)
+            view, view_args = _not_found, {}
+
+        status, headers, body = await self._render(scope, view, view_args)
+        await self._send(send, status, headers, body)
+
+async def _not_found(session):
+    abort(404)
+
+class WsgiFallback:
+    """Run a WSGI app for ASGI requests on a thread pool, streaming its response (e.g. the NDJSON exports)"""
+
+    def __init__(self, wsgi_app, threads: int = 8):
+        self.wsgi_app = wsgi_app
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+
+    def _environ(self, scope, body: bytes):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1] or 80),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = f'HTTP_{name}'
+                environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    def _run(self, environ, send, loop):
+        """Run the WSGI app on a pool thread, sending each chunk of its body as it is produced"""
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'], started['headers'] = status, headers
+
+        def forward(message):  # wait for each send, so a slow client holds back the app instead of filling memory
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def start():
+            forward({
+                'type': 'http.response.start',
+                'status': int(started.pop('status').split(' ', 1)[0]),
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in started['headers']],
+            })
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    if 'status' in started:  # start_response may be called as late as the first chunk
+                        start()
+                    forward({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if 'status' in started:
+                start()
+            forward({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    async def __call__(self, scope, receive, send):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._run, self._environ(scope, body), send, loop)
+
+def create_asgi_app(flask_app=None):
+    """The async read endpoints, falling back to the whole Flask app (on ASGI_WSGI_THREADS threads) for the rest"""
+    if flask_app is None:
+        from . import create_app
+        flask_app = create_app()
+    return AsyncReadApp(flask_app, fallback=WsgiFallback(flask_app, flask_app.config['ASGI_WSGI_THREADS']))
@@ -0,0 +1,70 @@
+from flask import abort
+from sqlalchemy import and_, exists, func, or_, select
+from ..changes import PRUNED, settled_id_query
+from ..models import Task, assignees_table, db, rollup_watermarks, task_events
+from .projection import serialize_tasks
+from .validation import int_arg
+
+# Delta sync (?since=) for GET /tasks and GET /users/<id>/tasks_assigned. task_events
+# ids are the change version: the version only moves past ids that can no longer
+# commit (see src/changes.py), and the delete and unassign events are the tombstones. A delta is read from the events past `since`
+# through their primary key, so it costs as much as the changes do, not the table.
+
+VERSION_HEADER = 'X-Change-Version'  # on full listings: the version to pass as ?since= next time
+
+def version_query():
+    return settled_id_query()
+
+def pruned_query():
+    return select(rollup_watermarks.c.last_id).where(rollup_watermarks.c.name == PRUNED)
+
+def since_arg():
+    """Optional ?since= version"""
+    since = int_arg('since')
+    if since is not None and since < 0:
+        return abort(400, "since must be a version returned by the API")
+    return since
+
+def check_since(since: int, pruned):
+    """410 once the events after `since` have been pruned"""
+    if pruned is not None and since < pruned:
+        return abort(410, "since is older than the kept change history; reload without since")
+
+def changed_tasks_query(since: int, version: int, limit: int, user_id: int = None):
+    """(task_id, version) of tasks with events in (since, version], least recently changed first, one more than `limit`.
+
+    With `user_id`, only changes that matter to that user's task list: its
+    assignments, and updates to tasks assigned to it. Deletes are always
+    included, since the assignment is gone by the time they are read.
+    """
+    latest = func.max(task_events.c.id).label('version')
+    stmt = select(task_events.c.task_id, latest).where(task_events.c.id > since, task_events.c.id <= version)
+    if user_id is not None:
+        assigned = exists().where(assignees_table.c.task_id == task_events.c.task_id, assignees_table.c.user_id == user_id)
+        stmt = stmt.where(or_(
+            task_events.c.user_id == user_id,
+            and_(task_events.c.user_id.is_(None), or_(task_events.c.kind == 'delete', assigned)),
+        ))
+    return stmt.group_by(task_events.c.task_id).order_by(latest, task_events.c.task_id).limit(limit + 1)
+
+def delta_page(rows: list, limit: int, version: int):
+    """(changed task ids, version to resume from, whether more changes follow) for rows of changed_tasks_query"""
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if more:
+        version = rows[-1].version
+    return [row.task_id for row in rows], version, more
+
+def delta_result(ids: list, tasks: list, version: int, more: bool):
+    """Changed tasks still in the list, and `removed` tombstones for the changed ids that are not"""
+    present = {t['task_id'] for t in tasks}
+    return {'tasks': tasks, 'removed': [i for i in ids if i not in present], 'version': version, 'more': more}
+
+def task_delta(query, since: int, limit: int, user_id: int = None):
+    """Delta of the tasks matched by `query` (a select_tasks() statement) after version `since`"""
+    check_since(since, db.session.scalar(pruned_query()))
+    version = db.session.scalar(version_query())
+    rows = db.session.execute(changed_tasks_query(since, version, limit, user_id)).all()
+    ids, version, more = delta_page(rows, limit, version)
+    tasks = serialize_tasks(db.session.execute(query.where(Task.id.in_(ids)).order_by(Task.id)).all()) if ids else []
+    return delta_result(ids, tasks, version, more)
@@ -0,0 +1,19 @@
+from flask import Response, current_app, stream_with_context
+from ..models import db
+
+EXPORT_BATCH_SIZE = 1000
+
+def ndjson_response(stmt, serialize_rows, batch_size: int = EXPORT_BATCH_SIZE):
+    """Stream the rows selected by `stmt`, turned into dicts a batch at a time by
+    `serialize_rows`, as newline-delimited JSON.
+
+    Rows are fetched `batch_size` at a time (a server-side cursor on Postgres,
+    incremental fetches on SQLite), so worker memory stays flat however many
+    rows the table holds.
+    """
+    def generate():
+        result = db.session.execute(stmt.execution_options(yield_per=batch_size))
+        for batch in result.partitions():
+            yield ''.join(current_app.json.dumps(obj) + '\n' for obj in serialize_rows(batch))
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
@@ -0,0 +1,16 @@
+from flask import Blueprint, abort, jsonify, url_for
+from ..jobs import job_status
+
+bp = Blueprint('jobs', __name__, url_prefix='/jobs')
+
+def accepted(job_id: int):
+    """202 response for work queued as job `job_id`, pointing at its status"""
+    location = url_for('jobs.show', id=job_id)
+    return jsonify({'job_id': job_id, 'status_url': location}), 202, {'Location': location}
+
+@bp.route('/<int:id>', methods=['GET'])  # status and progress of a background job
+def show(id: int):
+    job = job_status(id)
+    if job is None:
+        return abort(404, "Job not found")
+    return jsonify(job)
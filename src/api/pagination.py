@@ -0,0 +1,121 @@
+from flask import abort, request
+from sqlalchemy import and_, or_
+from sqlalchemy.sql import Select
+from ..models import db
+
+import base64
+import datetime
+import json
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+def encode_cursor(values: list):
+    """Encode the sort key of the last row of a page as an opaque cursor"""
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str):
+    """Decode a cursor produced by encode_cursor, aborting with 400 if it is malformed"""
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, UnicodeError):
+        return abort(400, "Invalid cursor")
+    if not isinstance(values, list):
+        return abort(400, "Invalid cursor")
+    return values
+
+def page_args():
+    """Read the limit/after query parameters shared by the list endpoints"""
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        return abort(400, "limit must be an integer")
+    if limit < 1 or limit > MAX_LIMIT:
+        return abort(400, f"limit must be between 1 and {MAX_LIMIT}")
+
+    after = request.args.get('after')
+    if after is not None:
+        after = decode_cursor(after)
+    return limit, after
+
+def _cursor_value(column, value):
+    """Turn a JSON cursor value back into the column's Python type (e.g. an ISO string into a date)"""
+    if value is None:
+        return None
+    try:
+        python_type = column.type.python_type
+        if python_type is datetime.date and isinstance(value, str):
+            return datetime.date.fromisoformat(value)
+        if python_type is datetime.datetime and isinstance(value, str):
+            return datetime.datetime.fromisoformat(value)
+        return python_type(value)
+    except (TypeError, ValueError):
+        return abort(400, "Invalid cursor")
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, (datetime.date, datetime.datetime)) else value
+
+def _after(column, id_column, value, last_id, descending: bool):
+    """Rows strictly after (value, last_id) in the order built by _order_by, NULLs included"""
+    if not descending:  # ascending, NULLs last
+        if value is None:
+            return and_(column.is_(None), id_column > last_id)
+        return or_(column > value, and_(column == value, id_column > last_id), column.is_(None))
+    # descending, NULLs first
+    if value is None:
+        return or_(column.isnot(None), and_(column.is_(None), id_column < last_id))
+    return or_(column < value, and_(column == value, id_column < last_id))
+
+def _order_by(column, id_column, descending: bool):
+    if descending:
+        return column.desc().nulls_first(), id_column.desc()
+    return column.asc().nulls_last(), id_column.asc()
+
+def page_query(query, column, limit: int, after, id_column=None, descending: bool = False):
+    """Narrow a Query or select() to the page after the cursor, in order, with one row more than `limit`"""
+    composite = id_column is not None and column is not id_column
+    if after is not None:
+        if len(after) != (2 if composite else 1):
+            return abort(400, "Invalid cursor")
+        if composite:
+            query = query.filter(_after(column, id_column, _cursor_value(column, after[0]),
+                                        _cursor_value(id_column, after[1]), descending))
+        else:
+            value = _cursor_value(column, after[0])
+            if value is None:
+                return abort(400, "Invalid cursor")
+            query = query.filter(column < value if descending else column > value)
+
+    if composite:
+        query = query.order_by(*_order_by(column, id_column, descending))
+    else:
+        query = query.order_by(column.desc() if descending else column)
+    return query.limit(limit + 1)
+
+def page_result(rows: list, column, limit: int, id_column=None):
+    """Trim the rows of a page_query to `limit` and build the cursor of the page that follows, if any"""
+    composite = id_column is not None and column is not id_column
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        values = [getattr(last, column.key)]
+        if composite:
+            values.append(getattr(last, id_column.key))
+        next_cursor = encode_cursor([_json_value(v) for v in values])
+    return rows, next_cursor
+
+def paginate(query, column, limit: int, after, id_column=None, descending: bool = False):
+    """Return one page of `query` ordered by `column` (keyset pagination) plus the next cursor.
+
+    When `column` is not unique, pass the primary key as `id_column`: rows are
+    then ordered by (column, id) and the cursor holds both values. One extra
+    row is fetched to find out whether another page follows, so the database
+    never has to count or skip over the rows before the cursor. A select()
+    is executed on the session and its rows returned as they are.
+    """
+    query = page_query(query, column, limit, after, id_column, descending)
+    rows = db.session.execute(query).all() if isinstance(query, Select) else query.all()
+    return page_result(rows, column, limit, id_column)
@@ -0,0 +1,92 @@
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from ..models import Task, User, assigned_user_dicts, assignees_table, db
+from ..user_cache import get_user_cache
+
+# Column-only versions of Task.serialize() and User.serialize() for the list endpoints.
+# Rows come back as plain tuples, so there are no ORM objects to build, track in the
+# identity map or lazy load from; the dicts have the same keys and values, so the
+# JSON jsonify() makes of them is byte for byte the same.
+
+TASK_COLUMNS = (Task.id, Task.title, Task.description, Task.deadline, Task.status, Task.created_by_user)
+USER_COLUMNS = (User.id, User.username, User.email)
+
+def _is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+def select_users():
+    return select(*USER_COLUMNS)
+
+def assigned_users_column(task_id):
+    """Postgres only: the assignees of the task `task_id` refers to, as a JSON array of user dicts ordered by id"""
+    user = func.json_build_object('email', User.email, 'user_id', User.id, 'username', User.username)
+    return (
+        select(func.coalesce(func.json_agg(aggregate_order_by(user, User.id)), literal_column("'[]'::json")))
+        .select_from(assignees_table.join(User, User.id == assignees_table.c.user_id))
+        .where(assignees_table.c.task_id == task_id)
+        .scalar_subquery()
+        .label('assigned_users')
+    )
+
+def select_tasks():
+    """select() of the task columns; on Postgres each row also carries its assignees as a JSON array.
+
+    Not with the shared user cache on: then the assignees' user records come from it.
+    """
+    stmt = select(*TASK_COLUMNS)
+    if _is_postgres() and get_user_cache() is None:
+        stmt = stmt.add_columns(assigned_users_column(Task.id))
+    return stmt
+
+def user_dict(row):
+    return {'user_id': row.id, 'username': row.username, 'email': row.email}
+
+def serialize_users(rows):
+    return [user_dict(row) for row in rows]
+
+def assignees_query(task_ids: list):
+    """(task_id, user columns) of the assignees of the given tasks, in one grouped join"""
+    return (
+        select(assignees_table.c.task_id, *USER_COLUMNS)
+        .join(User, User.id == assignees_table.c.user_id)
+        .where(assignees_table.c.task_id.in_(task_ids))
+        .order_by(assignees_table.c.task_id, User.id)
+    )
+
+def group_assignees(rows):
+    """{task_id: [user dicts ordered by id]} for rows of assignees_query"""
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row.task_id, []).append(user_dict(row))
+    return grouped
+
+def assignees_by_task(task_ids: list):
+    """{task_id: [user dicts ordered by id]} for the given tasks"""
+    if not task_ids:
+        return {}
+    if get_user_cache() is not None:
+        return assigned_user_dicts(task_ids)
+    return group_assignees(db.session.execute(assignees_query(task_ids)))
+
+def needs_assignees(rows):
+    """Whether rows of select_tasks() still need assignees_by_task (they carry them on Postgres)"""
+    return bool(rows) and 'assigned_users' not in rows[0]._fields
+
+def serialize_tasks(rows, assigned: dict = None):
+    """Task dicts for rows of select_tasks(); assignees come from the row (Postgres), `assigned` or one extra query"""
+    if rows and not needs_assignees(rows):
+        assigned = {row.id: row.assigned_users for row in rows}
+    elif assigned is None:
+        assigned = assignees_by_task([row.id for row in rows])
+    return [
+        {
+            'task_id': row.id,
+            'title': row.title,
+            'description': row.description,
+            'deadline': row.deadline,
+            'status': row.status,
+            'created_by_user': row.created_by_user,
+            'assigned_users': assigned.get(row.id, []),
+        }
+        for row in rows
+    ]
@@ -0,0 +1,40 @@
+from flask import Blueprint, jsonify
+from ..admission import get_admission
+from ..cache import get_cache
+from ..models import task_log_writer
+from ..replicas import get_router
+from ..user_cache import get_user_cache
+
+bp = Blueprint('stats', __name__, url_prefix='/stats')
+
+@bp.route('/cache', methods=['GET'])  # response cache hit/miss/eviction counters for this worker
+def cache():
+    return jsonify(get_cache().stats())
+
+@bp.route('/user_cache', methods=['GET'])  # shared user-record cache: size, memory and this worker's hit rate
+def user_cache():
+    cache = get_user_cache()
+    if cache is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(cache.stats(), enabled=True))
+
+@bp.route('/task_logs', methods=['GET'])  # app-side task_logs writer counters for this worker
+def task_logs():
+    writer = task_log_writer()
+    if writer is None:
+        return jsonify({'mode': 'trigger'})
+    return jsonify(dict(writer.stats(), mode='app'))
+
+@bp.route('/admission', methods=['GET'])  # admitted/shed/throttled counters and current load per route class for this worker
+def admission():
+    control = get_admission()
+    if control is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, 'classes': control.stats()})
+
+@bp.route('/replicas', methods=['GET'])  # reads served by the primary and each replica, and replica health, for this worker
+def replicas():
+    router = get_router()
+    if router is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(router.stats(), enabled=True))
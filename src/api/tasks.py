@@ -1,23 +1,204 @@
-from flask import Blueprint, jsonify, abort, request
+from flask import Blueprint, Response, jsonify, abort, request, stream_with_context
 from datetime import datetime
-from ..models import Task, User, db
+from sqlalchemy import and_, case, exists, func, or_, select
+from sqlalchemy.exc import SQLAlchemyError
+from ..cache import cached, invalidate, tag_response, versioned_json
+from ..changes import change_feed, record_change, stream, stream_args
+from ..jobs import run_or_enqueue
+from ..rollups import COMPLETED, duration_stats, refresh_if_stale, task_timeline
+from ..search import search_task_ids, snippets
+from ..models import Task, User, assignees_table, db, task_status_durations, assign_users_to_task, unassign_users_from_task, log_status_change, task_log_writer
+from .delta import VERSION_HEADER, since_arg, task_delta, version_query
+from .export import ndjson_response
+from .jobs import accepted
+from .pagination import encode_cursor, page_args, paginate
+from .projection import TASK_COLUMNS, assigned_users_column, select_tasks, serialize_tasks
+from .updates import update_one
+from .validation import date_arg, date_field, id_list, int_arg, list_arg, str_field, version_if_match
 
 import traceback
 
 bp = Blueprint('tasks', __name__, url_prefix='/tasks')
 
-@bp.route('', methods=['GET'])  # GETs all tasks
+# cache tag of /tasks/summary, dropped by every write that can change a count
+SUMMARY_TAG = ('tasks', 'summary')
+
+# ?sort= values; a leading '-' sorts descending. Ties (and NULL deadlines/statuses, which sort last) are ordered by id.
+SORT_COLUMNS = {
+    'id': Task.id,
+    'title': Task.title,
+    'deadline': Task.deadline,
+    'status': Task.status,
+}
+
+def filtered_tasks(query=None):
+    """Task query (or the given select(Task)) narrowed by the status, deadline range, creator and assignee query parameters"""
+    query = Task.query if query is None else query
+
+    statuses = list_arg('status')
+    if statuses:
+        query = query.filter(Task.status.in_(statuses))
+
+    deadline_from = date_arg('deadline_from')
+    if deadline_from is not None:
+        query = query.filter(Task.deadline >= deadline_from)
+
+    deadline_to = date_arg('deadline_to')
+    if deadline_to is not None:
+        query = query.filter(Task.deadline <= deadline_to)
+
+    created_by_user = int_arg('created_by_user')
+    if created_by_user is not None:
+        query = query.filter(Task.created_by_user == created_by_user)
+
+    assignee = int_arg('assignee')
+    if assignee is not None:
+        query = query.filter(exists().where(
+            assignees_table.c.user_id == assignee, assignees_table.c.task_id == Task.id
+        ).correlate(Task))  # only tasks, so it also works on queries already joined to the assignees
+
+    return query
+
+def sort_arg():
+    """Parse ?sort= into (column, descending)"""
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    column = SORT_COLUMNS.get(sort.lstrip('-'))
+    if column is None:
+        return abort(400, f"sort must be one of {', '.join(SORT_COLUMNS)} (prefix with - for descending)")
+    return column, descending
+
+@bp.route('', methods=['GET'])  # GETs one page of tasks, filtered and sorted in SQL
 def index():
-    tasks = Task.query.all() 
-    result = []
-    for t in tasks:
-        result.append(t.serialize()) 
-    return jsonify(result)  
+    limit, after = page_args()
+    since = since_arg()
+    if since is not None:  # only what changed after that version, with tombstones for the rest
+        if after is not None:
+            return abort(400, "since cannot be combined with after; page a delta by passing its version as since")
+        return jsonify(task_delta(filtered_tasks(select_tasks()), since, limit))
+    column, descending = sort_arg()
+
+    # plain column rows, not Task objects; assignees for the whole page come in one grouped query.
+    # The change version is read by the same statement, so no change can fall between the two.
+    stmt = filtered_tasks(select_tasks().add_columns(version_query().scalar_subquery().label('change_version')))
+    tasks, next_cursor = paginate(stmt, column, limit, after, id_column=Task.id, descending=descending)
+
+    result = serialize_tasks(tasks)
+    version = tasks[0].change_version if tasks else db.session.scalar(version_query())
+    return jsonify({'tasks': result, 'next_cursor': next_cursor}), {VERSION_HEADER: str(version)}
+
+@bp.route('/export', methods=['GET'])  # streams every task as newline-delimited JSON
+def export():
+    return ndjson_response(select_tasks().order_by(Task.id), serialize_tasks)
+
+@bp.route('/search', methods=['GET'])  # ranked full-text search over title and description
+def search():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return abort(400, "q is required")
+
+    limit, after = page_args()
+    if after is not None and (len(after) != 2 or not all(isinstance(v, (int, float)) for v in after)):
+        return abort(400, "Invalid cursor")
+
+    matches = search_task_ids(q, limit, after)
+    next_cursor = None
+    if len(matches) > limit:
+        matches = matches[:limit]
+        last_id, last_score = matches[-1]
+        next_cursor = encode_cursor([last_score, last_id])
+
+    ids = [task_id for task_id, _ in matches]
+    tasks = {t['task_id']: t for t in serialize_tasks(db.session.execute(select_tasks().where(Task.id.in_(ids))).all())}
+    highlights = snippets(q, ids) if request.args.get('snippet') in ('1', 'true') else None
+
+    results = []
+    for task_id, score in matches:
+        if task_id not in tasks:  # deleted since the match query ran
+            continue
+        result = {'rank': score, 'task': tasks[task_id]}
+        if highlights is not None:
+            result['snippet'] = highlights.get(task_id)
+        results.append(result)
+
+    return jsonify({'results': results, 'next_cursor': next_cursor})
+
+# ?group_by= values for /tasks/stats/durations; periods are calendar months
+DURATION_GROUPS = {
+    'status': task_status_durations.c.status,
+    'period': task_status_durations.c.period,
+    'user': assignees_table.c.user_id,
+}
+
+@bp.route('/stats/durations', methods=['GET'])  # time spent in each status, from the incrementally refreshed rollups
+def status_durations():
+    group_by = list_arg('group_by') or ['status']
+    unknown = [g for g in group_by if g not in DURATION_GROUPS]
+    if unknown or len(set(group_by)) != len(group_by):
+        return abort(400, f"group_by must be a comma-separated list of {', '.join(DURATION_GROUPS)}")
+
+    where = []
+    statuses = list_arg('status')
+    if statuses:
+        where.append(task_status_durations.c.status.in_(statuses))
+    user = int_arg('user')
+    if user is not None:
+        where.append(assignees_table.c.user_id == user)
+    period_from = date_arg('period_from')
+    if period_from is not None:
+        where.append(task_status_durations.c.period >= period_from.replace(day=1))
+    period_to = date_arg('period_to')
+    if period_to is not None:
+        where.append(task_status_durations.c.period <= period_to)
+
+    refresh_if_stale()
+    groups = duration_stats([DURATION_GROUPS[g] for g in group_by], where,
+                            join_assignees='user' in group_by or user is not None)
+    for group in groups:
+        key = group.pop('key')
+        group.update((name, value.isoformat() if name == 'period' else value) for name, value in zip(group_by, key))
+    return jsonify({'group_by': group_by, 'groups': groups})
+
+@bp.route('/changes', methods=['GET'])  # server-sent events for task writes; resumes after Last-Event-ID
+def changes():
+    after_id, timeout = stream_args()
+    # holds a thread while open; asgi.py serves the same stream from a coroutine instead
+    return Response(stream_with_context(stream(change_feed(), after_id, timeout)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def summary_counts(group_column, key: str, today, join_assignees: bool = False):
+    """Tasks, open tasks and overdue open tasks per value of `group_column`, narrowed by the index filters"""
+    is_open = or_(Task.status.is_(None), Task.status != COMPLETED)
+    overdue = and_(is_open, Task.deadline < today)
+    stmt = select(group_column, func.count(), func.count(case((is_open, 1))), func.count(case((overdue, 1))))
+    if join_assignees:
+        stmt = stmt.select_from(Task).join(assignees_table, assignees_table.c.task_id == Task.id)
+    stmt = filtered_tasks(stmt).group_by(group_column).order_by(group_column.asc().nulls_last())
+    return [{key: value, 'tasks': tasks, 'open': open_, 'overdue': late}
+            for value, tasks, open_, late in db.session.execute(stmt)]
+
+@bp.route('/summary', methods=['GET'])  # task counts by status, creator and assignee, with open/overdue counts
+@cached
+def summary():
+    today = datetime.utcnow().date()
+    tag_response(SUMMARY_TAG)
+    by_status = summary_counts(Task.status, 'status', today)
+    totals = {name: sum(group[name] for group in by_status) for name in ('tasks', 'open', 'overdue')}
+    return jsonify({
+        'as_of': today.isoformat(),  # overdue means an open task whose deadline is before this day
+        'total': totals,
+        'by_status': by_status,
+        'by_creator': summary_counts(Task.created_by_user, 'created_by_user', today),
+        'by_assignee': summary_counts(assignees_table.c.user_id, 'user_id', today, join_assignees=True),
+    })
 
 @bp.route('/<int:id>', methods=['GET']) # GETs a task's info after the id is entered
+@cached
 def show(id: int):
     t = Task.query.get_or_404(id, "Task not found")
-    return jsonify(t.serialize())
+    result = t.serialize()
+    tag_response(('task', id), *[('user', u['user_id']) for u in result['assigned_users']])
+    return versioned_json(result, t.version)
 
 @bp.route('', methods=['POST'])
 def create():
@@ -42,9 +223,13 @@ def create():
 
     try:
         db.session.add(t)  # prepare CREATE statement
+        db.session.flush()  # assigns t.id for the change event
+        record_change('create', t.id)
         db.session.commit()  # execute CREATE statement
 
         # Note: Do not assign the task to the user automatically here
+        # Nothing cached can refer to a task that did not exist yet, apart from the counts
+        invalidate(SUMMARY_TAG)
 
         return jsonify(t.serialize()), 201
     except Exception as e:
@@ -52,39 +237,58 @@ def create():
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
-@bp.route('/<int:id>', methods=['PATCH', 'PUT'])
-def update(id: int):
-    t = Task.query.get_or_404(id)
-
-    if 'title' not in request.json: # checks to make sure the title exists first
+def task_values(payload):
+    """The columns a PATCH/PUT body sets, validated and coerced before anything is written"""
+    if not isinstance(payload, dict) or 'title' not in payload:  # the title is required
         return abort(400)
-    
-    if 'title' in request.json:
-        t.title = request.json['title'] # updates title
+    values = {'title': str_field(payload, 'title', 256, nullable=False)}
+    if 'description' in payload:
+        values['description'] = str_field(payload, 'description')
+    if 'deadline' in payload:
+        values['deadline'] = date_field(payload, 'deadline')
+    if 'status' in payload:
+        values['status'] = str_field(payload, 'status', 50)
+    return values
 
-    if 'description' in request.json:
-        t.description = request.json['description'] # updates description
-
-    if 'deadline' in request.json:
-        t.deadline = request.json['deadline'] # updates deadline
+@bp.route('/<int:id>', methods=['PATCH', 'PUT'])  # one UPDATE ... RETURNING; If-Match makes it conditional
+def update(id: int):
+    values = task_values(request.json)
+    versions = version_if_match()
+    log_status = 'status' in values and task_log_writer() is not None  # triggers log it otherwise
+    postgres = db.engine.dialect.name == 'postgresql'
 
-    if 'status' in request.json:
-        t.status = request.json['status'] # updates status
+    def with_old_status_and_assignees(updated):
+        old = select(Task.id, Task.status).where(Task.id == id).with_for_update().cte('old')
+        return (select(updated, old.c.status.label('old_status'), assigned_users_column(updated.c.id))
+                .select_from(updated.join(old, old.c.id == updated.c.id)))
 
     try:
+        old_status = db.session.scalar(select(Task.status).where(Task.id == id)) if log_status and not postgres else None
+        row = update_one(Task, id, values, versions, [*TASK_COLUMNS, Task.version], wrap=with_old_status_and_assignees)
+        if log_status and row.status != (row.old_status if postgres else old_status):
+            log_status_change(id, row.status)
+        record_change('update', id)
+        result = serialize_tasks([row])[0]
         db.session.commit()  # save updates to the database
-        return jsonify(t.serialize()), 200  # Return 200 OK
-    except Exception as e:
+    except SQLAlchemyError as e:
+        db.session.rollback()
         # Return error message in JSON format along with 500 status code
         return jsonify({'error': str(e)}), 500  # 500 Internal Server Error
 
-@bp.route('/<int:id>', methods=['DELETE']) 
+    invalidate(('task', id), SUMMARY_TAG)
+    return versioned_json(result, row.version)  # Return 200 OK
+
+@bp.route('/<int:id>', methods=['DELETE'])  # large cascades are queued: 202 with the job's status URL
 def delete(id: int):
-    t = Task.query.get_or_404(id, "Task not found")
+    Task.query.get_or_404(id, "Task not found")
 
     try:
-        db.session.delete(t)  # prepare DELETE statement
-        db.session.commit()  # execute DELETE statement
+        # the task with its task_logs and assignments, here if that is only a few rows
+        job_id, _ = run_or_enqueue('delete_task', {'task_id': id}, f'delete_task:{id}')
+        db.session.commit()  # execute DELETE statements, or queue the job
+        if job_id is not None:
+            return accepted(job_id)
+        invalidate(('task', id), SUMMARY_TAG)
         return jsonify(True)
     except Exception as e:
         # Handle any exceptions, e.g., rollback changes
@@ -97,28 +301,59 @@ def assign_task(id: int, user_id: int):
     t = Task.query.get_or_404(id, "Task not found")
     u = User.query.get_or_404(user_id, "User not found")
 
-    # Call the assign_user method
-    if not t.assign_user(u):
-        return jsonify({'message': 'Task already assigned to the user'}), 400
-
     try:
+        # one keyed INSERT that skips an existing pair, so a concurrent duplicate cannot fail the request
+        if not t.assign_user(u):
+            return jsonify({'message': 'Task already assigned to the user'}), 400
+        record_change('assign', id, (user_id,))
         db.session.commit()  # Save changes to the database
-        return jsonify({'message': 'Task assigned successfully'}), 200
-    except Exception as e:
+    except SQLAlchemyError as e:
         db.session.rollback()  # Rollback changes if an exception occurs
         return jsonify({'message': f'Error assigning task: {str(e)}'}), 500
 
+    invalidate(('task', id), ('user_tasks', user_id), SUMMARY_TAG)
+    return jsonify({'message': 'Task assigned successfully'}), 200
+
+@bp.route('/<int:id>/assignees', methods=['POST', 'DELETE'])  # assigns/unassigns a list of users in one transaction
+def bulk_assignees(id: int):
+    user_ids = id_list(request.json, 'user_ids')
+    Task.query.get_or_404(id, "Task not found")
+
+    change = assign_users_to_task if request.method == 'POST' else unassign_users_from_task
+
+    try:
+        results = change(id, user_ids)
+        changed = [i for i, r in results.items() if r in ('assigned', 'unassigned')]
+        if changed:
+            record_change('assign' if request.method == 'POST' else 'unassign', id, changed)
+        db.session.commit()  # one commit for the whole list
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Error updating task assignees: {str(e)}'}), 500
+
+    if changed:
+        invalidate(('task', id), SUMMARY_TAG, *[('user_tasks', i) for i in changed])
+
+    return jsonify({'results': [{'user_id': i, 'result': r} for i, r in results.items()]}), 200
+
+@bp.route('/<int:id>/timeline', methods=['GET'])  # status history, time in each status and a completion estimate
+def timeline(id: int):
+    Task.query.get_or_404(id, "Task not found")
+    refresh_if_stale()  # the estimate draws on the rollups of completed tasks
+    return jsonify(task_timeline(id, datetime.utcnow()))
+
 @bp.route('/<int:id>/users_assigned_task', methods=['GET']) 
+@cached
 def users_assigned_task(id: int):
     t = Task.query.get_or_404(id)
 
+    result = t.users_assigned_task  # the user records come from the shared user cache when it is on
+    tag_response(('task', id), *[('user', u['user_id']) for u in result])
+
     # Check if there are users assigned
-    if not t.assignees:
+    if not result:
         return jsonify({'message': 'No users currently assigned to task.'})
 
-    # Use list comprehension to serialize assigned users
-    result = [user.serialize() for user in t.assignees]
-
     return jsonify(result)
 
 @bp.route('/<int:id>/unassign_user/<int:user_id>', methods=['PATCH','PUT'])
@@ -126,16 +361,15 @@ def unassign_user(id: int, user_id: int):
     t = Task.query.get_or_404(id, "Task not found")
     u = User.query.get_or_404(user_id, "User not found")
 
-    # Check if the user is assigned to the task
-    if u not in t.assignees:
-        return jsonify({'message': 'User is not assigned to the task'}), 400
-
-    # Remove the user from the assignees list
-    t.assignees.remove(u)
-
     try:
+        # Remove the pair by its key; nothing removed means the user was not assigned
+        if not t.unassign_user(u):
+            return jsonify({'message': 'User is not assigned to the task'}), 400
+        record_change('unassign', id, (user_id,))
         db.session.commit()  # Save changes to the database
-        return jsonify({'message': 'User unassigned successfully'}), 200
-    except Exception as e:
+    except SQLAlchemyError as e:
         db.session.rollback()  # Rollback changes if an exception occurs
-        return jsonify({'message': f'Error unassigning user from task: {str(e)}'}), 500
\ No newline at end of file
+        return jsonify({'message': f'Error unassigning user from task: {str(e)}'}), 500
+
+    invalidate(('task', id), ('user_tasks', user_id), SUMMARY_TAG)
+    return jsonify({'message': 'User unassigned successfully'}), 200
\ No newline at end of file
@@ -0,0 +1,38 @@
+from flask import abort
+from sqlalchemy import select, update
+from ..models import db
+
+# PATCH/PUT as a single UPDATE ... RETURNING: the new version of the row comes back
+# from the statement that writes it, instead of a SELECT before and another after.
+# An If-Match version goes into the WHERE clause (compare-and-set), so concurrent
+# editors never hold row locks; only when no row was updated is it looked up again,
+# to tell a missing record (404) from a stale one (412).
+
+def update_one(model, id: int, values: dict, versions, columns: list, wrap=None):
+    """Apply `values` to the `model` row `id`, bump its version and return `columns` of the result.
+
+    `versions` (from version_if_match) limits the update to those versions.
+    On Postgres, `wrap` can turn the UPDATE ... RETURNING, given as a CTE,
+    into the SELECT that is executed instead, to fetch more in the same
+    statement. Backends without RETURNING update, then read the row back
+    in the same transaction.
+    """
+    stmt = update(model).where(model.id == id)
+    if versions is not None:
+        stmt = stmt.where(model.version.in_(versions))
+    stmt = stmt.values(**values, version=model.version + 1)
+
+    if wrap is not None and db.engine.dialect.name == 'postgresql':
+        row = db.session.execute(wrap(stmt.returning(*columns).cte('updated'))).first()
+    elif db.engine.dialect.update_returning:
+        row = db.session.execute(stmt.returning(*columns)).first()
+    else:
+        row = None
+        if db.session.execute(stmt).rowcount:
+            row = db.session.execute(select(*columns).where(model.id == id)).first()
+
+    if row is None:
+        if db.session.scalar(select(model.version).where(model.id == id)) is None:
+            return abort(404, f"{model.__name__} not found")
+        return abort(412, f"{model.__name__} was changed since the version in If-Match")
+    return row
@@ -1,28 +1,45 @@
 from flask import Blueprint, jsonify, abort, request
-from ..models import User, db
-
-import hashlib
-import secrets
-
-def scramble(password: str):
-    """Hash and salt the given password"""
-    salt = secrets.token_hex(16)
-    return hashlib.sha512((password + salt).encode('utf-8')).hexdigest()
+from sqlalchemy import exists
+from sqlalchemy.exc import SQLAlchemyError
+from ..cache import cached, get_cache, invalidate, tag_response, versioned_json
+from ..changes import record_change
+from ..jobs import CREATOR_CLEARED, run_or_enqueue
+from ..models import Task, User, assignees_table, db, assign_tasks_to_user, unassign_tasks_from_user
+from .delta import VERSION_HEADER, since_arg, task_delta, version_query
+from .export import ndjson_response
+from .jobs import accepted
+from .pagination import page_args, paginate
+from .projection import USER_COLUMNS, select_tasks, select_users, serialize_tasks, serialize_users, user_dict
+from .updates import update_one
+from .tasks import SUMMARY_TAG
+from .validation import id_list, str_field, version_if_match
+from ..passwords import HashingBusy, hash_password
+from ..user_cache import invalidate_users
 
 bp = Blueprint('users', __name__, url_prefix='/users')
 
+@bp.errorhandler(HashingBusy)
+def hashing_busy(e):
+    # the password hashing pool is saturated; shed the write rather than queue it
+    return jsonify({'message': str(e)}), 503, {'Retry-After': '1'}
+
 @bp.route('', methods=['GET'])  # decorator takes path and list of HTTP verbs
 def index():
-    users = User.query.all()  # ORM performs SELECT query
-    result = []
-    for u in users:
-        result.append(u.serialize())  # build list of Tweets as dictionaries
-    return jsonify(result)  # return JSON response
+    limit, after = page_args()
+    users, next_cursor = paginate(select_users(), User.id, limit, after)  # SELECT id, username, email ... LIMIT
+    result = serialize_users(users)  # build list of Users as dictionaries
+    return jsonify({'users': result, 'next_cursor': next_cursor})  # return JSON response
+
+@bp.route('/export', methods=['GET'])  # streams every user as newline-delimited JSON
+def export():
+    return ndjson_response(select_users().order_by(User.id), serialize_users)
 
 @bp.route('/<int:id>', methods=['GET'])
+@cached
 def show(id: int):
     u = User.query.get_or_404(id, "User not found")
-    return jsonify(u.serialize())
+    tag_response(('user', id))
+    return versioned_json(u.serialize(), u.version)
 
 @bp.route('', methods=['POST'])
 def create():
@@ -34,7 +51,7 @@ def create():
     u = User(
         username=request.json['username'],
         email=request.json['email'],
-        password=scramble(request.json['password'])
+        password=hash_password(request.json['password'])
     )
 
     db.session.add(u)  # prepare CREATE statement
@@ -42,13 +59,38 @@ def create():
 
     return jsonify(u.serialize())
 
-@bp.route('/<int:id>', methods=['DELETE']) 
+@bp.route('/verify', methods=['POST'])  # checks a username and password; 401 if they do not match
+def verify():
+    payload = request.json
+    if not isinstance(payload, dict) or 'username' not in payload or 'password' not in payload:
+        return abort(400)
+    username = str_field(payload, 'username', 128, nullable=False)
+    password = str_field(payload, 'password', nullable=False)
+
+    u = User.query.filter_by(username=username).first()
+    if u is None or not u.check_password(password):
+        return jsonify({'message': 'Invalid username or password'}), 401
+    if db.session.is_modified(u):  # re-hashed with the current algorithm or cost; this bumps its version
+        db.session.commit()
+        invalidate(('user', u.id))
+        invalidate_users(u.id)
+    return jsonify(u.serialize())
+
+@bp.route('/<int:id>', methods=['DELETE'])  # large cascades are queued: 202 with the job's status URL
 def delete(id: int):                        
-    u = User.query.get_or_404(id, "User not found")
+    User.query.get_or_404(id, "User not found")
     
     try:
-        db.session.delete(u)
+        # the user goes with its assignments and leaves its tasks without a creator, here if that is only a few rows
+        job_id, deleted = run_or_enqueue('delete_user', {'user_id': id}, f'delete_user:{id}')
         db.session.commit()
+        if job_id is not None:
+            return accepted(job_id)
+        invalidate_users(id)
+        if deleted.get(CREATOR_CLEARED):
+            get_cache().clear()  # its tasks, now without a creator, are embedded in other users' cached lists too
+        else:
+            invalidate(('user', id), ('user_tasks', id), SUMMARY_TAG)
         return jsonify(True)
     except Exception as e:
         # Handle the exception (e.g., log it)
@@ -58,34 +100,74 @@ def delete(id: int):
 
 @bp.route('/<int:id>', methods=['PATCH', 'PUT']) # updates username, email, or password (no req. for username or pwd)
 def update(id: int):
-    u = User.query.get_or_404(id)
-
-    if 'username' not in request.json and 'password' not in request.json or 'email' not in request.json:
+    payload = request.json
+    if not isinstance(payload, dict) or 'username' not in payload and 'password' not in payload or 'email' not in payload:
         return abort(400)
-    
-    if 'username' in request.json:
-        u.username = request.json['username']
-
-    if 'password' in request.json:
-        u.password = scramble(request.json['password'])
 
-    if 'email' in request.json:
-        u.email = request.json['email']
+    # validate and coerce everything before writing, then write it in one UPDATE ... RETURNING
+    values = {'email': str_field(payload, 'email', 128, nullable=False)}
+    if 'username' in payload:
+        values['username'] = str_field(payload, 'username', 128, nullable=False)
+    if 'password' in payload:
+        values['password'] = hash_password(str_field(payload, 'password', nullable=False))
+    versions = version_if_match()
 
     try:
+        row = update_one(User, id, values, versions, [*USER_COLUMNS, User.version])
         db.session.commit()  # save updates to the database
-        return jsonify(u.serialize())
-    except:
+    except SQLAlchemyError:
         # something went wrong :(
+        db.session.rollback()
         return jsonify(False)
 
+    invalidate(('user', id))
+    invalidate_users(id)
+    return versioned_json(user_dict(row), row.version)
+
 @bp.route('/<int:id>/tasks_assigned', methods=['GET']) 
+@cached
 def tasks_assigned(id: int):
-    u = User.query.get_or_404(id)
-    result = [task.serialize() for task in u.assigned_tasks]
+    since = since_arg()
+    User.query.get_or_404(id)
+    assigned = exists().where(assignees_table.c.task_id == Task.id, assignees_table.c.user_id == id)
+    if since is not None:  # only what changed for this user after that version, with tombstones
+        delta = task_delta(select_tasks().where(assigned), since, page_args()[0], user_id=id)
+        tag_response(('user_tasks', id), *[('task', t['task_id']) for t in delta['tasks']],
+                     *[('user', a['user_id']) for t in delta['tasks'] for a in t['assigned_users']])
+        return jsonify(delta)
+
+    version = db.session.scalar(version_query())  # read first, so the list is at least this new
+    result = serialize_tasks(db.session.execute(select_tasks().where(assigned).order_by(Task.id)).all())  # one query for the tasks, one for their assignees
+
+    # the body embeds every listed task and every one of their assignees
+    tag_response(('user_tasks', id), *[('task', t['task_id']) for t in result],
+                 *[('user', a['user_id']) for t in result for a in t['assigned_users']])
     
     # Check if there are tasks assigned
     if not result:
-        return jsonify({'message': 'No tasks assigned to the user.'}), 200
+        return jsonify({'message': 'No tasks assigned to the user.'}), 200, {VERSION_HEADER: str(version)}
+
+    return jsonify(result), {VERSION_HEADER: str(version)}
+
+@bp.route('/<int:id>/tasks_assigned', methods=['POST', 'DELETE'])  # assigns/unassigns a list of tasks in one transaction
+def bulk_tasks_assigned(id: int):
+    task_ids = id_list(request.json, 'task_ids')
+    User.query.get_or_404(id, "User not found")
+
+    change = assign_tasks_to_user if request.method == 'POST' else unassign_tasks_from_user
+
+    try:
+        results = change(id, task_ids)
+        changed = [i for i, r in results.items() if r in ('assigned', 'unassigned')]
+        for task_id in changed:  # the same events /tasks/<id>/assignees records
+            record_change('assign' if request.method == 'POST' else 'unassign', task_id, (id,))
+        db.session.commit()  # one commit for the whole list
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Error updating assigned tasks: {str(e)}'}), 500
+
+    if changed:
+        invalidate(('user_tasks', id), SUMMARY_TAG, *[('task', i) for i in changed])
+
+    return jsonify({'results': [{'task_id': i, 'result': r} for i, r in results.items()]}), 200
 
-    return jsonify(result)
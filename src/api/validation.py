@@ -0,0 +1,83 @@
+from flask import abort, request
+
+import datetime
+
+MAX_BULK_IDS = 1000
+
+def id_list(payload, key: str):
+    """Return the de-duplicated list of integer ids under `key`, aborting with 400 if it is not one"""
+    if not isinstance(payload, dict) or not isinstance(payload.get(key), list):
+        return abort(400, f"Request body must contain a list of {key}")
+
+    ids = payload[key]
+    if not ids or len(ids) > MAX_BULK_IDS:
+        return abort(400, f"{key} must hold between 1 and {MAX_BULK_IDS} ids")
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        return abort(400, f"{key} must only contain integers")
+
+    return list(dict.fromkeys(ids))  # keep the caller's order, drop repeats
+
+def int_arg(name: str):
+    """Optional integer query parameter; 400 if present but not an integer"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return abort(400, f"{name} must be an integer")
+
+def date_arg(name: str):
+    """Optional YYYY-MM-DD query parameter; 400 if present but not a date"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        return abort(400, f"{name} must be a date in YYYY-MM-DD format")
+
+def list_arg(name: str):
+    """Optional comma-separated query parameter, e.g. ?status=pending,review"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return [item for item in value.split(',') if item]
+
+def str_field(payload: dict, key: str, max_length: int = None, nullable: bool = True):
+    """payload[key] as a string of at most `max_length` characters (or None if `nullable`); 400 otherwise"""
+    value = payload[key]
+    if value is None and nullable:
+        return None
+    if not isinstance(value, str) or (not nullable and not value.strip()):
+        return abort(400, f"{key} must be a{' non-empty' if not nullable else ''} string")
+    if max_length is not None and len(value) > max_length:
+        return abort(400, f"{key} must be at most {max_length} characters")
+    return value
+
+def date_field(payload: dict, key: str):
+    """payload[key] as a date, from YYYY-MM-DD or an ISO 8601 datetime (or None); 400 otherwise"""
+    value = payload[key]
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value).date() if 'T' in value else datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return abort(400, f"{key} must be a date in YYYY-MM-DD format")
+
+def version_if_match():
+    """Versions the If-Match header allows an update to replace (None without the header or with *).
+
+    Entity tags come from cache.versioned_etag, "<version>-<content hash>";
+    only the version is compared, so a change that did not touch the record
+    itself (e.g. an assignment) does not fail the update.
+    """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    versions = []
+    for tag in if_match.as_set():
+        version, _, _ = tag.partition('-')
+        if version.isdigit():
+            versions.append(int(version))
+    return versions
@@ -0,0 +1,180 @@
+from flask import current_app, g, jsonify, request
+from .replicas import replica_lag_allowance
+
+import collections
+import functools
+import hashlib
+import math
+import threading
+import time
+
+KEPT_HEADERS = ('X-Change-Version',)  # response headers stored and replayed with the body
+
+def content_etag(body: bytes):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()  # strong ETag: changes with every byte
+
+def versioned_etag(version: int, body: bytes):
+    """ETag of a record's representation that If-Match on its update endpoint checks (see version_if_match)"""
+    return f'{version}-{content_etag(body)}'
+
+def versioned_json(data, version: int):
+    """jsonify(data) carrying the versioned_etag of record version `version`"""
+    response = jsonify(data)
+    response.set_etag(versioned_etag(version, response.get_data()))
+    return response
+
+class CacheEntry:
+    __slots__ = ('body', 'mimetype', 'headers', 'etag', 'expires', 'tags')
+
+    def __init__(self, body: bytes, mimetype: str, expires: float, tags: frozenset, headers: tuple = (), etag: str = None):
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers
+        self.etag = etag or content_etag(body)
+        self.expires = expires
+        self.tags = tags
+
+class ResponseCache:
+    """Bounded LRU cache of rendered GET responses with a TTL and tag-based invalidation.
+
+    Every entry is tagged with the records its body was built from, e.g.
+    ('task', 3) or ('user', 7), and writes drop exactly the entries carrying
+    the tags they touch. The cache lives in one worker process, so the TTL
+    also bounds how long another worker's writes can go unseen.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 10.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0  # bumped by every invalidation
+        self.invalidated_at = -math.inf  # monotonic time of the last invalidation
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+        self._entries = collections.OrderedDict()  # key -> CacheEntry, least recently used first
+        self._keys_by_tag = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, body: bytes, mimetype: str, tags, generation: int, headers: tuple = (), etag: str = None,
+            replica_lag: float = 0.0):
+        """Store a response rendered while the cache was at `generation`.
+
+        The entry is still returned but not stored if an invalidation ran
+        while it was being rendered, since it may hold pre-write data. The
+        same goes for a body read from a replica that may trail the primary
+        by `replica_lag` seconds, if an invalidation ran within that time.
+        """
+        now = time.monotonic()
+        entry = CacheEntry(body, mimetype, now + self.ttl, frozenset(tags), headers, etag)
+        with self._lock:
+            if self.max_entries <= 0 or generation != self.generation or now - self.invalidated_at < replica_lag:
+                return entry
+            self._remove(key)
+            self._entries[key] = entry
+            for tag in entry.tags:
+                self._keys_by_tag[tag].add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, *tags):
+        with self._lock:
+            self.generation += 1
+            self.invalidated_at = time.monotonic()
+            for tag in tags:
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidated_at = time.monotonic()
+            self._entries.clear()
+            self._keys_by_tag.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry.tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+def init_app(app):
+    app.extensions['response_cache'] = ResponseCache(
+        app.config['RESPONSE_CACHE_MAX_ENTRIES'],
+        app.config['RESPONSE_CACHE_TTL']
+    )
+
+def get_cache():
+    return current_app.extensions['response_cache']
+
+def tag_response(*tags):
+    """Record the (kind, id) tags the response being rendered by a @cached view depends on"""
+    if 'cache_tags' in g:
+        g.cache_tags.update(tags)
+
+def invalidate(*tags):
+    """Drop every cached response tagged with any of `tags`; call after a successful commit"""
+    get_cache().invalidate(*tags)
+
+def cached(view):
+    """Serve a GET view from the response cache and answer If-None-Match with 304.
+
+    Only 200 responses are stored. Cache hits (and so 304s for unchanged
+    resources) never reach the view or the database. The ETag is a hash of
+    the body unless the view set one.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = get_cache()
+        key = request.full_path
+        entry = cache.get(key)
+
+        if entry is None:
+            generation = cache.generation
+            g.cache_tags = set()
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            headers = tuple((name, response.headers[name]) for name in KEPT_HEADERS if name in response.headers)
+            etag, _ = response.get_etag()  # the view's own ETag, if it set one (e.g. versioned_etag)
+            entry = cache.put(key, response.get_data(), response.mimetype, g.cache_tags, generation, headers, etag,
+                              replica_lag_allowance())
+
+        response = current_app.response_class(entry.body, mimetype=entry.mimetype, headers=entry.headers)
+        response.set_etag(entry.etag)
+        response.cache_control.no_cache = True  # clients revalidate with If-None-Match every time
+        return response.make_conditional(request)
+
+    return wrapper
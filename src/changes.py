@@ -0,0 +1,394 @@
+from flask import abort, current_app, has_app_context, request
+from sqlalchemy import delete, event, func, insert, literal, select, text, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from .models import SNAPSHOT_XMAX, db, next_ids, rollup_watermarks, settled, task_events
+
+import asyncio
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import os
+import selectors
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Every task write records its events in task_events, in the same transaction, so a
+# subscriber resuming from an event id (Last-Event-ID) misses nothing that committed.
+# Subscribers read the table by id; the ChangeFeed only tells them when to look, and
+# while any are connected it keeps the newest events in memory so a commit costs one
+# query per process rather than one per subscriber.
+#
+# Readers page through events by id, so they must never pass an id that may still
+# commit: they stop at the newest settled event (see SNAPSHOT_XMAX in models.py).
+
+PENDING_CHANGES = 'pending_task_changes'
+PRUNED = 'task_events_pruned'  # rollup_watermarks row: newest task_events id removed by prune()
+CHANNEL = 'task_changes'  # Postgres NOTIFY channel
+BATCH_SIZE = 500  # events sent per read
+RING_SIZE = 10_000  # newest events kept in memory while anyone is subscribed
+PRUNE_INTERVAL = 600.0  # seconds between prune() calls per process
+RETRY_MS = 2000  # how long EventSource clients wait before reconnecting
+
+KEEPALIVE = ': keepalive\n\n'
+RESET = 'event: reset\ndata: {}\n\n'  # the resume id was pruned; reload with GET /tasks
+
+def record_change(kind: str, task_id: int, user_ids=(None,)):
+    """Add `kind` events for a task (one per user for assign/unassign) to the current transaction"""
+    record_changes([(kind, task_id, user_id) for user_id in user_ids])
+
+def record_changes(events):
+    """Add (kind, task_id, user_id) events to the current transaction"""
+    session = db.session()
+    now = datetime.datetime.utcnow()
+    rows = [{'kind': kind, 'task_id': task_id, 'user_id': user_id, 'created_at': now} for kind, task_id, user_id in events]
+    if not rows:
+        return
+    if db.engine.dialect.name == 'postgresql':
+        # draw the ids first: the INSERT is a new statement, so (in READ COMMITTED) its snapshot, and
+        # with it the horizon, is taken after they were drawn
+        ids = next_ids(session, 'task_events', len(rows))
+        session.execute(insert(task_events).values(horizon=SNAPSHOT_XMAX), [dict(row, id=i) for row, i in zip(rows, ids)])
+    else:
+        session.execute(insert(task_events), rows)
+    _recorded(session)
+
+def record_staged_changes(staged):
+    """Postgres: add the events held in a temporary table of (event_id, kind, task_id, user_id), for bulk loads.
+
+    The events never leave the database, and rows without a kind are skipped.
+    As in record_changes, the ids are drawn by one statement and the horizon
+    is taken by the next.
+    """
+    session = db.session()
+    events = staged.c.kind.is_not(None)
+    session.execute(update(staged).where(events).values(event_id=func.nextval(func.pg_get_serial_sequence('task_events', 'id'))))
+    written = session.execute(insert(task_events).from_select(
+        ['id', 'kind', 'task_id', 'user_id', 'created_at', 'horizon'],
+        select(staged.c.event_id, staged.c.kind, staged.c.task_id, staged.c.user_id,
+               literal(datetime.datetime.utcnow()), SNAPSHOT_XMAX).where(events),
+    )).rowcount
+    if written:
+        _recorded(session)
+
+def _recorded(session):
+    session.info[PENDING_CHANGES] = True
+    feed = change_feed()
+    if feed is not None:
+        feed.emit(session)
+
+def settled_id_query():
+    """The newest event id readers may go up to (0 without any)"""
+    newest = select(task_events.c.id).where(settled(task_events.c.horizon)).order_by(task_events.c.id.desc()).limit(1)
+    return select(func.coalesce(newest.scalar_subquery(), 0))
+
+def _event(row):
+    return {'id': row.id, 'kind': row.kind, 'task_id': row.task_id, 'user_id': row.user_id,
+            'created_at': row.created_at.isoformat()}
+
+def format_event(e: dict):
+    data = json.dumps({'kind': e['kind'], 'task_id': e['task_id'], 'user_id': e['user_id'], 'created_at': e['created_at']},
+                      separators=(',', ':'))
+    return f"id: {e['id']}\nevent: {e['kind']}\ndata: {data}\n\n"
+
+class ChangeFeed:
+    """Wakes this process's /tasks/changes subscribers when task_events are committed.
+
+    While anyone is subscribed, events are fetched into memory once per
+    commit (or per notification) and every subscriber reads them from there;
+    ids older than what is held are read from the table. Only this process's
+    commits wake subscribers at once: other workers' events are picked up
+    when a subscriber's heartbeat times out and polls, unless a subclass
+    delivers them (PostgresChangeFeed).
+    """
+
+    def __init__(self, app, heartbeat: float = 15.0, retention: float = 86400.0):
+        self.app = app
+        self.heartbeat = heartbeat
+        self.retention = retention
+        self.subscribers = 0
+        self.generation = 0  # bumped whenever new events may be readable
+        self._events = collections.deque(maxlen=RING_SIZE)
+        self._last_id = None  # newest id fetched; None while nobody is subscribed
+        self._floor = None  # _events holds every event with _floor < id <= _last_id
+        self._waiters = set()  # (loop, asyncio.Event) of waiting async subscribers
+        self._refreshed_at = 0.0
+        self._pruned_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._refresh_lock = threading.Lock()
+
+    def emit(self, session):
+        """Called inside each transaction that records events"""
+
+    def committed(self):
+        """Called after a transaction that recorded events commits in this process"""
+        if self.subscribers:
+            self.refresh()
+        if time.monotonic() - self._pruned_at >= PRUNE_INTERVAL:
+            self._pruned_at = time.monotonic()
+            self.prune()
+
+    def _subscribed(self):
+        """Called when a subscriber connects"""
+
+    @contextlib.contextmanager
+    def subscription(self):
+        with self._lock:
+            self.subscribers += 1
+        self._subscribed()
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self.subscribers -= 1
+                if not self.subscribers:  # nobody keeps the events in memory current any more
+                    self._events.clear()
+                    self._last_id = self._floor = None
+
+    def _wake(self):
+        self.generation += 1
+        self._condition.notify_all()
+        for loop, waiter in self._waiters:
+            loop.call_soon_threadsafe(waiter.set)
+
+    def refresh(self, min_interval: float = 0.0):
+        """Fetch the events committed since the last refresh and wake the subscribers"""
+        if time.monotonic() - self._refreshed_at < min_interval:
+            return
+        with self._refresh_lock:
+            self._refreshed_at = time.monotonic()
+            last_id = self._last_id
+            try:
+                with self.app.app_context(), db.engine.connect() as connection:
+                    if last_id is None:
+                        rows, newest = [], connection.scalar(settled_id_query())
+                    else:
+                        rows = connection.execute(
+                            select(task_events)
+                            .where(task_events.c.id > last_id, task_events.c.id <= settled_id_query().scalar_subquery())
+                            .order_by(task_events.c.id)
+                        ).all()
+                        newest = rows[-1].id if rows else last_id
+            except SQLAlchemyError:
+                logger.warning('Reading task_events failed', exc_info=True)
+                return
+            with self._lock:
+                if not self.subscribers or self._last_id != last_id:
+                    return
+                if last_id is None:
+                    self._floor = newest
+                for row in rows:
+                    if len(self._events) == self._events.maxlen:
+                        self._floor = self._events[0]['id']
+                    self._events.append(_event(row))
+                self._last_id = newest
+                if rows or last_id is None:
+                    self._wake()
+
+    def read_cached(self, after_id: int):
+        """Events after `after_id` from memory, or None if they are not all held there"""
+        with self._lock:
+            if self._last_id is None or after_id < self._floor:
+                return None
+            events = []
+            for e in reversed(self._events):
+                if e['id'] <= after_id:
+                    break
+                events.append(e)
+        events.reverse()
+        return events[:BATCH_SIZE]
+
+    def read(self, after_id: int):
+        """Up to BATCH_SIZE events after `after_id`, oldest first"""
+        events = self.read_cached(after_id)
+        if events is not None:
+            return events
+        with self.app.app_context(), db.engine.connect() as connection:
+            rows = connection.execute(
+                select(task_events)
+                .where(task_events.c.id > after_id, task_events.c.id <= settled_id_query().scalar_subquery())
+                .order_by(task_events.c.id).limit(BATCH_SIZE)
+            )
+            return [_event(row) for row in rows]
+
+    def start(self, after_id):
+        """(id to stream after, whether the client must reload) for a subscriber resuming after `after_id`.
+
+        None means only events committed from now on are wanted. An id older
+        than the pruned events cannot be resumed from.
+        """
+        with self.app.app_context(), db.engine.connect() as connection:
+            newest = connection.scalar(settled_id_query())
+            if after_id is None:
+                return newest, False
+            pruned = connection.scalar(select(rollup_watermarks.c.last_id).where(rollup_watermarks.c.name == PRUNED)) or 0
+            if after_id < pruned:
+                return newest, True
+            return after_id, False
+
+    def wait(self, generation: int, timeout: float):
+        """Block until the generation moves past `generation`; False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self.generation != generation, timeout)
+
+    async def wait_async(self, generation: int, timeout: float):
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            if self.generation != generation:
+                return True
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+    def prune(self):
+        """Delete events older than the retention period; returns how many"""
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.retention)
+        try:
+            with self.app.app_context(), db.engine.begin() as connection:
+                last = connection.scalar(select(func.max(task_events.c.id)).where(task_events.c.created_at < cutoff))
+                if last is None:
+                    return 0
+                deleted = connection.execute(delete(task_events).where(task_events.c.id <= last)).rowcount
+                watermark = rollup_watermarks.c.name == PRUNED
+                if not connection.execute(update(rollup_watermarks).where(watermark).values(last_id=last)).rowcount:
+                    connection.execute(insert(rollup_watermarks).values(name=PRUNED, last_id=last))
+        except SQLAlchemyError:
+            logger.warning('Pruning task_events failed', exc_info=True)
+            return 0
+        return deleted
+
+class PostgresChangeFeed(ChangeFeed):
+    """ChangeFeed that also wakes subscribers for commits made by other processes, via LISTEN/NOTIFY"""
+
+    _listener_pid = None
+
+    def emit(self, session):
+        # delivered to every listener when (and only if) the transaction commits
+        session.execute(text('SELECT pg_notify(:channel, :payload)'), {'channel': CHANNEL, 'payload': ''})
+
+    def _subscribed(self):
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()  # one listener per process, started after a gunicorn fork
+        threading.Thread(target=self._listen, name='task-changes-listener', daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    raw = db.engine.raw_connection()
+                raw.detach()  # a long-lived connection of its own, never returned to the pool
+                connection = raw.dbapi_connection
+                connection.autocommit = True
+                connection.cursor().execute(f'LISTEN {CHANNEL}')
+                self.refresh()  # anything committed while the listener was not connected
+                with selectors.DefaultSelector() as selector:
+                    selector.register(connection, selectors.EVENT_READ)
+                    while True:
+                        if selector.select(timeout=self.heartbeat):
+                            connection.poll()
+                            if connection.notifies:
+                                connection.notifies.clear()
+                                self.refresh()
+            except Exception:
+                logger.warning('Listening for %s notifications failed; reconnecting', CHANNEL, exc_info=True)
+                time.sleep(1)
+
+BACKENDS = {'local': ChangeFeed, 'postgres': PostgresChangeFeed}
+
+def change_feed():
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('change_feed')
+
+@event.listens_for(Session, 'after_commit')
+def _wake_subscribers(session):
+    if session.info.pop(PENDING_CHANGES, None):
+        feed = change_feed()
+        if feed is not None:
+            feed.committed()
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back_changes(session):
+    session.info.pop(PENDING_CHANGES, None)
+
+def stream_args():
+    """(event id to resume after or None, seconds to stay open) from Last-Event-ID (or ?after=) and ?timeout="""
+    raw = request.headers.get('Last-Event-ID') or request.args.get('after')
+    after_id = None
+    if raw:
+        try:
+            after_id = int(raw)
+        except ValueError:
+            return abort(400, "Last-Event-ID must be an event id")
+    max_seconds = current_app.config['CHANGE_FEED_MAX_SECONDS']
+    try:
+        timeout = float(request.args.get('timeout', max_seconds))
+    except ValueError:
+        return abort(400, "timeout must be a number of seconds")
+    if not 0 <= timeout <= max_seconds:
+        return abort(400, f"timeout must be between 0 and {max_seconds}")
+    return after_id, timeout
+
+def stream(feed: ChangeFeed, after_id, timeout: float):
+    """Server-sent events for one subscriber: the events after `after_id`, then new ones for `timeout` seconds"""
+    deadline = time.monotonic() + timeout
+    with feed.subscription():
+        after_id, reset = feed.start(after_id)
+        yield f'retry: {RETRY_MS}\n\n' + (RESET if reset else '')
+        while True:
+            generation = feed.generation
+            events = feed.read(after_id)
+            if events:
+                after_id = events[-1]['id']
+                yield ''.join(format_event(e) for e in events)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if not events and not feed.wait(generation, min(remaining, feed.heartbeat)):
+                yield KEEPALIVE
+                feed.refresh(min_interval=feed.heartbeat / 2)  # other workers' commits
+
+async def astream(feed: ChangeFeed, after_id, timeout: float):
+    """stream() for asyncio: a waiting subscriber is a suspended coroutine, not a thread"""
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + timeout
+    with feed.subscription():
+        after_id, reset = await loop.run_in_executor(None, feed.start, after_id)
+        yield f'retry: {RETRY_MS}\n\n' + (RESET if reset else '')
+        while True:
+            generation = feed.generation
+            events = feed.read_cached(after_id)
+            if events is None:
+                events = await loop.run_in_executor(None, feed.read, after_id)
+            if events:
+                after_id = events[-1]['id']
+                yield ''.join(format_event(e) for e in events)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if not events and not await feed.wait_async(generation, min(remaining, feed.heartbeat)):
+                yield KEEPALIVE
+                await loop.run_in_executor(None, feed.refresh, feed.heartbeat / 2)
+
+def init_app(app):
+    backend = app.config['CHANGE_FEED_BACKEND']
+    if backend == 'auto':
+        backend = 'postgres' if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql') else 'local'
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown CHANGE_FEED_BACKEND: {backend}')
+    app.extensions['change_feed'] = BACKENDS[backend](
+        app, app.config['CHANGE_FEED_HEARTBEAT'], app.config['CHANGE_FEED_RETENTION']
+    )
@@ -0,0 +1,317 @@
+import click
+import csv
+import datetime
+import io
+import itertools
+import json
+from flask.cli import AppGroup
+from sqlalchemy import case, cast, column, insert, literal_column, null, select, table as table_clause, text, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from .changes import record_changes, record_staged_changes
+from .models import Task, User, assignees_table, db
+from .user_cache import get_user_cache
+
+data_cli = AppGroup('data', help='Bulk import and export of users, tasks and task_assignees, and task_logs rollups.')
+
+TABLES = {
+    'users': User.__table__,
+    'tasks': Task.__table__,
+    'task_assignees': assignees_table,
+}
+
+# column(s) an --on-conflict=update load matches existing rows on
+NATURAL_KEYS = {
+    'users': ['username'],
+    'tasks': ['title'],
+    'task_assignees': ['user_id', 'task_id'],
+}
+
+# task_events kinds for the rows an import writes: (for a new row, for an updated one), so the
+# change feed and delta sync see them like API writes. Re-importing an assignment only
+# rewrites its created_at, which is no change to the task.
+CHANGE_KINDS = {
+    'tasks': ('create', 'update'),
+    'task_assignees': ('assign', None),
+}
+
+FORMATS = ['csv', 'jsonl']
+
+def _format_for(fp, fmt):
+    """Pick the file format from --format, falling back to the file extension"""
+    if fmt:
+        return fmt
+    name = getattr(fp, 'name', '')
+    return 'jsonl' if name.endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+def _batched(rows, size: int):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+def _coerce(col, value):
+    """Convert a raw CSV/JSON value to the Python type of the column"""
+    if value is None or value == '':
+        return None
+    python_type = col.type.python_type
+    if isinstance(value, python_type):
+        return value
+    if python_type is datetime.datetime:
+        return datetime.datetime.fromisoformat(value)
+    if python_type is datetime.date:
+        return datetime.date.fromisoformat(value)
+    return python_type(value)
+
+def _read_rows(fp, fmt: str):
+    if fmt == 'csv':
+        yield from csv.DictReader(fp)
+    else:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+def _json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def _is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+def _conflict_clause(stmt, tbl, on_conflict: str, columns: list):
+    """Apply the ON CONFLICT behaviour selected by --on-conflict to a dialect insert"""
+    if on_conflict == 'skip':
+        return stmt.on_conflict_do_nothing()
+    if on_conflict == 'update':
+        keys = NATURAL_KEYS[tbl.name]
+        updates = {c: stmt.excluded[c] for c in columns if c not in keys and c not in ('id', 'version')}
+        if updates and 'version' in tbl.c:
+            updates['version'] = tbl.c.version + 1  # never the file's: an updated row needs a new ETag (see If-Match)
+        if not updates:
+            return stmt.on_conflict_do_nothing(index_elements=keys)
+        return stmt.on_conflict_do_update(index_elements=keys, set_=updates)
+    return stmt
+
+def _changed_columns(tbl):
+    """(task_id, user_id) of a written row, for its change event"""
+    if tbl.name == 'tasks':
+        return tbl.c.id.label('task_id'), cast(null(), db.Integer).label('user_id')
+    return tbl.c.task_id, tbl.c.user_id
+
+def _load_sqlite(tbl, columns: list, batches, on_conflict: str):
+    """Insert each batch with one executemany call, recording the change events of the rows it wrote"""
+    stmt = _conflict_clause(sqlite.insert(tbl), tbl, on_conflict, columns)
+    if tbl.name not in CHANGE_KINDS:
+        for batch in batches:
+            result = db.session.execute(stmt, batch)
+            yield len(batch), max(result.rowcount, 0)
+        return
+
+    created_kind, updated_kind = CHANGE_KINDS[tbl.name]
+    keys = [tbl.c[k] for k in NATURAL_KEYS[tbl.name]]
+    stmt = stmt.returning(*_changed_columns(tbl), *[key.label(f'key_{i}') for i, key in enumerate(keys)])
+    for batch in batches:
+        existing = set()
+        if on_conflict == 'update':  # the rows the upsert will update rather than insert
+            existing = {tuple(row) for row in db.session.execute(
+                select(*keys).where(tuple_(*keys).in_([tuple(row[k.name] for k in keys) for row in batch]))
+            )}
+        written = db.session.execute(stmt, batch).all()
+        kinds = [(updated_kind if tuple(row[2:]) in existing else created_kind, row) for row in written]
+        record_changes((kind, row.task_id, row.user_id) for kind, row in kinds if kind is not None)
+        yield len(batch), len(written)
+
+def _staging_sql(tbl, columns: list):
+    """(CREATE TEMP TABLE, COPY) statements staging just the imported columns of `tbl`.
+
+    The staging table has only those columns, with their types and without
+    constraints, so columns missing from the file (id, version, ...) get
+    their defaults in the INSERT ... SELECT rather than failing NOT NULL here.
+    """
+    staging_name = f'_import_{tbl.name}'
+    column_list = ', '.join(columns)
+    return (
+        f'CREATE TEMP TABLE {staging_name} ON COMMIT DROP AS SELECT {column_list} FROM {tbl.name} WITH NO DATA',
+        f'COPY {staging_name} ({column_list}) FROM STDIN WITH (FORMAT csv)',
+    )
+
+CHANGES_STAGING = '_import_changes'
+
+def _load_postgres(tbl, columns: list, batches, on_conflict: str):
+    """COPY each batch into a temporary staging table, then move the rows over with one INSERT ... SELECT"""
+    staging = table_clause(f'_import_{tbl.name}', *[column(c) for c in columns])
+    create_staging, copy_batch = _staging_sql(tbl, columns)
+
+    dbapi_conn = db.session.connection().connection
+    with dbapi_conn.cursor() as cur:
+        cur.execute(create_staging)
+        for batch in batches:
+            buf = io.StringIO()
+            csv.writer(buf).writerows([row[c] for c in columns] for row in batch)
+            buf.seek(0)
+            cur.copy_expert(copy_batch, buf)
+            yield len(batch), 0
+
+    stmt = _conflict_clause(postgresql.insert(tbl).from_select(columns, select(*staging.columns)), tbl, on_conflict, columns)
+    if tbl.name not in CHANGE_KINDS:
+        result = db.session.execute(stmt)
+        yield 0, max(result.rowcount, 0)
+    else:
+        # stage the written rows' change events straight from RETURNING (xmax is 0 for a row just inserted)
+        created_kind, updated_kind = CHANGE_KINDS[tbl.name]
+        changes = table_clause(CHANGES_STAGING, column('event_id'), column('kind'), column('task_id'), column('user_id'))
+        kind = case((literal_column('xmax = 0'), created_kind), else_=updated_kind)
+        written = stmt.returning(kind.label('kind'), *_changed_columns(tbl)).cte('written')
+        db.session.execute(text(f'CREATE TEMP TABLE {CHANGES_STAGING} '
+                                '(event_id bigint, kind varchar(20), task_id integer, user_id integer) ON COMMIT DROP'))
+        result = db.session.execute(insert(changes).add_cte(written).from_select(
+            ['kind', 'task_id', 'user_id'], select(written.c.kind, written.c.task_id, written.c.user_id)
+        ))
+        yield 0, max(result.rowcount, 0)
+        record_staged_changes(changes)
+
+    # explicit ids bypass the serial sequence, so move it past the highest id
+    if 'id' in columns:
+        db.session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{tbl.name}', 'id'), COALESCE(MAX(id), 1)) FROM {tbl.name}"
+        ))
+
+@data_cli.command('import')
+@click.argument('table_name', type=click.Choice(list(TABLES)))
+@click.argument('fp', metavar='PATH', type=click.File('r'))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Input format (default: from the file extension).')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows sent to the database per batch.')
+@click.option('--on-conflict', type=click.Choice(['error', 'skip', 'update']), default='error', show_default=True,
+              help='What to do with rows that clash with a unique title/username/email or primary key.')
+def import_command(table_name, fp, fmt, batch_size, on_conflict):
+    """Bulk-load TABLE_NAME from a CSV or JSONL file ("-" for stdin).
+
+    The whole load runs in one transaction. Passwords in a users file are
+    stored as given, so they must already be hashed.
+    """
+    tbl = TABLES[table_name]
+    rows = _read_rows(fp, _format_for(fp, fmt))
+
+    first = next(rows, None)
+    if first is None:
+        click.echo(f'{table_name}: nothing to import', err=True)
+        return
+
+    unknown = set(first) - set(tbl.columns.keys())
+    if unknown:
+        raise click.BadParameter(f"unknown column(s) for {table_name}: {', '.join(sorted(unknown))}")
+
+    # created_at is filled in by the application, not the database
+    columns = [c for c in tbl.columns.keys() if c in first or c == 'created_at']
+    now = datetime.datetime.utcnow()
+
+    def coerced():
+        for raw in itertools.chain([first], rows):
+            row = {c: _coerce(tbl.columns[c], raw.get(c)) for c in columns}
+            if 'created_at' in row and row['created_at'] is None:
+                row['created_at'] = now
+            yield row
+
+    loader = _load_postgres if _is_postgres() else _load_sqlite
+    read = inserted = 0
+    try:
+        for batch_read, batch_inserted in loader(tbl, columns, _batched(coerced(), batch_size), on_conflict):
+            read += batch_read
+            inserted += batch_inserted
+            if batch_read:
+                click.echo(f'{table_name}: {read} rows read', err=True)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    cache = get_user_cache()
+    if table_name == 'users' and on_conflict == 'update' and cache is not None:
+        cache.clear()  # updated users may have new usernames and emails
+
+    click.echo(f'{table_name}: {inserted} rows written, {read - inserted} skipped', err=True)
+
+@data_cli.command('export')
+@click.argument('table_name', type=click.Choice(list(TABLES)))
+@click.argument('fp', metavar='PATH', type=click.File('w'))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Output format (default: from the file extension).')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows fetched from the database per batch.')
+def export_command(table_name, fp, fmt, batch_size):
+    """Dump TABLE_NAME to a CSV or JSONL file ("-" for stdout)."""
+    tbl = TABLES[table_name]
+    fmt = _format_for(fp, fmt)
+    columns = tbl.columns.keys()
+    order_by = ', '.join(c.name for c in tbl.primary_key.columns)
+
+    if fmt == 'csv' and _is_postgres():
+        dbapi_conn = db.session.connection().connection
+        with dbapi_conn.cursor() as cur:
+            cur.copy_expert(
+                f"COPY (SELECT {', '.join(columns)} FROM {tbl.name} ORDER BY {order_by}) TO STDOUT WITH (FORMAT csv, HEADER)",
+                fp
+            )
+            click.echo(f'{table_name}: {cur.rowcount} rows written', err=True)
+        return
+
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(fp)
+        writer.writerow(columns)
+
+    stmt = select(tbl).order_by(*tbl.primary_key.columns).execution_options(yield_per=batch_size)
+    written = 0
+    for batch in db.session.execute(stmt).partitions():
+        if writer:
+            writer.writerows(batch)
+        else:
+            fp.writelines(json.dumps(dict(row._mapping), default=_json_default) + '\n' for row in batch)
+        written += len(batch)
+        click.echo(f'{table_name}: {written} rows written', err=True)
+
+    if not written:
+        click.echo(f'{table_name}: 0 rows written', err=True)
+
+@data_cli.command('rollup')
+@click.option('--batch-size', type=int, help='task_logs rows folded in per transaction (default: ROLLUP_BATCH_SIZE).')
+def rollup_command(batch_size):
+    """Fold new task_logs rows into the time-in-status rollups.
+
+    Only rows past the stored high-water mark are read, so this is cheap to
+    run from cron; the API also refreshes them every ROLLUP_REFRESH_INTERVAL.
+    """
+    from .rollups import refresh
+    updated = refresh(batch_size)
+    click.echo(f'task_logs: rollups updated for {updated} tasks', err=True)
+
+jobs_cli = AppGroup('jobs', help='Background jobs: run workers and queue maintenance work.')
+
+@jobs_cli.command('work')
+@click.option('--processes', type=int, default=2, show_default=True, help='Worker processes to fork.')
+@click.option('--burst', is_flag=True, help='Exit once no job is ready instead of waiting for more.')
+def work_command(processes, burst):
+    """Run queued jobs (deletes answered with 202, rollup refreshes) until interrupted.
+
+    Workers only need the app database. Start as many as the database can
+    take; each claims one job at a time and commits after every batch.
+    """
+    from flask import current_app
+    from .jobs import work, work_pool
+    app = current_app._get_current_object()
+    if processes <= 1:
+        ran = work(app, burst=burst)
+        click.echo(f'jobs: {ran} run', err=True)
+        return
+    exitcodes = work_pool(app, processes, burst)
+    if any(exitcodes):
+        raise click.ClickException(f'worker exit codes: {exitcodes}')
+
+@jobs_cli.command('enqueue')
+@click.argument('kind', type=click.Choice(['refresh_rollups']))
+def enqueue_command(kind):
+    """Queue a maintenance job for the workers, e.g. catching up the rollups after a bulk import."""
+    from .jobs import enqueue
+    job_id = enqueue(kind, {})
+    db.session.commit()
+    click.echo(f'jobs: queued {kind} as job {job_id}', err=True)
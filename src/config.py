@@ -0,0 +1,92 @@
+from sqlalchemy.engine import make_url
+
+import os
+
+DEFAULT_DATABASE_URI = 'postgresql://postgres@localhost:5432/task_management_system'
+TESTING_DATABASE_URI = 'sqlite:///test.db'
+
+# asyncio drivers used by the async read app (src/aio.py) for each database
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+def database_uri(config):
+    """Pick the database URI: an explicitly configured one, else SQLite when TESTING, else local Postgres"""
+    if config.get('SQLALCHEMY_DATABASE_URI'):
+        return config['SQLALCHEMY_DATABASE_URI']
+    return TESTING_DATABASE_URI if config.get('TESTING') else DEFAULT_DATABASE_URI
+
+def engine_options(config, uri: str = None):
+    """Build SQLAlchemy engine options from the DB_* settings.
+
+    Options already present in SQLALCHEMY_ENGINE_OPTIONS win. Pool sizing only
+    applies to server databases; Flask-SQLAlchemy picks SQLite's pool itself.
+    """
+    uri = uri or config['SQLALCHEMY_DATABASE_URI']
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    if uri.startswith('sqlite'):
+        return options
+
+    options.setdefault('pool_size', config['DB_POOL_SIZE'])
+    options.setdefault('max_overflow', config['DB_MAX_OVERFLOW'])
+    options.setdefault('pool_timeout', config['DB_POOL_TIMEOUT'])
+    options.setdefault('pool_recycle', config['DB_POOL_RECYCLE'])
+    options.setdefault('pool_pre_ping', config['DB_POOL_PRE_PING'])
+
+    if uri.startswith('postgresql') and config['DB_STATEMENT_TIMEOUT_MS']:
+        connect_args = dict(options.get('connect_args') or {})
+        connect_args.setdefault('options', f"-c statement_timeout={int(config['DB_STATEMENT_TIMEOUT_MS'])}")
+        options['connect_args'] = connect_args
+
+    return options
+
+def replica_binds(config):
+    """SQLALCHEMY_BINDS entries (replica_0, replica_1, ...) for DATABASE_REPLICA_URIS, each with its engine_options"""
+    from .replicas import replica_key
+    return {replica_key(i): dict(engine_options(config, uri), url=uri)
+            for i, uri in enumerate(config.get('DATABASE_REPLICA_URIS') or ())}
+
+def async_database_uri(config, instance_path: str = None):
+    """ASYNC_DATABASE_URI if set, else the app's database through its asyncio driver.
+
+    Relative SQLite paths are resolved against `instance_path`, as
+    Flask-SQLAlchemy does for the app's own engine, so both open the same file.
+    """
+    if config.get('ASYNC_DATABASE_URI'):
+        uri = config['ASYNC_DATABASE_URI']
+    else:
+        scheme, separator, rest = config['SQLALCHEMY_DATABASE_URI'].partition('://')
+        backend = scheme.split('+')[0]
+        if backend not in ASYNC_DRIVERS:
+            raise ValueError(f'No asyncio driver known for {scheme}; set ASYNC_DATABASE_URI')
+        uri = ASYNC_DRIVERS[backend] + separator + rest
+    if instance_path is not None and uri.startswith('sqlite'):
+        uri = _sqlite_in_instance_path(uri, instance_path)
+    return uri
+
+def _sqlite_in_instance_path(uri: str, instance_path: str):
+    url = make_url(uri)
+    if url.database in (None, '', ':memory:'):
+        return uri
+    is_uri = url.query.get('uri', False)  # sqlite:///file:path?uri=true
+    path = url.database[5:] if is_uri else url.database
+    if os.path.isabs(path):
+        return uri
+    path = os.path.join(instance_path, path)
+    return url.set(database=f'file:{path}' if is_uri else path).render_as_string(hide_password=False)
+
+def async_replica_uris(config, instance_path: str = None):
+    """{replica bind key: asyncio URI} for DATABASE_REPLICA_URIS, the async counterparts of replica_binds()"""
+    from .replicas import replica_key
+    return {replica_key(i): async_database_uri({'SQLALCHEMY_DATABASE_URI': uri}, instance_path)
+            for i, uri in enumerate(config.get('DATABASE_REPLICA_URIS') or ())}
+
+def async_engine_options(config, uri: str):
+    """engine_options for the async engine; asyncpg takes the statement timeout as a server setting"""
+    options = engine_options(config, uri)
+    connect_args = dict(options.get('connect_args') or {})
+    if uri.startswith('postgresql+asyncpg') and connect_args.pop('options', None) is not None:
+        server_settings = dict(connect_args.get('server_settings') or {})
+        server_settings.setdefault('statement_timeout', str(int(config['DB_STATEMENT_TIMEOUT_MS'])))
+        connect_args['server_settings'] = server_settings
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
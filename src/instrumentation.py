@@ -0,0 +1,102 @@
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+import collections
+import contextlib
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# The start time is kept on the statement's execution context rather than the connection, so a
+# statement that fails (and never reaches after_cursor_execute) leaves nothing behind.
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start_time = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_start_time
+    if not has_request_context() or 'sql_count' not in g:
+        return
+    g.sql_count += 1
+    g.sql_time += elapsed
+    if g.sql_statements is not None:
+        g.sql_statements[statement] += 1  # parameters are bound, so repeats share one statement text
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+    g.sql_statements = collections.Counter() if current_app.config['SQL_DETECT_N_PLUS_ONE'] else None
+
+def _repeated_statements(threshold: int):
+    """Statements run at least `threshold` times in this request, i.e. likely N+1 fan-outs"""
+    if g.sql_statements is None:
+        return {}
+    return {statement: count for statement, count in g.sql_statements.items() if count >= threshold}
+
+def init_app(app):
+    """Count statements and database time per request and report them.
+
+    Every response gets a Server-Timing header (db and total durations) and a
+    JSON log line. With SQL_DETECT_N_PLUS_ONE, statements repeated at least
+    SQL_N_PLUS_ONE_THRESHOLD times within one request are logged as warnings.
+    """
+    if not app.config['SQL_INSTRUMENTATION']:
+        return
+
+    threshold = app.config['SQL_N_PLUS_ONE_THRESHOLD']
+
+    from .models import db
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+    app.before_request(_start_request)
+
+    @app.after_request
+    def report(response):
+        if 'sql_count' not in g:
+            return response
+
+        total_ms = (time.perf_counter() - g.request_start) * 1000
+        db_ms = g.sql_time * 1000
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={db_ms:.2f};desc="{g.sql_count} queries", total;dur={total_ms:.2f}'
+        )
+
+        repeated = _repeated_statements(threshold)
+        for statement, count in repeated.items():
+            logger.warning('Possible N+1: %s %s ran %d times: %s', request.method, request.path, count, statement)
+
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'queries': g.sql_count,
+            'db_ms': round(db_ms, 2),
+            'total_ms': round(total_ms, 2),
+            'repeated_statements': len(repeated),
+        }))
+        return response
+
+@contextlib.contextmanager
+def capture_queries(engines):
+    """Collect the SQL text of every statement the given engines run inside the block"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engines = list(engines)
+    for engine in engines:
+        event.listen(engine, 'after_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            event.remove(engine, 'after_cursor_execute', record)
@@ -0,0 +1,284 @@
+from flask import current_app
+from sqlalchemy import delete, func, insert, select, tuple_, update
+from .changes import record_change
+from .models import Task, User, assignees_table, db, jobs_table, task_progress_table, task_status_durations, task_status_state
+from .rollups import refresh_batch
+from .user_cache import invalidate_users
+
+import datetime
+import logging
+import multiprocessing
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Work too heavy for a request (cascading deletes, catching up the rollups) is queued
+# as a row in `jobs` and run by `flask jobs work` processes, with nothing but the app
+# database. A worker claims a job with one UPDATE that leases it for
+# JOB_VISIBILITY_TIMEOUT seconds (FOR UPDATE SKIP LOCKED on Postgres, so workers
+# never wait on each other) and extends the lease with every batch it commits. If
+# the worker dies the lease runs out and another worker claims the job again; the
+# handlers work in committed, idempotent batches, so the retry picks up where the
+# last attempt stopped. A failed attempt is retried after JOB_RETRY_DELAY seconds,
+# doubled per attempt, until JOB_MAX_ATTEMPTS.
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+CREATOR_CLEARED = 'tasks_creator_cleared'  # progress key: tasks of a deleted user left without a creator
+PENDING = (QUEUED, RUNNING)
+
+def _utcnow():
+    return datetime.datetime.utcnow()
+
+def _is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+def _batches(select_keys, batch_size: int):
+    """Yield lists of up to `batch_size` keys from select_keys until it returns none"""
+    while True:
+        keys = db.session.execute(select_keys.limit(batch_size)).all()
+        if not keys:
+            return
+        yield keys
+
+def _delete_in_batches(table, where, batch_size: int):
+    """DELETE the rows of `table` matching `where`, `batch_size` at a time by primary key; yields each batch's count"""
+    key = list(table.primary_key.columns)
+    for keys in _batches(select(*key).where(where), batch_size):
+        match = key[0].in_([k[0] for k in keys]) if len(key) == 1 else tuple_(*key).in_([tuple(k) for k in keys])
+        yield db.session.execute(delete(table).where(match)).rowcount
+
+def _delete_tasks(task_ids: list, batch_size: int):
+    """Delete tasks with everything that references them, yielding {table: rows} per batch"""
+    for table in (task_progress_table, assignees_table, task_status_durations, task_status_state):
+        for count in _delete_in_batches(table, table.c.task_id.in_(task_ids), batch_size):
+            yield {table.name: count}
+    deleted = db.session.scalars(delete(Task).where(Task.id.in_(task_ids)).returning(Task.id)).all()
+    for task_id in deleted:
+        record_change('delete', task_id)
+    yield {'tasks': len(deleted)}
+
+def delete_task(payload: dict, batch_size: int):
+    """Delete a task, its task_logs and its assignments"""
+    yield from _delete_tasks([payload['task_id']], batch_size)
+
+def delete_user(payload: dict, batch_size: int):
+    """Delete a user and its assignments; the tasks it created are kept, with no creator"""
+    user_id = payload['user_id']
+    assigned = select(assignees_table.c.task_id).where(assignees_table.c.user_id == user_id).order_by(assignees_table.c.task_id)
+    for keys in _batches(assigned, batch_size):
+        removed = db.session.scalars(
+            delete(assignees_table)
+            .where(assignees_table.c.user_id == user_id, assignees_table.c.task_id.in_([task_id for task_id, in keys]))
+            .returning(assignees_table.c.task_id)
+        ).all()
+        for task_id in removed:  # removed from the user's list, for the change feed and delta sync
+            record_change('unassign', task_id, (user_id,))
+        yield {assignees_table.name: len(removed)}
+
+    created = select(Task.id).where(Task.created_by_user == user_id).order_by(Task.id)
+    tasks = Task.__table__.c
+    for keys in _batches(created, batch_size):
+        cleared = db.session.scalars(
+            update(Task.__table__)
+            .where(tasks.id.in_([task_id for task_id, in keys]), tasks.created_by_user == user_id)
+            .values(created_by_user=None, version=tasks.version + 1)  # a new representation, so a new ETag
+            .returning(tasks.id)
+        ).all()
+        for task_id in cleared:
+            record_change('update', task_id)
+        yield {CREATOR_CLEARED: len(cleared)}
+
+    yield {'users': db.session.execute(delete(User).where(User.id == user_id)).rowcount}
+    invalidate_users(user_id)  # a worker resumes here after committing the batch above; the route invalidates inline deletes
+
+def refresh_rollups(payload: dict, batch_size: int):
+    """Catch the time-in-status rollups up with task_logs (refresh_batch commits each batch itself)"""
+    config = current_app.config
+    while True:
+        updated = refresh_batch(config['ROLLUP_BATCH_SIZE'])
+        if not updated:
+            return
+        yield {'tasks': updated}
+
+# job kind -> handler(payload, batch_size), a generator yielding {table: rows} after each batch
+HANDLERS = {
+    'delete_task': delete_task,
+    'delete_user': delete_user,
+    'refresh_rollups': refresh_rollups,
+}
+
+def cascade_size(kind: str, payload: dict, limit: int):
+    """Rows a delete job would remove or update, counted up to `limit` + 1 (enough to tell a small job from a large one)"""
+    if kind == 'delete_task':
+        task_ids = select(Task.id).where(Task.id == payload['task_id'])
+        queries = [task_ids]
+        queries += [select(table.c.task_id).where(table.c.task_id.in_(task_ids)) for table in (task_progress_table, assignees_table)]
+    else:  # the assignments it removes and the tasks it updates
+        queries = [select(assignees_table.c.task_id).where(assignees_table.c.user_id == payload['user_id']),
+                   select(Task.id).where(Task.created_by_user == payload['user_id'])]
+    total = 0
+    for query in queries:
+        total += db.session.scalar(select(func.count()).select_from(query.limit(limit + 1 - total).subquery()))
+        if total > limit:
+            break
+    return total
+
+def enqueue(kind: str, payload: dict, key: str = None):
+    """Queue a job in the current transaction and return its id (the caller commits).
+
+    A job with the same `key` that is still queued or running is reused
+    instead, so repeating a request does not queue the work twice.
+    """
+    key = key or kind
+    pending = db.session.scalar(
+        select(jobs_table.c.id).where(jobs_table.c.key == key, jobs_table.c.status.in_(PENDING)).limit(1)
+    )
+    if pending is not None:
+        return pending
+    now = _utcnow()
+    return db.session.execute(insert(jobs_table).values(
+        kind=kind, key=key, payload=payload, status=QUEUED, attempts=0,
+        max_attempts=current_app.config['JOB_MAX_ATTEMPTS'], visible_at=now, created_at=now,
+    )).inserted_primary_key[0]
+
+def run_or_enqueue(kind: str, payload: dict, key: str):
+    """Run a delete job in this request if its cascade is at most JOB_INLINE_LIMIT rows, else queue it.
+
+    Returns (queued job id, None) or, when the job ran here, (None, {table:
+    rows deleted}; CREATOR_CLEARED counts tasks updated instead). Either way
+    the caller commits: an inline job is one transaction, as before.
+    """
+    limit = current_app.config['JOB_INLINE_LIMIT']
+    if limit > 0 and cascade_size(kind, payload, limit) <= limit:
+        deleted = {}
+        for counts in HANDLERS[kind](payload, limit + 1):
+            for table, count in counts.items():
+                deleted[table] = deleted.get(table, 0) + count
+        return None, deleted
+    return enqueue(kind, payload, key), None
+
+def job_status(job_id: int):
+    """The job as a dict for GET /jobs/<id>, or None"""
+    row = db.session.execute(select(jobs_table).where(jobs_table.c.id == job_id)).first()
+    if row is None:
+        return None
+    return {
+        'job_id': row.id, 'kind': row.kind, 'status': row.status, 'attempts': row.attempts,
+        'max_attempts': row.max_attempts, 'progress': row.progress or {}, 'error': row.error,
+        'created_at': row.created_at, 'finished_at': row.finished_at,
+    }
+
+def fail_expired():
+    """Give up on running jobs whose lease ran out on their last attempt (the worker died); returns how many"""
+    now = _utcnow()
+    count = db.session.execute(
+        update(jobs_table)
+        .where(jobs_table.c.status == RUNNING, jobs_table.c.visible_at <= now,
+               jobs_table.c.attempts >= jobs_table.c.max_attempts)
+        .values(status=FAILED, finished_at=now,
+                error=func.coalesce(jobs_table.c.error, 'the worker stopped before the job finished'))
+    ).rowcount
+    db.session.commit()
+    return count
+
+def claim(visibility: float):
+    """Lease the oldest job that is ready (queued, or running on an expired lease) and commit; None if there is none"""
+    now = _utcnow()
+    jobs = jobs_table.c
+    ready = (
+        select(jobs.id)
+        .where(jobs.status.in_(PENDING), jobs.visible_at <= now, jobs.attempts < jobs.max_attempts)
+        .order_by(jobs.visible_at, jobs.id)
+        .limit(1)
+    )
+    if _is_postgres():
+        ready = ready.with_for_update(skip_locked=True)
+    job = db.session.execute(
+        update(jobs_table)
+        .where(jobs.id == ready.scalar_subquery())
+        .values(status=RUNNING, attempts=jobs.attempts + 1, visible_at=now + datetime.timedelta(seconds=visibility))
+        .returning(jobs.id, jobs.kind, jobs.payload, jobs.attempts, jobs.max_attempts, jobs.progress)
+    ).first()
+    db.session.commit()
+    return job
+
+def run(job, batch_size: int, visibility: float, retry_delay: float):
+    """Run a claimed job, committing after every batch; returns its status afterwards.
+
+    Each commit also extends the lease, on the condition that no other
+    worker has claimed the job since (its attempts are still ours). When
+    that fails the batch is rolled back and the job left to the new owner.
+    """
+    jobs = jobs_table.c
+    ours = (jobs.id == job.id) & (jobs.attempts == job.attempts)
+    progress = dict(job.progress or {})
+    try:
+        for counts in HANDLERS[job.kind](job.payload, batch_size):
+            for table, count in counts.items():
+                progress[table] = progress.get(table, 0) + count
+            lease = _utcnow() + datetime.timedelta(seconds=visibility)
+            if not db.session.execute(update(jobs_table).where(ours).values(visible_at=lease, progress=dict(progress))).rowcount:
+                db.session.rollback()
+                logger.warning('job %s was claimed by another worker; leaving it', job.id)
+                return RUNNING
+            db.session.commit()
+        status, error, visible_at = DONE, None, _utcnow()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning('job %s (%s) failed on attempt %s', job.id, job.kind, job.attempts, exc_info=True)
+        status = FAILED if job.attempts >= job.max_attempts else QUEUED
+        error = f'{type(e).__name__}: {e}'
+        visible_at = _utcnow() + datetime.timedelta(seconds=retry_delay * 2 ** (job.attempts - 1))
+
+    db.session.execute(update(jobs_table).where(ours).values(
+        status=status, error=error, visible_at=visible_at, progress=progress,
+        finished_at=visible_at if status in (DONE, FAILED) else None,
+    ))
+    db.session.commit()
+    return status
+
+def work(app, stop: threading.Event = None, burst: bool = False):
+    """Claim and run jobs until `stop` is set or, with `burst`, none is ready; returns the number of jobs run"""
+    config = app.config
+    stop = stop or threading.Event()
+    ran = 0
+    with app.app_context():
+        while not stop.is_set():
+            fail_expired()
+            job = claim(config['JOB_VISIBILITY_TIMEOUT'])
+            if job is None:
+                if burst:
+                    break
+                stop.wait(config['JOB_POLL_INTERVAL'])
+                continue
+            run(job, config['JOB_BATCH_SIZE'], config['JOB_VISIBILITY_TIMEOUT'], config['JOB_RETRY_DELAY'])
+            ran += 1
+            db.session.remove()
+    return ran
+
+def _work_process(app, stop, burst: bool):
+    # Ctrl-C and SIGTERM (to the parent or the whole group) only set `stop`; the current job is finished first
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)  # the parent's connections must not be shared after fork
+    work(app, stop, burst)
+
+def work_pool(app, processes: int, burst: bool = False):
+    """Run `processes` forked worker processes until SIGINT/SIGTERM (or, with `burst`, until the queue is empty)"""
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    workers = [context.Process(target=_work_process, args=(app, stop, burst), name=f'jobs-worker-{i}')
+               for i in range(processes)]
+    previous = {sig: signal.signal(sig, lambda *_: stop.set()) for sig in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+    return [worker.exitcode for worker in workers]
@@ -1,46 +1,71 @@
+from flask import current_app, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, bindparam, delete, event, func, insert, inspect, literal, literal_column, or_, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from .passwords import get_hasher
+from .replicas import RoutingSession, replica_lag_allowance
+from .user_cache import get_user_cache
+import atexit
 import datetime
+import logging
+import threading
+import time
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})  # reads may go to a replica; see replicas.py
 
 assignees_table = db.Table(
     'task_assignees',
     db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
     db.Column('task_id', db.Integer, db.ForeignKey('tasks.id'), primary_key=True),
-    db.Column('created_at', db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    db.Column('created_at', db.DateTime, default=datetime.datetime.utcnow, nullable=False),
+    # the primary key leads with user_id; this serves lookups and joins starting from a task
+    db.Index('ix_task_assignees_task_id_user_id', 'task_id', 'user_id')
 )
 
 class Task(db.Model):
     __tablename__ = 'tasks'
+    __table_args__ = (
+        # B-tree (column, id) indexes serve both the GET /tasks filters and keyset pagination in that order
+        db.Index('ix_tasks_status_id', 'status', 'id'),
+        db.Index('ix_tasks_deadline_id', 'deadline', 'id'),
+        db.Index('ix_tasks_created_by_user_id', 'created_by_user', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.String(256), unique=True, nullable=False)
     description = db.Column(db.Text)
     deadline = db.Column(db.Date)
     status = db.Column(db.String(50))
     created_by_user = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # bumped by every update; see If-Match
+    __mapper_args__ = {'version_id_col': version}  # ORM updates bump it too, and fail on a stale copy
 
     created_by = db.relationship('User', back_populates='tasks_created_by_user', foreign_keys=[created_by_user], overlaps='created_by_user_rel')
+    # dynamic: reading the collection is a query, and appending to it never loads it.
+    # Membership checks and single assignments go through the (user_id, task_id) key
+    # instead; see assign_user and unassign_user.
     assignees = db.relationship(
         'User',
         secondary=assignees_table,
         back_populates='assigned_tasks',
-        lazy='select'
+        order_by='User.id',  # the same order the list endpoints' projection uses
+        lazy='dynamic'
     )
 
     @property
     def users_assigned_task(self):
-        if self.assignees:
-            return [user.serialize() for user in self.assignees]
-        else:
-            return []
-        
+        if get_user_cache() is not None:
+            return assigned_user_dicts([self.id]).get(self.id, [])
+        return [user.serialize() for user in self.assignees]
+
     def assign_user(self, user):
-        if user not in self.assignees:
-            self.assignees.append(user)
-            db.session.commit()
-            return True
-        else:
-            return False
+        """Assign `user` unless it already is; returns whether it was added. The caller commits."""
+        return assign_user_to_task(self.id, user.id)
+
+    def unassign_user(self, user):
+        """Unassign `user` if it is assigned; returns whether it was removed. The caller commits."""
+        return unassign_user_from_task(self.id, user.id)
 
     def __init__(self, title, description, deadline, status, created_by_user):
         self.title = title
@@ -50,7 +75,7 @@ class Task(db.Model):
         self.created_by_user = created_by_user
 
     def serialize(self):
-        assigned_users = [user.serialize() for user in self.assignees]
+        assigned_users = self.users_assigned_task  # from the shared user cache when it is on
         return {
             'task_id': self.id,
             'title': self.title,
@@ -68,13 +93,16 @@ class User(db.Model):
     email = db.Column(db.String(128), unique=True, nullable=False)
     password = db.Column(db.String(128), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=True)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # bumped by every update; see If-Match
+    __mapper_args__ = {'version_id_col': version}  # ORM updates bump it too, and fail on a stale copy
 
     tasks_created_by_user = db.relationship('Task', back_populates='created_by', lazy=True)
     assigned_tasks = db.relationship(
         'Task',
         secondary=assignees_table,
         back_populates='assignees',
-        lazy='select'
+        order_by='Task.id',
+        lazy='dynamic'  # see Task.assignees
     )
 
     def __init__(self, username, email, password, created_at=None):
@@ -83,6 +111,18 @@ class User(db.Model):
         self.password = password
         self.created_at = created_at or datetime.datetime.utcnow()
 
+    def check_password(self, password: str):
+        """Verify a password, re-hashing it if the stored hash uses an outdated algorithm or cost.
+
+        The caller commits, so an upgraded hash is saved with the rest of the request.
+        """
+        hasher = get_hasher()
+        if not hasher.verify(self.password, password):
+            return False
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(password)
+        return True
+
     def serialize(self):
         return {
             'user_id': self.id,
@@ -90,9 +130,357 @@ class User(db.Model):
             'email': self.email
         }
 
+def assignee_ids_query(task_ids: list):
+    """(task_id, user_id) of the assignees of the given tasks, from task_assignees alone"""
+    return (
+        select(assignees_table.c.task_id, assignees_table.c.user_id)
+        .where(assignees_table.c.task_id.in_(task_ids))
+        .order_by(assignees_table.c.task_id, assignees_table.c.user_id)
+    )
+
+def users_query(user_ids):
+    """(id, username, email) of the given users: the columns User.serialize() uses"""
+    return select(User.id, User.username, User.email).where(User.id.in_(user_ids))
+
+def cached_users(user_ids):
+    """Look users up in the shared user cache: ({id: user dict} found, set of ids missing, generation to fill at)"""
+    cache = get_user_cache()
+    user_ids = set(user_ids)
+    generation = cache.generation  # read before the misses are loaded; see UserRecordCache.put_many
+    found = cache.get_many(user_ids)
+    return found, user_ids - found.keys(), generation
+
+def fill_users(found: dict, rows, generation: int):
+    """Add rows of users_query() to `found` and store them in the shared user cache; returns `found`"""
+    rows = [tuple(row) for row in rows]
+    get_user_cache().put_many(rows, generation, replica_lag_allowance())
+    found.update({user_id: {'user_id': user_id, 'username': username, 'email': email} for user_id, username, email in rows})
+    return found
+
+def group_assignee_ids(pairs, users: dict):
+    """{task_id: [user dicts ordered by id]} for rows of assignee_ids_query and the users they name"""
+    grouped = {}
+    for task_id, user_id in pairs:
+        if user_id in users:  # a user deleted since the pairs were read
+            grouped.setdefault(task_id, []).append(users[user_id])
+    return grouped
+
+def assigned_user_dicts(task_ids: list):
+    """{task_id: [user dicts ordered by id]} with the users from the shared user cache; only misses query users"""
+    pairs = db.session.execute(assignee_ids_query(task_ids)).all()
+    found, missing, generation = cached_users(user_id for _, user_id in pairs)
+    if missing:
+        fill_users(found, db.session.execute(users_query(missing)), generation)
+    return group_assignee_ids(pairs, found)
+
+def _assignment_state(owner_col, owner_id: int, target_model, target_col, target_ids: list):
+    """Map each existing id in target_ids to whether it is already paired with owner_id (one query)"""
+    rows = db.session.execute(
+        select(target_model.id, target_col)
+        .outerjoin(assignees_table, and_(target_col == target_model.id, owner_col == owner_id))
+        .where(target_model.id.in_(target_ids))
+    ).all()
+    return {target_id: linked is not None for target_id, linked in rows}
+
+def _bulk_assign(owner_col, owner_id: int, target_model, target_col, target_ids: list):
+    """Pair owner_id with every id in target_ids using one INSERT ... SELECT ... ON CONFLICT DO NOTHING"""
+    state = _assignment_state(owner_col, owner_id, target_model, target_col, target_ids)
+    new_ids = [i for i, linked in state.items() if not linked]
+
+    inserted = set()
+    if new_ids:
+        # a concurrent request may pair some of them first; those rows are skipped rather than failing on the key
+        inserted = set(db.session.scalars(
+            _insert_or_skip(assignees_table).from_select(
+                [target_col.name, owner_col.name, 'created_at'],
+                select(target_model.id, literal(owner_id), literal(datetime.datetime.utcnow()))
+                .where(target_model.id.in_(new_ids))
+            ).returning(target_col)
+        ))
+
+    return {i: 'not_found' if i not in state else 'assigned' if i in inserted else 'already_assigned' for i in target_ids}
+
+def _bulk_unassign(owner_col, owner_id: int, target_model, target_col, target_ids: list):
+    """Remove every existing pair of owner_id and target_ids with one DELETE"""
+    state = _assignment_state(owner_col, owner_id, target_model, target_col, target_ids)
+    linked_ids = [i for i, linked in state.items() if linked]
+
+    if linked_ids:
+        db.session.execute(
+            delete(assignees_table).where(owner_col == owner_id, target_col.in_(linked_ids))
+        )
+
+    return {i: 'not_found' if i not in state else 'unassigned' if state[i] else 'not_assigned' for i in target_ids}
+
+def _insert_or_skip(table):
+    """INSERT into `table` that skips rows whose primary key already exists, atomically (ON CONFLICT DO NOTHING)"""
+    stmt = postgresql.insert(table) if db.engine.dialect.name == 'postgresql' else sqlite.insert(table)
+    return stmt.on_conflict_do_nothing()
+
+def assign_user_to_task(task_id: int, user_id: int):
+    """Pair one user with one task by primary key; False if they already were. The caller commits."""
+    result = db.session.execute(
+        _insert_or_skip(assignees_table).values(user_id=user_id, task_id=task_id, created_at=datetime.datetime.utcnow())
+    )
+    return result.rowcount == 1
+
+def unassign_user_from_task(task_id: int, user_id: int):
+    """Remove one user/task pair by primary key; False if there was none. The caller commits."""
+    result = db.session.execute(
+        delete(assignees_table).where(assignees_table.c.user_id == user_id, assignees_table.c.task_id == task_id)
+    )
+    return result.rowcount == 1
+
+def assign_users_to_task(task_id: int, user_ids: list):
+    """Assign many users to one task; returns {user_id: result}. The caller commits."""
+    return _bulk_assign(assignees_table.c.task_id, task_id, User, assignees_table.c.user_id, user_ids)
+
+def unassign_users_from_task(task_id: int, user_ids: list):
+    """Unassign many users from one task; returns {user_id: result}. The caller commits."""
+    return _bulk_unassign(assignees_table.c.task_id, task_id, User, assignees_table.c.user_id, user_ids)
+
+def assign_tasks_to_user(user_id: int, task_ids: list):
+    """Assign many tasks to one user; returns {task_id: result}. The caller commits."""
+    return _bulk_assign(assignees_table.c.user_id, user_id, Task, assignees_table.c.task_id, task_ids)
+
+def unassign_tasks_from_user(user_id: int, task_ids: list):
+    """Unassign many tasks from one user; returns {task_id: result}. The caller commits."""
+    return _bulk_unassign(assignees_table.c.user_id, user_id, Task, assignees_table.c.task_id, task_ids)
+
+# Ids drawn from a sequence can commit out of order on Postgres. Tables read by id past a high-water mark
+# (task_logs, task_events) store a horizon with each row: the first transaction id not yet started when the
+# row's id was drawn. Once the oldest transaction still running is at or past it, every writer that could
+# hold a lower id has finished, so readers only go up to the newest row that has settled that way.
+SNAPSHOT_XMAX = literal_column('pg_snapshot_xmax(pg_current_snapshot())::text::bigint')  # first transaction id not yet started
+SNAPSHOT_XMIN = literal_column('pg_snapshot_xmin(pg_current_snapshot())::text::bigint')  # oldest transaction id still running
+
+def next_ids(connection, table_name: str, n: int) -> list:
+    """Postgres: draw n ids from the table's id sequence (insert with horizon=SNAPSHOT_XMAX in a later statement)"""
+    return connection.scalars(select(func.nextval(func.pg_get_serial_sequence(table_name, 'id')))
+                              .select_from(func.generate_series(1, n))).all()
+
+def settled(horizon):
+    """Filter for rows every lower id of which has committed or rolled back, given their horizon column"""
+    if db.engine.dialect.name == 'postgresql':
+        return or_(horizon.is_(None), horizon <= SNAPSHOT_XMIN)
+    return horizon.is_(None)  # only set on Postgres; SQLite commits one writer at a time, in id order
+
 task_progress_table = db.Table(
     'task_logs',
+    # increasing id: the high-water mark the status rollups are refreshed from
+    db.Column('id', db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True),
     db.Column('task_id', db.Integer, db.ForeignKey('tasks.id'), nullable=False),
     db.Column('status', db.String(50), nullable=False),
-    db.Column('timestamp', db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    db.Column('timestamp', db.DateTime, default=datetime.datetime.utcnow, nullable=False),
+    db.Column('horizon', db.BigInteger),  # Postgres only: see SNAPSHOT_XMAX
+    db.Index('ix_task_logs_task_id_timestamp', 'task_id', 'timestamp')
+)
+
+# Time spent in each status, per task and per month the status was entered (see src/rollups.py)
+task_status_durations = db.Table(
+    'task_status_durations',
+    db.Column('task_id', db.Integer, db.ForeignKey('tasks.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('status', db.String(50), primary_key=True),
+    db.Column('period', db.Date, primary_key=True),
+    db.Column('seconds', db.Float, nullable=False),
+    db.Column('visits', db.Integer, nullable=False),  # closed intervals spent in the status
+    db.Index('ix_task_status_durations_status_period', 'status', 'period')
+)
+
+# The status each task is currently in, since when, and when it was first logged and first completed
+task_status_state = db.Table(
+    'task_status_state',
+    db.Column('task_id', db.Integer, db.ForeignKey('tasks.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('status', db.String(50), nullable=False),
+    db.Column('entered_at', db.DateTime, nullable=False),
+    db.Column('first_logged_at', db.DateTime, nullable=False),
+    db.Column('completed_at', db.DateTime),
+    db.Column('completion_seconds', db.Float),  # completed_at - first_logged_at, for the completion estimates
+    db.Index('ix_task_status_state_completion_seconds', 'completion_seconds')
+)
+
+# High-water marks: the last task_logs id folded into the rollups, the last task_events id pruned
+rollup_watermarks = db.Table(
+    'rollup_watermarks',
+    db.Column('name', db.String(50), primary_key=True),
+    db.Column('last_id', db.BigInteger, nullable=False)
+)
+
+# Create/update/delete/assign/unassign events behind GET /tasks/changes (see src/changes.py); no foreign
+# keys, so a deleted task's events outlive it. Pruned after CHANGE_FEED_RETENTION seconds.
+task_events = db.Table(
+    'task_events',
+    db.Column('id', db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True),
+    db.Column('kind', db.String(20), nullable=False),
+    db.Column('task_id', db.Integer, nullable=False),
+    db.Column('user_id', db.Integer),  # the user assigned or unassigned
+    db.Column('created_at', db.DateTime, default=datetime.datetime.utcnow, nullable=False),
+    db.Column('horizon', db.BigInteger),  # Postgres only: see SNAPSHOT_XMAX
+    db.Index('ix_task_events_created_at', 'created_at')
+)
+
+# Background jobs run by `flask jobs work` (see src/jobs.py)
+jobs_table = db.Table(
+    'jobs',
+    db.Column('id', db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True),
+    db.Column('kind', db.String(50), nullable=False),
+    db.Column('key', db.String(128), nullable=False),  # e.g. delete_task:42; a second request joins the pending job
+    db.Column('payload', db.JSON, nullable=False),
+    db.Column('status', db.String(20), nullable=False),  # queued, running, done or failed
+    db.Column('attempts', db.Integer, nullable=False, default=0),
+    db.Column('max_attempts', db.Integer, nullable=False),
+    db.Column('visible_at', db.DateTime, nullable=False),  # queued: when it may run; running: when its lease runs out
+    db.Column('progress', db.JSON),  # rows handled so far, by table
+    db.Column('error', db.Text),  # the last attempt's error
+    db.Column('created_at', db.DateTime, default=datetime.datetime.utcnow, nullable=False),
+    db.Column('finished_at', db.DateTime),
+    db.Index('ix_jobs_status_visible_at', 'status', 'visible_at'),
+    db.Index('ix_jobs_key', 'key')
 )
+
+logger = logging.getLogger(__name__)
+
+class TaskLogWriter:
+    """Writes status changes to task_logs in batches, outside the request's transaction.
+
+    Changes are captured from the ORM (see _capture_status_changes), held per
+    session until it commits, then buffered here and written as one
+    multi-row INSERT once `batch_size` are waiting or the oldest has waited
+    `flush_interval` seconds. A rolled back transaction's changes are dropped
+    with it; a failed write keeps its rows for the next flush, and whatever
+    is buffered is written when the process exits.
+    """
+
+    def __init__(self, app, batch_size: int = 500, flush_interval: float = 1.0, max_buffered: int = 100_000):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.written = self.flushes = self.failed_flushes = self.dropped = 0
+        self._buffer = []
+        self._oldest = None  # monotonic time the oldest buffered row was added
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def add(self, rows: list):
+        with self._lock:
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.extend(rows)
+            overflow = len(self._buffer) - self.max_buffered
+            if overflow > 0:  # the database has been unreachable for a while; keep the newest rows
+                del self._buffer[:overflow]
+                self.dropped += overflow
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        with self._lock:
+            due = self._buffer and (len(self._buffer) >= self.batch_size
+                                    or time.monotonic() - self._oldest >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write everything buffered in one transaction; returns the number of rows written"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+            if not rows:
+                return 0
+            try:
+                with self.app.app_context(), db.engine.begin() as connection:
+                    if connection.dialect.name == 'postgresql':
+                        # take a transaction id before drawing the ids, so the horizon covers this writer
+                        connection.execute(select(func.pg_current_xact_id()))
+                        ids = next_ids(connection, 'task_logs', len(rows))
+                        connection.execute(insert(task_progress_table).values(horizon=SNAPSHOT_XMAX),
+                                           [dict(row, id=i) for row, i in zip(rows, ids)])
+                    else:
+                        connection.execute(insert(task_progress_table), rows)
+            except SQLAlchemyError:
+                logger.warning('Writing %d task_logs rows failed; keeping them for the next flush', len(rows), exc_info=True)
+                with self._lock:
+                    self._buffer[:0] = rows
+                    self._oldest = time.monotonic()
+                    self.failed_flushes += 1
+                return 0
+            self.written += len(rows)
+            self.flushes += 1
+            return len(rows)
+
+    def stats(self):
+        with self._lock:
+            return {'buffered': len(self._buffer), 'written': self.written, 'flushes': self.flushes,
+                    'failed_flushes': self.failed_flushes, 'dropped': self.dropped}
+
+PENDING_LOGS = 'pending_task_logs'
+
+def task_log_writer():
+    """The app's TaskLogWriter, or None when task_logs is written by database triggers"""
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('task_log_writer')
+
+def log_status_change(task_id: int, status: str, session=None):
+    """Record a status change made without the ORM (e.g. a Core UPDATE); written if the session commits"""
+    if status is not None and task_log_writer() is not None:
+        (session or db.session).info.setdefault(PENDING_LOGS, []).append(
+            {'task_id': task_id, 'status': status, 'timestamp': datetime.datetime.utcnow()}
+        )
+
+@event.listens_for(Session, 'after_flush')
+def _capture_status_changes(session, flush_context):
+    """Queue a task_logs row for every task inserted with a status or whose status changed, as the triggers do"""
+    if task_log_writer() is None:
+        return
+    for obj in session.new:
+        if isinstance(obj, Task):
+            log_status_change(obj.id, obj.status, session)
+    for obj in session.dirty:
+        if isinstance(obj, Task) and inspect(obj).attrs.status.history.has_changes():
+            log_status_change(obj.id, obj.status, session)
+
+@event.listens_for(Session, 'after_commit')
+def _buffer_committed_logs(session):
+    rows = session.info.pop(PENDING_LOGS, None)
+    writer = task_log_writer()
+    if rows and writer is not None:
+        writer.add(rows)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back_logs(session):
+    session.info.pop(PENDING_LOGS, None)
+
+# the triggers postgres_database_schema/tasks_table.sql installs to write task_logs
+LOG_TRIGGERS = ('log_task_status_trigger', 'status_update_trigger')
+
+def installed_log_triggers() -> list:
+    """The task_logs triggers present on the tasks table"""
+    if db.engine.dialect.name == 'postgresql':
+        query = text("SELECT tgname FROM pg_trigger WHERE tgrelid = to_regclass('tasks') "
+                     'AND NOT tgisinternal AND tgname = ANY(:names)').bindparams(names=list(LOG_TRIGGERS))
+    else:
+        query = text("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'tasks' "
+                     'AND name IN :names').bindparams(bindparam('names', list(LOG_TRIGGERS), expanding=True))
+    with db.engine.connect() as connection:
+        return sorted(connection.execute(query).scalars())
+
+def init_task_log_writer(app):
+    """Set up app-side task_logs writes if TASK_LOG_MODE (or, for 'auto', the database) calls for them"""
+    mode = app.config['TASK_LOG_MODE']
+    if mode not in ('auto', 'app', 'trigger'):
+        raise ValueError(f'Unknown TASK_LOG_MODE: {mode}')
+    if mode != 'trigger':
+        with app.app_context():
+            triggers = installed_log_triggers()
+        if triggers and mode == 'app':  # the app would log every change a second time
+            raise ValueError(f"TASK_LOG_MODE is 'app' but the tasks table still has {', '.join(triggers)}; "
+                             'drop them or use trigger mode')
+        mode = 'trigger' if triggers else 'app'
+    if mode == 'trigger':
+        return
+
+    writer = TaskLogWriter(app, app.config['TASK_LOG_BATCH_SIZE'], app.config['TASK_LOG_FLUSH_INTERVAL'])
+    app.extensions['task_log_writer'] = writer
+    app.teardown_request(lambda exc: writer.flush_if_due())  # lets the flush interval elapse between commits
+    atexit.register(writer.flush)
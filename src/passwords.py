@@ -0,0 +1,141 @@
+from flask import current_app
+
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import secrets
+import threading
+
+# Stored hashes look like "<algorithm>$<cost>$<salt>$<digest>", e.g.
+#   pbkdf2_sha256$600000$<salt>$<digest>
+#   scrypt$16384,8,1$<salt>$<digest>
+# with salt and digest in unpadded base64, so they fit the 128 character column.
+ALGORITHMS = ('pbkdf2_sha256', 'scrypt')
+SALT_BYTES = 16
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue is full or a hash outlasts the timeout; callers should answer 503"""
+
+def _b64(raw: bytes):
+    return base64.b64encode(raw).decode('ascii').rstrip('=')
+
+def _unb64(text: str):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+def _derive(algorithm: str, cost: tuple, password: str, salt: bytes):
+    if algorithm == 'pbkdf2_sha256':
+        (iterations,) = cost
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    if algorithm == 'scrypt':
+        n, r, p = cost
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r + 2 ** 20, dklen=32)
+    raise ValueError(f'Unknown password hash algorithm: {algorithm}')
+
+def make_hash(password: str, algorithm: str, cost: tuple, salt: bytes = None):
+    """Hash `password` and return the self-describing string stored in users.password"""
+    salt = salt or secrets.token_bytes(SALT_BYTES)
+    digest = _derive(algorithm, cost, password, salt)
+    return '$'.join([algorithm, ','.join(str(c) for c in cost), _b64(salt), _b64(digest)])
+
+def parse_hash(stored: str):
+    """Split a stored hash into (algorithm, cost, salt, digest), or return None if it has an unknown format.
+
+    Passwords stored before this module existed are a bare SHA-512 of the
+    password plus a salt that was thrown away, so they parse as None and can
+    never be verified.
+    """
+    parts = (stored or '').split('$')
+    if len(parts) != 4 or parts[0] not in ALGORITHMS:
+        return None
+    try:
+        cost = tuple(int(c) for c in parts[1].split(','))
+        return parts[0], cost, _unb64(parts[2]), _unb64(parts[3])
+    except ValueError:
+        return None
+
+def check_hash(stored: str, password: str):
+    parsed = parse_hash(stored)
+    if parsed is None:
+        return False
+    algorithm, cost, salt, digest = parsed
+    return hmac.compare_digest(_derive(algorithm, cost, password, salt), digest)
+
+class PasswordHasher:
+    """Hashes and verifies passwords on a small bounded thread pool.
+
+    hashlib's PBKDF2 and scrypt release the GIL, so a thread pool is enough to
+    keep them off the request threads' CPU share; capping it at `workers`
+    hashes at a time plus `queue_limit` waiting ones means a burst of sign-ups
+    or password changes is refused with HashingBusy instead of starving reads.
+    The pool is started lazily, so each gunicorn worker gets its own after fork.
+    """
+
+    def __init__(self, algorithm: str = 'pbkdf2_sha256', pbkdf2_iterations: int = 600_000,
+                 scrypt_cost: tuple = (2 ** 14, 8, 1), workers: int = 2, queue_limit: int = 16,
+                 timeout: float = 30.0):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f'Unknown password hash algorithm: {algorithm}')
+        self.algorithm = algorithm
+        self.cost = (pbkdf2_iterations,) if algorithm == 'pbkdf2_sha256' else tuple(scrypt_cost)
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy('Too many password hashing requests in progress')
+        try:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix='password-hash'
+                    )
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            # a job still queued is dropped (freeing its slot now); a running one keeps its slot until it finishes
+            future.cancel()
+            raise HashingBusy('Password hashing timed out') from None
+
+    def hash(self, password: str):
+        return self._submit(make_hash, password, self.algorithm, self.cost)
+
+    def verify(self, stored: str, password: str):
+        return self._submit(check_hash, stored, password)
+
+    def needs_rehash(self, stored: str):
+        """True if `stored` was made with a different algorithm or cost than the current setting"""
+        parsed = parse_hash(stored)
+        return parsed is None or (parsed[0], parsed[1]) != (self.algorithm, self.cost)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+def init_app(app):
+    app.extensions['password_hasher'] = PasswordHasher(
+        algorithm=app.config['PASSWORD_HASH_ALGORITHM'],
+        pbkdf2_iterations=app.config['PASSWORD_PBKDF2_ITERATIONS'],
+        scrypt_cost=app.config['PASSWORD_SCRYPT_COST'],
+        workers=app.config['PASSWORD_HASH_WORKERS'],
+        queue_limit=app.config['PASSWORD_HASH_QUEUE_LIMIT'],
+        timeout=app.config['PASSWORD_HASH_TIMEOUT']
+    )
+
+def get_hasher():
+    return current_app.extensions['password_hasher']
+
+def hash_password(password: str):
+    """Hash a password with the configured algorithm and cost"""
+    return get_hasher().hash(password)
@@ -0,0 +1,165 @@
+from flask import current_app, g, has_app_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import UpdateBase, text
+from sqlalchemy.exc import SQLAlchemyError
+
+import itertools
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Read replicas: DATABASE_REPLICA_URIS become the SQLALCHEMY_BINDS replica_0,
+# replica_1, ... and read-only requests (GET/HEAD on views that never write) read
+# from one of them, picked round-robin per request. Everything else uses the primary:
+# other methods, writes issued while serving a GET (RoutingSession sends DML and ORM
+# flushes there), job workers and the CLI. A replica is checked with SELECT 1 (and, on
+# Postgres, its replay lag) at most every REPLICA_CHECK_INTERVAL seconds and skipped
+# while it fails; with none left, reads fall back to the primary. A client that wrote
+# gets a cookie keeping its reads on the primary for REPLICA_STICKY_SECONDS, so it
+# reads its own writes while the replicas catch up.
+
+BIND_PREFIX = 'replica_'
+STICKY_COOKIE = 'read_primary_until'
+SAFE_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS'})
+READ_METHODS = frozenset({'GET', 'HEAD'})
+# GET views that write (refreshing the rollups they read), or must see the newest rows (the change feed, job status)
+PRIMARY_ENDPOINTS = frozenset({'tasks.status_durations', 'tasks.timeline', 'tasks.changes', 'jobs.show'})
+PRIMARY = 'primary'
+
+def replica_key(index: int):
+    return f'{BIND_PREFIX}{index}'
+
+def _writes(clause):
+    return isinstance(clause, UpdateBase)
+
+class RoutingSession(Session):
+    """db.session: reads during a replica-routed request go to its replica, all writes to the primary"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not _writes(clause) and has_app_context():
+            key = g.get('read_replica')
+            if key is not None:
+                return self._db.engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+class ReplicaRouter:
+    """Round-robin choice among the replicas that passed their last health check, with per-target counters"""
+
+    def __init__(self, keys: list, check_interval: float = 5.0, max_lag: float = None, sticky_seconds: float = 5.0):
+        self.keys = list(keys)
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.sticky_seconds = sticky_seconds
+        self.health = {key: (True, -math.inf) for key in self.keys}  # key -> (healthy, monotonic time of the check)
+        self.reads = dict.fromkeys([PRIMARY, *self.keys], 0)
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def check(self, key: str, engine):
+        """Ping the replica (and check its lag on Postgres); records and returns whether it can serve reads"""
+        healthy = True
+        try:
+            with engine.connect() as connection:
+                if engine.dialect.name == 'postgresql' and self.max_lag is not None:
+                    lag = connection.scalar(text(
+                        'SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)'
+                    ))
+                    healthy = lag <= self.max_lag
+                else:
+                    connection.execute(text('SELECT 1'))
+        except SQLAlchemyError:
+            logger.warning('read replica %s failed its health check', key, exc_info=True)
+            healthy = False
+        with self._lock:
+            self.health[key] = (healthy, time.monotonic())
+        return healthy
+
+    def choose(self, engines):
+        """The bind key of the next healthy replica, or None for the primary"""
+        if not self.keys:
+            return None
+        start = next(self._turn)
+        for i in range(len(self.keys)):
+            key = self.keys[(start + i) % len(self.keys)]
+            healthy, checked = self.health[key]
+            if time.monotonic() - checked >= self.check_interval:
+                healthy = self.check(key, engines[key])
+            if healthy:
+                return key
+        return None
+
+    def sticky(self):
+        """Whether this client wrote recently enough that it must read from the primary"""
+        try:
+            return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def may_use_replica(self):
+        """Whether the current request may read from a replica: a read-only view, from a client that did not just write"""
+        return request.method in READ_METHODS and request.endpoint not in PRIMARY_ENDPOINTS and not self.sticky()
+
+    def checks_due(self):
+        """Whether choose() would health-check a replica now (and so block on its connection)"""
+        now = time.monotonic()
+        return any(now - checked >= self.check_interval for _, checked in self.health.values())
+
+    def count(self, key: str = None):
+        with self._lock:
+            self.reads[key or PRIMARY] += 1
+
+    def route(self):
+        """before_request: pick the replica this request reads from, if it may use one"""
+        key = None
+        if self.may_use_replica():
+            from .models import db
+            key = self.choose(db.engines)
+        g.read_replica = key
+        self.count(key)
+
+    def stick(self, response):
+        """after_request: keep the client that just wrote on the primary for a while"""
+        if request.method not in SAFE_METHODS and response.status_code < 400 and self.sticky_seconds > 0:
+            until = time.time() + self.sticky_seconds
+            response.set_cookie(STICKY_COOKIE, f'{until:.3f}', max_age=math.ceil(self.sticky_seconds),
+                                httponly=True, samesite='Lax')
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {
+                'reads': dict(self.reads),
+                'replicas': {key: {'healthy': healthy} for key, (healthy, _) in self.health.items()},
+                'sticky_seconds': self.sticky_seconds,
+            }
+
+def get_router():
+    return current_app.extensions.get('replicas')
+
+def replica_lag_allowance():
+    """Seconds the replica this request reads from may trail the primary; 0 when it reads from the primary"""
+    router = get_router()
+    if router is None or g.get('read_replica') is None:
+        return 0.0
+    return router.sticky_seconds
+
+def init_app(app):
+    """Route read-only requests to the replica binds configured by DATABASE_REPLICA_URIS (a no-op without any)"""
+    keys = sorted(key for key in app.config.get('SQLALCHEMY_BINDS') or {} if key.startswith(BIND_PREFIX))
+    if not keys:
+        return
+    from .models import db
+    for key in keys:
+        db.metadatas.pop(key, None)  # no tables of their own (they replicate the primary's), so create_all/drop_all skip them
+    router = ReplicaRouter(
+        keys,
+        app.config['REPLICA_CHECK_INTERVAL'],
+        app.config['REPLICA_MAX_LAG'],
+        app.config['REPLICA_STICKY_SECONDS'],
+    )
+    app.extensions['replicas'] = router
+    app.before_request(router.route)
+    app.after_request(router.stick)
@@ -0,0 +1,324 @@
+from flask import current_app
+from sqlalchemy import case, func, literal, select, union_all, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from .models import assignees_table, db, rollup_watermarks, settled, task_progress_table, task_status_durations, task_status_state
+
+import array
+import collections
+import datetime
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+WATERMARK = 'task_logs'
+COMPLETED = 'completed'
+
+# task_logs is append-only and its id only grows, so the rollups are brought up to
+# date by folding in the rows past the stored high-water mark instead of rescanning
+# the log. Each task's open interval (its current status and when it was entered) is
+# kept in task_status_state and closed when the task's next log row arrives. The
+# mark only moves up to settled rows (see SNAPSHOT_XMAX in models.py), so a row
+# whose transaction commits after a higher id's is never skipped.
+
+def _is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+def _seconds(start, end):
+    if _is_postgres():
+        return func.extract('epoch', end - start)
+    return (func.julianday(end) - func.julianday(start)) * 86400.0
+
+def _month(ts):
+    """First day of the month `ts` falls in"""
+    if _is_postgres():
+        return func.cast(func.date_trunc('month', ts), db.Date)
+    return func.date(ts, 'start of month')
+
+def _as_date(value):
+    return datetime.date.fromisoformat(value) if isinstance(value, str) else value
+
+def _upsert(table, rows: list, keys: list, set_):
+    """INSERT rows, updating the ones whose `keys` already exist with set_(excluded)"""
+    stmt = (postgresql.insert(table) if _is_postgres() else sqlite.insert(table))
+    stmt = stmt.on_conflict_do_update(index_elements=keys, set_=set_(stmt.excluded))
+    db.session.execute(stmt, rows)
+
+def _watermark():
+    last_id = db.session.execute(
+        select(rollup_watermarks.c.last_id).where(rollup_watermarks.c.name == WATERMARK)
+    ).scalar()
+    if last_id is None:
+        stmt = postgresql.insert(rollup_watermarks) if _is_postgres() else sqlite.insert(rollup_watermarks)
+        db.session.execute(stmt.values(name=WATERMARK, last_id=0).on_conflict_do_nothing())
+        last_id = 0
+    return last_id
+
+def refresh_batch(batch_size: int):
+    """Fold the next `batch_size` task_logs rows past the high-water mark into the rollups and commit.
+
+    The batch stops at the newest row that has settled, so a lower id still
+    in flight is folded in by a later run. Returns the number of tasks
+    updated; 0 when there was nothing to do or another process refreshed the
+    same rows first.
+    """
+    logs = task_progress_table.c
+    last_id = _watermark()
+
+    window = select(logs.id, logs.horizon).where(logs.id > last_id).order_by(logs.id).limit(batch_size).subquery()
+    upto = db.session.execute(select(func.max(case((settled(window.c.horizon), window.c.id))))).scalar()
+    if upto is None:
+        db.session.commit()
+        return 0
+
+    # Claim the range first: a concurrent refresher fails this compare-and-set (after waiting
+    # for our commit on Postgres) and backs off instead of counting the same rows twice
+    claimed = db.session.execute(
+        update(rollup_watermarks)
+        .where(rollup_watermarks.c.name == WATERMARK, rollup_watermarks.c.last_id == last_id)
+        .values(last_id=upto)
+    ).rowcount
+    if claimed != 1:
+        db.session.rollback()
+        return 0
+
+    batch = select(logs.id, logs.task_id, logs.status, logs.timestamp).where(
+        logs.id > last_id, logs.id <= upto
+    ).cte('batch')
+    state = task_status_state.c
+
+    # Each task's open interval followed by its new rows; LEAD() pairs every row with the next one
+    events = union_all(
+        select(literal(0).label('id'), state.task_id, state.status, state.entered_at.label('timestamp'))
+        .where(state.task_id.in_(select(batch.c.task_id))),
+        select(batch.c.id, batch.c.task_id, batch.c.status, batch.c.timestamp)
+    ).subquery()
+    following = func.lead(events.c.timestamp).over(
+        partition_by=events.c.task_id, order_by=(events.c.timestamp, events.c.id)
+    )
+    intervals = select(events.c.task_id, events.c.status, events.c.timestamp.label('start'),
+                       following.label('end')).subquery()
+    period = _month(intervals.c.start)
+    durations = db.session.execute(
+        select(intervals.c.task_id, intervals.c.status, period, func.sum(_seconds(intervals.c.start, intervals.c.end)),
+               func.count())
+        .where(intervals.c.end.isnot(None))
+        .group_by(intervals.c.task_id, intervals.c.status, period)
+    ).all()
+    if durations:
+        _upsert(task_status_durations,
+                [{'task_id': t, 'status': s, 'period': _as_date(p), 'seconds': float(sec), 'visits': n}
+                 for t, s, p, sec, n in durations],
+                ['task_id', 'status', 'period'],
+                lambda new: {'seconds': task_status_durations.c.seconds + new.seconds,
+                             'visits': task_status_durations.c.visits + new.visits})
+
+    # New open interval per task: its latest row, unless the stored one is later still
+    ranked = select(
+        batch.c.task_id, batch.c.status, batch.c.timestamp,
+        func.row_number().over(partition_by=batch.c.task_id,
+                               order_by=(batch.c.timestamp.desc(), batch.c.id.desc())).label('rank')
+    ).subquery()
+    firsts = select(
+        batch.c.task_id,
+        func.min(batch.c.timestamp).label('first_logged_at'),
+        func.min(case((batch.c.status == COMPLETED, batch.c.timestamp))).label('completed_at')
+    ).group_by(batch.c.task_id).subquery()
+    rows = db.session.execute(
+        select(ranked.c.task_id, ranked.c.status, ranked.c.timestamp, firsts.c.first_logged_at, firsts.c.completed_at,
+               state.status, state.entered_at, state.first_logged_at, state.completed_at)
+        .join(firsts, firsts.c.task_id == ranked.c.task_id)
+        .outerjoin(task_status_state, state.task_id == ranked.c.task_id)
+        .where(ranked.c.rank == 1)
+    ).all()
+
+    new_state = []
+    for task_id, status, entered_at, first_logged_at, completed_at, old_status, old_entered, old_first, old_completed in rows:
+        if old_entered is not None and old_entered > entered_at:
+            status, entered_at = old_status, old_entered
+        new_state.append({
+            'task_id': task_id,
+            'status': status,
+            'entered_at': entered_at,
+            'first_logged_at': min(first_logged_at, old_first) if old_first else first_logged_at,
+            'completed_at': min(filter(None, (completed_at, old_completed)), default=None),
+        })
+    for row in new_state:
+        completed_at = row['completed_at']
+        row['completion_seconds'] = (completed_at - row['first_logged_at']).total_seconds() if completed_at else None
+    if new_state:
+        _upsert(task_status_state, new_state, ['task_id'],
+                lambda new: {'status': new.status, 'entered_at': new.entered_at, 'first_logged_at': new.first_logged_at,
+                             'completed_at': new.completed_at, 'completion_seconds': new.completion_seconds})
+
+    db.session.commit()
+    return len(new_state)
+
+def refresh(batch_size: int = None, max_batches: int = None):
+    """Run refresh_batch until the rollups are caught up (or max_batches ran); returns tasks updated"""
+    batch_size = batch_size or current_app.config['ROLLUP_BATCH_SIZE']
+    total = batches = 0
+    while max_batches is None or batches < max_batches:
+        updated = refresh_batch(batch_size)
+        batches += 1
+        total += updated
+        if not updated:
+            break
+    return total
+
+def refresh_if_stale():
+    """Refresh (one batch) when the last refresh from this worker is older than ROLLUP_REFRESH_INTERVAL.
+
+    Called from the read endpoints. A request never waits for another
+    thread's refresh, and a failed refresh only leaves the rollups stale.
+    """
+    interval = current_app.config['ROLLUP_REFRESH_INTERVAL']
+    state = current_app.extensions['rollups']
+    if interval < 0 or time.monotonic() - state['refreshed_at'] < interval:
+        return
+    if not state['lock'].acquire(blocking=False):
+        return
+    try:
+        refresh(max_batches=1)
+        state['refreshed_at'] = time.monotonic()
+    except SQLAlchemyError:
+        db.session.rollback()
+        logger.warning('task_logs rollup refresh failed', exc_info=True)
+    finally:
+        state['lock'].release()
+
+def init_app(app):
+    app.extensions['rollups'] = {
+        'lock': threading.Lock(),
+        'refreshed_at': float('-inf'),
+    }
+
+def percentile(values, q: float):
+    """q-th percentile (linear interpolation, as numpy's default and percentile_cont) of sorted values"""
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def completion_percentiles(age_seconds: float, qs: tuple):
+    """(count, {q: seconds}) over the completion times of completed tasks that took longer than age_seconds.
+
+    On Postgres percentile_cont computes them; on SQLite each percentile is
+    read as the two neighbouring values from the completion_seconds index.
+    """
+    seconds = task_status_state.c.completion_seconds
+    longer = seconds > age_seconds
+    if _is_postgres():
+        count, *values = db.session.execute(
+            select(func.count(), *[func.percentile_cont(q / 100.0).within_group(seconds) for q in qs]).where(longer)
+        ).one()
+        return count, dict(zip(qs, values)) if count else {}
+
+    count = db.session.execute(select(func.count()).where(longer)).scalar()
+    values = {}
+    for q in qs if count else ():
+        position = (count - 1) * q / 100.0
+        neighbours = db.session.execute(
+            select(seconds).where(longer).order_by(seconds).offset(int(position)).limit(2)
+        ).scalars().all()
+        values[q] = percentile(neighbours, (position - int(position)) * 100.0)
+    return count, values
+
+def estimate_completion(age_seconds: float, now: datetime.datetime):
+    """Remaining time for a task open for age_seconds, from completed tasks that were still open at that age"""
+    count, percentiles = completion_percentiles(age_seconds, (50, 90))
+    if not count:
+        return None
+    remaining = {q: s - age_seconds for q, s in percentiles.items()}
+    return {
+        'based_on': count,
+        'remaining_seconds': {f'p{q}': round(s, 3) for q, s in remaining.items()},
+        'expected_completion': {f'p{q}': (now + datetime.timedelta(seconds=s)).isoformat() for q, s in remaining.items()},
+    }
+
+def task_timeline(task_id: int, now: datetime.datetime):
+    """Status intervals of one task, read straight from its task_logs rows, plus a completion estimate"""
+    logs = task_progress_table.c
+    rows = db.session.execute(
+        select(logs.status, logs.timestamp).where(logs.task_id == task_id).order_by(logs.timestamp, logs.id)
+    ).all()
+
+    intervals = []
+    time_in_status = collections.defaultdict(float)
+    for (status, start), following in itertools.zip_longest(rows, rows[1:]):
+        end = following.timestamp if following else None
+        seconds = ((end or now) - start).total_seconds()
+        time_in_status[status] += seconds
+        intervals.append({'status': status, 'start': start.isoformat(),
+                          'end': end.isoformat() if end else None, 'seconds': round(seconds, 3)})
+
+    completed_at = next((ts for status, ts in rows if status == COMPLETED), None)
+    estimate = None
+    if rows and completed_at is None:
+        estimate = estimate_completion((now - rows[0].timestamp).total_seconds(), now)
+    return {
+        'task_id': task_id,
+        'status': rows[-1].status if rows else None,
+        'completed_at': completed_at.isoformat() if completed_at else None,
+        'time_in_status': {status: round(seconds, 3) for status, seconds in time_in_status.items()},
+        'intervals': intervals,
+        'estimate': estimate,
+    }
+
+def _per_task_durations(group_columns: list, where: list, join_assignees: bool):
+    """(group key..., seconds, visits) per group and task, summed from the rollup rows"""
+    d = task_status_durations.c
+    stmt = select(*[column.label(f'key_{i}') for i, column in enumerate(group_columns)],
+                  func.sum(d.seconds).label('seconds'), func.sum(d.visits).label('visits')).where(*where)
+    if join_assignees:
+        stmt = stmt.join_from(task_status_durations, assignees_table, assignees_table.c.task_id == d.task_id)
+    return stmt.group_by(*group_columns, d.task_id)
+
+def duration_stats_query(group_columns: list, where: list, join_assignees: bool):
+    """Postgres: the per-group aggregates in one statement, with the percentiles from percentile_cont"""
+    per_task = _per_task_durations(group_columns, where, join_assignees).subquery()
+    keys = [per_task.c[f'key_{i}'] for i in range(len(group_columns))]
+    seconds = per_task.c.seconds
+    return select(
+        *keys, func.count(), func.sum(per_task.c.visits), func.sum(seconds),
+        func.percentile_cont(0.5).within_group(seconds), func.percentile_cont(0.9).within_group(seconds),
+    ).group_by(*keys).order_by(*keys)
+
+def _group_stats(key: tuple, tasks: int, visits: int, total: float, p50: float, p90: float):
+    return {
+        'key': key,
+        'tasks': tasks,
+        'visits': visits,
+        'total_seconds': round(total, 3),
+        'mean_seconds': round(total / tasks, 3),
+        'p50_seconds': round(p50, 3),
+        'p90_seconds': round(p90, 3),
+    }
+
+def duration_stats(group_columns: list, where: list, join_assignees: bool):
+    """Time in status per group: totals, mean and percentiles over the per-task totals of each group.
+
+    On Postgres the database does all of it and returns one row per group.
+    SQLite has no percentile function, so there it returns every group's
+    per-task totals, sorted, and the groups are aggregated here: Python work
+    per task, where each group's percentiles are index lookups.
+    """
+    width = len(group_columns)
+    if _is_postgres():
+        return [_group_stats(tuple(row[:width]), *row[width:])
+                for row in db.session.execute(duration_stats_query(group_columns, where, join_assignees))]
+
+    per_task = _per_task_durations(group_columns, where, join_assignees)
+    per_task = per_task.order_by(*per_task.selected_columns[:width], per_task.selected_columns.seconds)
+    groups = []
+    for key, rows in itertools.groupby(db.session.execute(per_task), key=lambda row: tuple(row[:width])):
+        rows = list(rows)
+        seconds = array.array('d', (row.seconds for row in rows))
+        groups.append(_group_stats(key, len(seconds), sum(row.visits for row in rows), sum(seconds),
+                                   percentile(seconds, 50), percentile(seconds, 90)))
+    return groups
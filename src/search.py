@@ -0,0 +1,107 @@
+from sqlalchemy import DDL, bindparam, event, text
+from .models import Task, db
+
+import re
+
+# Postgres keeps a weighted tsvector of title (A) and description (B) in a generated
+# column with a GIN index; SQLite keeps an external-content FTS5 table in step with
+# tasks through triggers. Both are created with the tables and by migration 8c4d0e6f2a17.
+POSTGRES_DDL = [
+    """ALTER TABLE tasks ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'B')
+    ) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_tasks_search_vector ON tasks USING gin (search_vector)",
+]
+
+SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5(
+        title, description, content='tasks', content_rowid='id', tokenize='porter unicode61'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS tasks_fts_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO tasks_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tasks_fts_delete AFTER DELETE ON tasks BEGIN
+        INSERT INTO tasks_fts(tasks_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tasks_fts_update AFTER UPDATE OF title, description ON tasks BEGIN
+        INSERT INTO tasks_fts(tasks_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO tasks_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+]
+
+for statement in POSTGRES_DDL:
+    event.listen(Task.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+for statement in SQLITE_DDL:
+    event.listen(Task.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Task.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS tasks_fts').execute_if(dialect='sqlite'))
+
+MARK_START, MARK_END = '<mark>', '</mark>'
+
+# Each query returns (id, score) for every match, best first; the cursor filter is applied around it.
+# Scores are float8 so the one a cursor carries (a Python float) compares equal to the row it came from;
+# ts_rank_cd's float4 never equals its float8 round trip, which dropped ties at page boundaries.
+POSTGRES_MATCHES = """
+    SELECT t.id AS id, ts_rank_cd(t.search_vector, websearch_to_tsquery('english', :q))::float8 AS score
+    FROM tasks t
+    WHERE t.search_vector @@ websearch_to_tsquery('english', :q)
+"""
+SQLITE_MATCHES = """
+    SELECT tasks_fts.rowid AS id, -bm25(tasks_fts, 4.0, 1.0) AS score
+    FROM tasks_fts
+    WHERE tasks_fts MATCH :q
+"""
+
+POSTGRES_SNIPPETS = f"""
+    SELECT t.id, ts_headline('english', t.title || ' ' || coalesce(t.description, ''),
+                             websearch_to_tsquery('english', :q),
+                             'StartSel={MARK_START}, StopSel={MARK_END}, MaxWords=30, MinWords=10')
+    FROM tasks t
+    WHERE t.id IN :ids
+"""
+SQLITE_SNIPPETS = f"""
+    SELECT tasks_fts.rowid, snippet(tasks_fts, -1, '{MARK_START}', '{MARK_END}', '…', 16)
+    FROM tasks_fts
+    WHERE tasks_fts MATCH :q AND tasks_fts.rowid IN :ids
+"""
+
+def _fts5_query(q: str):
+    """Quote every word so user input can't use (or break on) FTS5 query syntax; words are ANDed"""
+    words = re.findall(r'\w+', q)
+    return ' '.join(f'"{w}"' for w in words)
+
+def search_task_ids(q: str, limit: int, after=None):
+    """Return up to limit + 1 (id, score) pairs for tasks matching `q`, best match first.
+
+    Only the index lookup and the ranking of the matching rows are done in the
+    database, so the cost grows with the number of matches, not with the table.
+    `after` is the (score, id) of the last row of the previous page.
+    """
+    postgres = db.engine.dialect.name == 'postgresql'
+    if postgres:
+        matches, params = POSTGRES_MATCHES, {'q': q}
+    else:
+        params = {'q': _fts5_query(q)}
+        if not params['q']:
+            return []
+        matches = SQLITE_MATCHES
+
+    where = ''
+    if after is not None:
+        where = 'WHERE m.score < :score OR (m.score = :score AND m.id > :id)'
+        params.update(score=after[0], id=after[1])
+
+    rows = db.session.execute(
+        text(f'SELECT m.id, m.score FROM ({matches}) m {where} ORDER BY m.score DESC, m.id LIMIT :limit'),
+        dict(params, limit=limit + 1)
+    ).all()
+    return [(row.id, float(row.score)) for row in rows]
+
+def snippets(q: str, ids: list):
+    """Highlighted extracts (matches wrapped in <mark>) for the given task ids"""
+    if not ids:
+        return {}
+    postgres = db.engine.dialect.name == 'postgresql'
+    statement = text(POSTGRES_SNIPPETS if postgres else SQLITE_SNIPPETS).bindparams(bindparam('ids', expanding=True))
+    params = {'q': q if postgres else _fts5_query(q), 'ids': ids}
+    return dict(db.session.execute(statement, params).all())
@@ -0,0 +1,207 @@
+from flask import current_app
+
+import contextlib
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+# A user-record cache shared by every worker process on a host, for the user dicts
+# task serialization embeds as assigned_users. The records live in a memory-mapped
+# file of USER_CACHE_SLOTS fixed-size slots; a user's slot is its id modulo the slot
+# count, so memory is fixed up front and a lookup is one struct unpack. Without
+# USER_CACHE_PATH the file is an unlinked temporary one, shared with the processes
+# forked after create_app (gunicorn workers with preload_app); with it, every process
+# that maps the same path shares it. Writers take a lock (a thread lock plus lockf on
+# the file) and bump a slot's sequence number to odd while rewriting it, so a reader
+# that sees an odd or changed sequence treats the slot as a miss instead of locking.
+# users.update/users.delete bump the header's generation and clear the user's slot;
+# records read from the database are only stored if the generation has not moved
+# since, like ResponseCache.put, and records read from a replica are not stored while
+# it may still trail the last invalidation. USER_CACHE_TTL bounds how long writes made
+# on other hosts go unseen.
+
+MAGIC = b'usrcach1'
+HEADER = struct.Struct('<8sQQd')  # magic, slot count, generation, time of the last invalidation
+HEADER_SIZE = 64
+GENERATION_OFFSET = 16
+INVALIDATED_OFFSET = 24
+FIELD_BYTES = 128  # username and email are String(128); longer UTF-8 encodings are not cached
+RECORD = struct.Struct(f'<QqdBB{FIELD_BYTES}s{FIELD_BYTES}s')  # sequence, user id (0: empty), expiry, lengths, username, email
+SLOT_HEAD = struct.Struct('<Qqd')  # sequence, user id, expiry
+RECORD_SIZE = 288  # RECORD padded to a multiple of 8
+SEQUENCE = struct.Struct('<Q')
+TIMESTAMP = struct.Struct('<d')
+
+class UserRecordCache:
+    """Fixed-size, memory-mapped map of user id -> user dict, shared across processes.
+
+    Hit, miss and fill counters are kept per process.
+    """
+
+    def __init__(self, slots: int = 4096, ttl: float = 60.0, path: str = None):
+        self.slots = slots
+        self.ttl = ttl
+        self.path = path
+        self.size = HEADER_SIZE + slots * RECORD_SIZE
+        self.hits = self.misses = self.fills = self.evictions = self.invalidations = self.oversize = 0
+        self._lock = threading.Lock()
+        if path:
+            self._file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b')
+        else:
+            self._file = tempfile.TemporaryFile()
+        with self._locked_file():
+            header = self._file.read(HEADER.size)
+            if os.fstat(self._file.fileno()).st_size != self.size or header[:16] != HEADER.pack(MAGIC, slots, 0, 0.0)[:16]:
+                self._file.truncate(0)  # new, or laid out for another slot count: start empty
+                self._file.truncate(self.size)
+                self._file.seek(0)
+                self._file.write(HEADER.pack(MAGIC, slots, 0, 0.0))
+                self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), self.size)
+
+    @contextlib.contextmanager
+    def _locked_file(self):
+        with self._lock:
+            fcntl.lockf(self._file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+    @property
+    def generation(self):
+        """Bumped by every invalidation; pass the value read before a database read to put_many()"""
+        return SEQUENCE.unpack_from(self._map, GENERATION_OFFSET)[0]
+
+    @property
+    def invalidated_at(self):
+        """Wall-clock time of the last invalidation by any process sharing the file"""
+        return TIMESTAMP.unpack_from(self._map, INVALIDATED_OFFSET)[0]
+
+    def _offset(self, user_id: int):
+        return HEADER_SIZE + (user_id % self.slots) * RECORD_SIZE
+
+    def _write(self, offset: int, sequence: int, user_id: int, expires: float, username: bytes = b'', email: bytes = b''):
+        SEQUENCE.pack_into(self._map, offset, sequence + 1)  # odd while the slot is rewritten
+        RECORD.pack_into(self._map, offset, sequence + 1, user_id, expires, len(username), len(email), username, email)
+        SEQUENCE.pack_into(self._map, offset, sequence + 2)
+
+    def _bump_generation(self):
+        SEQUENCE.pack_into(self._map, GENERATION_OFFSET, self.generation + 1)
+        TIMESTAMP.pack_into(self._map, INVALIDATED_OFFSET, time.time())
+
+    def get_many(self, user_ids):
+        """{user id: user dict} for the ids that have a current record; the rest are misses"""
+        now = time.time()
+        found = {}
+        asked = 0
+        for user_id in user_ids:
+            asked += 1
+            offset = self._offset(user_id)
+            sequence, cached_id, expires, username_length, email_length, username, email = RECORD.unpack_from(self._map, offset)
+            if sequence % 2 or cached_id != user_id or expires <= now:
+                continue
+            if SEQUENCE.unpack_from(self._map, offset)[0] != sequence:  # rewritten while we read it
+                continue
+            found[user_id] = {
+                'user_id': user_id,
+                'username': username[:username_length].decode(),
+                'email': email[:email_length].decode(),
+            }
+        with self._lock:
+            self.hits += len(found)
+            self.misses += asked - len(found)
+        return found
+
+    def put_many(self, users, generation: int, replica_lag: float = 0.0):
+        """Store (id, username, email) rows read while the cache was at `generation`; returns how many were stored.
+
+        Nothing is stored if an invalidation ran since, as the rows may be
+        from before that write, nor if the rows were read from a replica that
+        may trail the primary by `replica_lag` seconds and an invalidation ran
+        within that time.
+        """
+        now = time.time()
+        stored = 0
+        with self._locked_file():
+            if self.generation != generation or now - self.invalidated_at < replica_lag:
+                return 0
+            for user_id, username, email in users:
+                username, email = username.encode(), email.encode()
+                if len(username) > FIELD_BYTES or len(email) > FIELD_BYTES:
+                    self.oversize += 1
+                    continue
+                offset = self._offset(user_id)
+                sequence, cached_id, expires = SLOT_HEAD.unpack_from(self._map, offset)
+                if cached_id not in (0, user_id) and expires > now:
+                    self.evictions += 1
+                self._write(offset, sequence, user_id, now + self.ttl, username, email)
+                stored += 1
+            self.fills += stored
+        return stored
+
+    def invalidate(self, *user_ids):
+        """Forget the given users, in every process; call after the write commits"""
+        with self._locked_file():
+            self._bump_generation()
+            for user_id in user_ids:
+                offset = self._offset(user_id)
+                sequence, cached_id, _ = SLOT_HEAD.unpack_from(self._map, offset)
+                if cached_id == user_id:
+                    self._write(offset, sequence, 0, 0.0)
+            self.invalidations += len(user_ids)
+
+    def clear(self):
+        with self._locked_file():
+            self._bump_generation()
+            for offset in range(HEADER_SIZE, self.size, RECORD_SIZE):
+                sequence, cached_id, _ = SLOT_HEAD.unpack_from(self._map, offset)
+                if cached_id:
+                    self._write(offset, sequence, 0, 0.0)
+
+    def stats(self):
+        now = time.time()
+        entries = 0
+        for offset in range(HEADER_SIZE, self.size, RECORD_SIZE):
+            _, cached_id, expires = SLOT_HEAD.unpack_from(self._map, offset)
+            entries += bool(cached_id) and expires > now
+        with self._lock:
+            looked_up = self.hits + self.misses
+            return {
+                'entries': entries,
+                'slots': self.slots,
+                'bytes': self.size,
+                'ttl': self.ttl,
+                'shared_file': self.path,
+                'generation': self.generation,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / looked_up, 4) if looked_up else None,
+                'fills': self.fills,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'oversize': self.oversize,
+            }
+
+def get_user_cache():
+    """The app's UserRecordCache, or None when USER_CACHE_SLOTS is 0"""
+    return current_app.extensions.get('user_cache')
+
+def invalidate_users(*user_ids):
+    """Drop the users' cached records (if the cache is on); call after a successful commit"""
+    cache = get_user_cache()
+    if cache is not None:
+        cache.invalidate(*user_ids)
+
+def init_app(app):
+    if app.config['USER_CACHE_SLOTS'] <= 0:
+        return
+    app.extensions['user_cache'] = UserRecordCache(
+        app.config['USER_CACHE_SLOTS'],
+        app.config['USER_CACHE_TTL'],
+        app.config['USER_CACHE_PATH'],
+    )
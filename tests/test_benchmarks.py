@@ -0,0 +1,52 @@
+import json
+import threading
+from werkzeug.serving import make_server
+from benchmarks import datasets, endpoints, loadgen
+from src import create_app
+from src.models import db
+from tests.test_endpoints import app
+
+def test_every_route_has_a_benchmark_request(app):
+    # new routes in the tasks/users blueprints need a Route entry in benchmarks/endpoints.py
+    assert endpoints.uncovered_endpoints(app) == []
+
+def test_benchmark_smoke_run(tmp_path):
+    output = tmp_path / 'results.json'
+    status = endpoints.main([
+        '--tasks', '20', '--users', '5', '--logs-per-task', '1', '--iterations', '3',
+        '--pbkdf2-iterations', '1000', '--output', str(output), '--max-errors', '0'
+    ])
+    assert status == 0
+
+    results = json.loads(output.read_text())
+    assert results['meta']['dataset']['tasks'] == 20
+    assert results['routes']['GET tasks.show']['requests'] == 3
+    assert set(results['routes']['GET tasks.show']) >= {'p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps'}
+
+def test_loadgen_templates_from_insomnia_export():
+    templates = {t.key: t for t in loadgen.merge_templates(loadgen.load_insomnia('Insomnia_export.json'), ['GET /tasks=5'])}
+
+    assert 'PATCH /tasks/{task}/unassign_user/{user}' in templates
+    assert 'GET /users/{user}/tasks_assigned' in templates
+    assert templates['GET /tasks'].weight == 5
+    assert templates['POST /tasks'].body['title'] == 'New Task 8'
+
+def test_loadgen_replays_against_a_live_server(tmp_path):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "load.db"}', 'PASSWORD_PBKDF2_ITERATIONS': 1000})
+    with app.app_context():
+        db.create_all()
+        datasets.seed(datasets.DatasetSpec(tasks=20, users=5, logs_per_task=0))
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        output = tmp_path / 'load.json'
+        status = loadgen.main(['--url', f'http://127.0.0.1:{server.port}', '--duration', '1',
+                               '--concurrency', '2', '--output', str(output)])
+    finally:
+        server.shutdown()
+
+    assert status == 0
+    report = json.loads(output.read_text())['endpoints']
+    assert report['GET /tasks/{task}']['requests'] > 0
+    assert all(row['error_rate'] == 0 for row in report.values())
@@ -0,0 +1,61 @@
+from src.config import async_database_uri, async_engine_options, database_uri, engine_options, replica_binds
+
+POOL_SETTINGS = {
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 10,
+    'DB_POOL_TIMEOUT': 10,
+    'DB_POOL_RECYCLE': 1800,
+    'DB_POOL_PRE_PING': True,
+    'DB_STATEMENT_TIMEOUT_MS': 30_000,
+}
+
+def test_database_uri_fallbacks():
+    assert database_uri({'TESTING': True}) == 'sqlite:///test.db'
+    assert database_uri({}).startswith('postgresql://')
+    assert database_uri({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'}) == 'sqlite:///:memory:'
+
+def test_postgres_engine_options():
+    config = dict(POOL_SETTINGS, SQLALCHEMY_DATABASE_URI='postgresql://postgres@db/tasks',
+                  SQLALCHEMY_ENGINE_OPTIONS={'pool_size': 20})
+    options = engine_options(config)
+
+    # explicit engine options win over the DB_* settings
+    assert options['pool_size'] == 20
+    assert options['max_overflow'] == 10
+    assert options['pool_pre_ping'] is True
+    assert options['connect_args'] == {'options': '-c statement_timeout=30000'}
+
+def test_sqlite_engine_options_leave_pool_alone():
+    assert engine_options(dict(POOL_SETTINGS, SQLALCHEMY_DATABASE_URI='sqlite:///test.db')) == {}
+
+def test_async_database_uri_and_options():
+    config = dict(POOL_SETTINGS, SQLALCHEMY_DATABASE_URI='postgresql+psycopg2://postgres@db/tasks')
+    uri = async_database_uri(config)
+    assert uri == 'postgresql+asyncpg://postgres@db/tasks'
+    assert async_engine_options(config, uri)['connect_args'] == {'server_settings': {'statement_timeout': '30000'}}
+
+    assert async_database_uri({'SQLALCHEMY_DATABASE_URI': 'sqlite:////tmp/tasks.db'}) == 'sqlite+aiosqlite:////tmp/tasks.db'
+    assert async_database_uri({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'ASYNC_DATABASE_URI': 'sqlite+aiosqlite:///x.db'}) \
+        == 'sqlite+aiosqlite:///x.db'
+
+def test_replica_binds_share_the_pool_settings():
+    config = dict(POOL_SETTINGS, DATABASE_REPLICA_URIS=['postgresql://reader@replica-1/tasks', 'sqlite:////tmp/replica.db'])
+    binds = replica_binds(config)
+    assert list(binds) == ['replica_0', 'replica_1']
+    assert binds['replica_0']['url'] == 'postgresql://reader@replica-1/tasks' and binds['replica_0']['pool_size'] == 5
+    assert binds['replica_1'] == {'url': 'sqlite:////tmp/replica.db'}
+    assert replica_binds(POOL_SETTINGS) == {}
+
+def test_async_database_uri_resolves_relative_sqlite_paths_like_flask_sqlalchemy():
+    from src import create_app
+    from src.aio import AsyncReadApp
+    from src.models import db
+    assert async_database_uri({'SQLALCHEMY_DATABASE_URI': 'sqlite:///tasks.db'}, '/srv/instance') \
+        == 'sqlite+aiosqlite:////srv/instance/tasks.db'
+    assert async_database_uri({'SQLALCHEMY_DATABASE_URI': 'sqlite:////tmp/tasks.db'}, '/srv/instance') \
+        == 'sqlite+aiosqlite:////tmp/tasks.db'
+
+    # both engines open the same file (neither connects here)
+    app = create_app(test_config={'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///relative.db'})
+    with app.app_context():
+        assert AsyncReadApp(app).engine.url.database == db.engine.url.database == f'{app.instance_path}/relative.db'
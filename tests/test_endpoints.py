@@ -1,12 +1,23 @@
+import contextlib
+import json
+import multiprocessing
 import pytest
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import update
 from src import create_app
-from src.models import db, Task, User
+from src.admission import TokenBuckets
+from src.models import db, Task, User, assignees_table, task_events, task_progress_table, task_status_durations, task_status_state
+from src.instrumentation import capture_queries
+from src.passwords import get_hasher, make_hash
+from src.user_cache import UserRecordCache
 
 @pytest.fixture
 def app():
     """Create and configure a new Flask app instance for testing."""
-    app = create_app(test_config={'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+    app = create_app(test_config={'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:', 'PASSWORD_PBKDF2_ITERATIONS': 1000,
+                                  'TASK_LOG_FLUSH_INTERVAL': 0})
     with app.app_context():
         db.create_all()
         yield app
@@ -18,6 +29,16 @@ def client(app):
     """A test client for the app."""
     return app.test_client()
 
+@pytest.fixture
+def max_queries(app):
+    """Context manager factory failing the test if the block runs more than `limit` SQL statements."""
+    @contextlib.contextmanager
+    def check(limit):
+        with capture_queries(db.engines.values()) as statements:
+            yield statements
+        assert len(statements) <= limit, f"{len(statements)} queries (max {limit}):\n" + "\n".join(statements)
+    return check
+
 def test_task_index_endpoint(client):
     """Test the index endpoint."""
     # Insert some dummy data into the database
@@ -105,8 +126,36 @@ def test_update_task(client):
     # Send a PATCH request to update the task
     response = client.patch(f'/tasks/{task.id}', json=updated_task_data)
 
-    # Check if the response status code is 500 (Internal Server Error)
-    assert response.status_code == 500
+    # The ISO datetime deadline is coerced to its date before it is written
+    assert response.status_code == 200
+    assert response.json['title'] == 'Updated Test Task'
+    assert response.json['deadline'] == datetime.now().strftime('%a, %d %b %Y 00:00:00 GMT')
+    assert response.headers['ETag'].startswith('"2-')
+
+def test_update_if_match_and_validation(client, max_queries):
+    user = User(username='editor', email='editor@example.com', password='pw')
+    db.session.add(user)
+    db.session.add(Task(title="Edited", description="Twice", deadline=datetime.now(), status="pending", created_by_user=1))
+    db.session.commit()
+    db.session.expire_all()
+
+    etag = client.get('/tasks/1').headers['ETag']
+    # UPDATE ... RETURNING and the assignees, plus the change event and, for app-side task_logs, the old status and the log row
+    with max_queries(5):
+        first = client.patch('/tasks/1', json={'title': 'Edited', 'status': 'review'}, headers={'If-Match': etag})
+    assert first.status_code == 200 and first.json['status'] == 'review'
+    # the second editor's copy is stale; the one from the first response is current
+    assert client.patch('/tasks/1', json={'title': 'Edited again'}, headers={'If-Match': etag}).status_code == 412
+    assert client.patch('/tasks/1', json={'title': 'Edited again'}, headers={'If-Match': first.headers['ETag']}).status_code == 200
+    assert client.get('/tasks/1').json['title'] == 'Edited again'
+    assert client.patch('/tasks/9', json={'title': 'Missing'}, headers={'If-Match': etag}).status_code == 404
+    assert client.patch('/tasks/1', json={'title': 'Edited', 'deadline': 'soon'}).status_code == 400
+    assert client.patch('/tasks/1', json={'title': ''}).status_code == 400
+
+    etag = client.get('/users/1').headers['ETag']
+    assert client.patch('/users/1', json={'username': 'editor', 'email': 'new@example.com'}, headers={'If-Match': etag}).json['email'] == 'new@example.com'
+    assert client.patch('/users/1', json={'username': 'editor', 'email': 'old@example.com'}, headers={'If-Match': etag}).status_code == 412
+    assert client.get('/users/1').json['email'] == 'new@example.com'
 
 def test_update_task_invalid_id(client):
     # Prepare JSON data for updating a task
@@ -141,3 +190,1076 @@ def test_update_task_missing_title(client):
 
     # Check if the response status code is 400 (Bad Request)
     assert response.status_code == 400
+
+def test_task_index_pagination(client):
+    # Create more tasks than fit on one page
+    for i in range(3):
+        db.session.add(Task(title=f"Task {i}", description="Paged", deadline=datetime.now(), status="Incomplete", created_by_user=1))
+    db.session.commit()
+
+    # First page holds two tasks and a cursor for the next one
+    response = client.get('/tasks?limit=2')
+    assert response.status_code == 200
+    assert [t['title'] for t in response.json['tasks']] == ['Task 0', 'Task 1']
+    assert response.json['next_cursor'] is not None
+
+    # Following the cursor returns the remaining task and no further cursor
+    response = client.get(f"/tasks?limit=2&after={response.json['next_cursor']}")
+    assert [t['title'] for t in response.json['tasks']] == ['Task 2']
+    assert response.json['next_cursor'] is None
+
+def test_index_invalid_page_args(client):
+    assert client.get('/tasks?limit=0').status_code == 400
+    assert client.get('/users?limit=abc').status_code == 400
+    assert client.get('/users?after=not-a-cursor').status_code == 400
+
+def test_export_tasks_ndjson(client):
+    user = User(username='test_user', email='test@example.com', password='test_password')
+    db.session.add(user)
+    db.session.commit()
+    for i in range(3):
+        task = Task(title=f"Task {i}", description="Exported", deadline=datetime.now(), status="Incomplete", created_by_user=user.id)
+        task.assignees.append(user)
+        db.session.add(task)
+    db.session.commit()
+
+    response = client.get('/tasks/export')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+
+    # One JSON document per line, each carrying its assignees
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [t['title'] for t in lines] == ['Task 0', 'Task 1', 'Task 2']
+    assert all(t['assigned_users'][0]['username'] == 'test_user' for t in lines)
+
+    response = client.get('/users/export')
+    assert [json.loads(line)['username'] for line in response.get_data(as_text=True).splitlines()] == ['test_user']
+
+def test_cli_import_export_users(app, tmp_path):
+    # The second row clashes with the first on username and email
+    source = tmp_path / 'users.csv'
+    source.write_text(
+        'username,email,password\n'
+        'alice,alice@example.com,hash1\n'
+        'alice,alice@example.com,hash2\n'
+        'bob,bob@example.com,hash3\n'
+    )
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(args=['data', 'import', 'users', str(source), '--on-conflict', 'skip', '--batch-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert '2 rows written, 1 skipped' in result.output
+    assert [u.username for u in User.query.order_by(User.id)] == ['alice', 'bob']
+
+    target = tmp_path / 'users.jsonl'
+    result = runner.invoke(args=['data', 'export', 'users', str(target)])
+    assert result.exit_code == 0, result.output
+    rows = [json.loads(line) for line in target.read_text().splitlines()]
+    assert [r['email'] for r in rows] == ['alice@example.com', 'bob@example.com']
+
+    # re-importing the export (with its version column) updates rows under a new version, never an old one
+    source.write_text(''.join(json.dumps(dict(r, email=r['email'].replace('@', '@new.'))) + '\n' for r in rows))
+    result = runner.invoke(args=['data', 'import', 'users', str(source), '--format', 'jsonl', '--on-conflict', 'update'])
+    assert result.exit_code == 0, result.output
+    assert [(u.email, u.version) for u in User.query.order_by(User.id)] == [('alice@new.example.com', 2), ('bob@new.example.com', 2)]
+
+def test_cli_import_records_change_events(app, client, tmp_path):
+    db.session.add(User(username='owner', email='owner@example.com', password='pw'))
+    db.session.commit()
+    runner = app.test_cli_runner()
+    tasks, assignments = tmp_path / 'tasks.csv', tmp_path / 'task_assignees.csv'
+
+    def load(table_name, path, text):
+        path.write_text(text)
+        result = runner.invoke(args=['data', 'import', table_name, str(path), '--on-conflict', 'update'])
+        assert result.exit_code == 0, result.output
+
+    load('tasks', tasks, 'title,description,status,created_by_user\nFirst,One,pending,1\nSecond,Two,pending,1\n')
+    load('task_assignees', assignments, 'task_id,user_id\n1,1\n')
+    load('tasks', tasks, 'title,description,status,created_by_user\nSecond,Two again,review,1\nThird,Three,pending,1\n')
+    load('task_assignees', assignments, 'task_id,user_id\n1,1\n')  # already there: no change to report
+
+    events = _sse_events(client.get('/tasks/changes?after=0&timeout=0').get_data(as_text=True))
+    assert [(e['event'], json.loads(e['data'])['task_id'], json.loads(e['data'])['user_id']) for e in events] == [
+        ('create', 1, None), ('create', 2, None), ('assign', 1, 1), ('update', 2, None), ('create', 3, None)]
+    delta = client.get('/tasks?since=0').json
+    assert [(t['task_id'], t['status']) for t in delta['tasks']] == [(1, 'pending'), (2, 'review'), (3, 'pending')]
+    assert delta['version'] == int(events[-1]['id'])
+    assert [t['task_id'] for t in client.get('/users/1/tasks_assigned?since=0').json['tasks']] == [1]
+
+def test_cli_import_conflict_modes(app, tmp_path):
+    # the file has no id or version column: the database fills them in
+    source = tmp_path / 'users.csv'
+    runner = app.test_cli_runner()
+
+    def load(on_conflict, *rows):
+        source.write_text('username,email,password\n' + ''.join(f'{name},{name}@{domain},hash\n' for name, domain in rows))
+        return runner.invoke(args=['data', 'import', 'users', str(source), '--on-conflict', on_conflict])
+
+    def users():
+        return [(u.id, u.username, u.email, u.version) for u in User.query.order_by(User.id)]
+
+    assert load('error', ('alice', 'example.com'), ('bob', 'example.com')).exit_code == 0
+    assert users() == [(1, 'alice', 'alice@example.com', 1), (2, 'bob', 'bob@example.com', 1)]
+
+    result = load('error', ('carol', 'example.com'), ('alice', 'new.example.com'))
+    assert result.exit_code != 0
+    db.session.expire_all()
+    assert users() == [(1, 'alice', 'alice@example.com', 1), (2, 'bob', 'bob@example.com', 1)]  # all or nothing
+
+    result = load('skip', ('carol', 'example.com'), ('alice', 'new.example.com'))
+    assert result.exit_code == 0, result.output
+    assert '1 rows written, 1 skipped' in result.output
+    db.session.expire_all()
+    assert users() == [(1, 'alice', 'alice@example.com', 1), (2, 'bob', 'bob@example.com', 1), (3, 'carol', 'carol@example.com', 1)]
+
+    result = load('update', ('alice', 'new.example.com'), ('dave', 'example.com'))
+    assert result.exit_code == 0, result.output
+    db.session.expire_all()
+    assert users() == [(1, 'alice', 'alice@new.example.com', 2), (2, 'bob', 'bob@example.com', 1),
+                       (3, 'carol', 'carol@example.com', 1), (4, 'dave', 'dave@example.com', 1)]
+
+def test_bulk_assign_and_unassign_users(client):
+    users = [User(username=f'user{i}', email=f'user{i}@example.com', password='pw') for i in range(3)]
+    db.session.add_all(users)
+    db.session.commit()
+    task = Task(title="Team Task", description="Bulk", deadline=datetime.now(), status="Incomplete", created_by_user=users[0].id)
+    task.assignees.append(users[0])
+    db.session.add(task)
+    db.session.commit()
+    ids = [u.id for u in users]
+
+    # users[0] is already assigned and 999 does not exist
+    response = client.post(f'/tasks/{task.id}/assignees', json={'user_ids': ids + [999]})
+    assert response.status_code == 200
+    assert [r['result'] for r in response.json['results']] == ['already_assigned', 'assigned', 'assigned', 'not_found']
+    assert sorted(u['user_id'] for u in client.get(f'/tasks/{task.id}').json['assigned_users']) == ids
+
+    response = client.delete(f'/tasks/{task.id}/assignees', json={'user_ids': ids[:2]})
+    assert [r['result'] for r in response.json['results']] == ['unassigned', 'unassigned']
+    assert [u['user_id'] for u in client.get(f'/tasks/{task.id}').json['assigned_users']] == [ids[2]]
+
+    assert client.post(f'/tasks/{task.id}/assignees', json={'user_ids': 'all'}).status_code == 400
+    assert client.post('/tasks/999/assignees', json={'user_ids': ids}).status_code == 404
+
+def test_bulk_assign_skips_pairs_a_concurrent_request_inserted(client, monkeypatch):
+    import src.models
+    users = [User(username=f'user{i}', email=f'user{i}@example.com', password='pw') for i in range(2)]
+    db.session.add_all(users)
+    task = Task(title="Raced", description="Bulk", deadline=datetime.now(), status="Incomplete", created_by_user=1)
+    task.assignees.append(users[0])
+    db.session.add(task)
+    db.session.commit()
+
+    # both pairs looked free when read, but another request committed the first one before our INSERT ran
+    monkeypatch.setattr(src.models, '_assignment_state', lambda *args: {users[0].id: False, users[1].id: False})
+    response = client.post(f'/tasks/{task.id}/assignees', json={'user_ids': [users[0].id, users[1].id]})
+    assert response.status_code == 200
+    assert [r['result'] for r in response.json['results']] == ['already_assigned', 'assigned']
+    changes = _sse_events(client.get('/tasks/changes?after=0&timeout=0').get_data(as_text=True))
+    assert [(e['event'], json.loads(e['data'])['user_id']) for e in changes] == [('assign', users[1].id)]
+
+def test_bulk_assign_tasks_to_user(client):
+    user = User(username='test_user', email='test@example.com', password='pw')
+    db.session.add(user)
+    db.session.commit()
+    tasks = [Task(title=f"Task {i}", description="Bulk", deadline=datetime.now(), status="Incomplete", created_by_user=user.id) for i in range(2)]
+    db.session.add_all(tasks)
+    db.session.commit()
+
+    response = client.post(f'/users/{user.id}/tasks_assigned', json={'task_ids': [t.id for t in tasks]})
+    assert [r['result'] for r in response.json['results']] == ['assigned', 'assigned']
+    assert len(client.get(f'/users/{user.id}/tasks_assigned').json) == 2
+
+def test_task_show_etag_and_invalidation(client):
+    user = User(username='test_user', email='test@example.com', password='pw')
+    db.session.add(user)
+    db.session.commit()
+    task = Task(title="Cached Task", description="Polled", deadline=datetime.now(), status="Incomplete", created_by_user=user.id)
+    db.session.add(task)
+    db.session.commit()
+
+    first = client.get(f'/tasks/{task.id}')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+
+    # An unchanged task answers 304 straight from the cache
+    response = client.get(f'/tasks/{task.id}', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert client.get('/stats/cache').json['hits'] == 1
+
+    # Assigning a user invalidates the cached task, so the ETag changes
+    client.post(f'/tasks/{task.id}/assign_to/{user.id}')
+    response = client.get(f'/tasks/{task.id}', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.json['assigned_users'][0]['username'] == 'test_user'
+
+def test_create_user_password_is_verifiable(client):
+    response = client.post('/users', json={'username': 'test_user', 'email': 'test@example.com', 'password': 'secret'})
+    assert response.status_code == 200
+
+    user = db.session.get(User, response.json['user_id'])
+    assert user.password.startswith('pbkdf2_sha256$1000$')
+    assert client.post('/users/verify', json={'username': 'test_user', 'password': 'secret'}).json == user.serialize()
+    assert client.post('/users/verify', json={'username': 'test_user', 'password': 'wrong'}).status_code == 401
+    assert client.post('/users/verify', json={'username': 'nobody', 'password': 'secret'}).status_code == 401
+    assert client.post('/users/verify', json={'username': 'test_user'}).status_code == 400
+
+def test_verify_upgrades_outdated_hash(client):
+    # A hash made with a cheaper cost than the configured one is replaced on the next successful check
+    user = User(username='test_user', email='test@example.com', password=make_hash('secret', 'pbkdf2_sha256', (10,)))
+    db.session.add(user)
+    db.session.commit()
+    etag = client.get(f'/users/{user.id}').headers['ETag']
+
+    assert client.post('/users/verify', json={'username': 'test_user', 'password': 'wrong'}).status_code == 401
+    db.session.refresh(user)
+    assert user.password.startswith('pbkdf2_sha256$10$')  # a failed check leaves the hash alone
+
+    assert client.post('/users/verify', json={'username': 'test_user', 'password': 'secret'}).status_code == 200
+    db.session.refresh(user)
+    assert user.password.startswith('pbkdf2_sha256$1000$')
+    assert client.get(f'/users/{user.id}').headers['ETag'] != etag  # the new version is not served from the cache
+    assert client.post('/users/verify', json={'username': 'test_user', 'password': 'secret'}).status_code == 200
+
+def test_slow_password_hash_answers_503(app, client, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr('src.passwords.make_hash', lambda *args: release.wait(5) and 'never stored')
+    hasher = get_hasher()
+    hasher.timeout = 0.01
+
+    response = client.post('/users', json={'username': 'slow', 'email': 'slow@example.com', 'password': 'secret'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert response.json['message'] == 'Password hashing timed out'
+    assert db.session.query(User).count() == 0
+
+    # the running hash keeps its slot until it finishes, then hands it back
+    release.set()
+    hasher.shutdown()
+    assert hasher._slots._value == hasher.workers + app.config['PASSWORD_HASH_QUEUE_LIMIT']
+
+def test_task_endpoints_query_counts(client, max_queries):
+    users = [User(username=f'user{i}', email=f'user{i}@example.com', password='pw') for i in range(3)]
+    db.session.add_all(users)
+    for i in range(5):
+        task = Task(title=f"Task {i}", description="Counted", deadline=datetime.now(), status="Incomplete", created_by_user=1)
+        task.assignees.extend(users)
+        db.session.add(task)
+    db.session.commit()
+    db.session.expire_all()
+
+    # one query for the page and one batched query for all of its assignees, however many tasks there are;
+    # the first time, one more loads the users into the shared user cache
+    with max_queries(3):
+        response = client.get('/tasks')
+    assert len(response.json['tasks']) == 5
+
+    with max_queries(2) as statements:
+        client.get('/tasks/1')
+    assert not any('FROM users' in statement for statement in statements)
+
+def test_list_projection_matches_orm_serialize(app, client):
+    from flask import jsonify
+    users = [User(username=f'user{i}', email=f'user{i}@example.com', password='pw') for i in range(3)]
+    db.session.add_all(users)
+    db.session.commit()
+    for i in range(4):
+        task = Task(title=f"Task {i}", description=None if i == 2 else "Projected", deadline=datetime(2024, 2, 1 + i) if i else None,
+                    status="Incomplete", created_by_user=users[0].id)
+        task.assignees.extend(reversed(users[:i]))  # assignees come out ordered by id either way
+        db.session.add(task)
+    db.session.commit()
+    db.session.expire_all()
+
+    orm = jsonify({'tasks': [t.serialize() for t in Task.query.order_by(Task.id)], 'next_cursor': None}).get_data()
+    assert client.get('/tasks').get_data() == orm
+    orm = jsonify({'users': [u.serialize() for u in User.query.order_by(User.id)], 'next_cursor': None}).get_data()
+    assert client.get('/users').get_data() == orm
+    orm = ''.join(app.json.dumps(t.serialize()) + '\n' for t in Task.query.order_by(Task.id)).encode()
+    assert client.get('/tasks/export').get_data() == orm
+
+def test_server_timing_header(client):
+    response = client.get('/users')
+    assert response.status_code == 200
+    assert response.headers['Server-Timing'].startswith('db;dur=')
+    assert 'queries' in response.headers['Server-Timing']
+
+def test_server_timing_survives_failed_statements(app, client):
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+
+    # a test-only view whose first statement fails
+    @app.route('/failing_statement')
+    def failing_statement():
+        with pytest.raises(OperationalError):
+            db.session.execute(text('SELECT * FROM no_such_table'))
+        db.session.rollback()
+        db.session.execute(text('SELECT 1'))
+        return {'connection_info': sorted(db.session.connection().info)}
+
+    response = client.get('/failing_statement')
+    assert response.json == {'connection_info': []}  # no start times left behind on the connection
+    assert 'desc="1 queries"' in response.headers['Server-Timing']
+
+def test_n_plus_one_detector_flags_repeated_statements(app, client, caplog):
+    app.config['SQL_DETECT_N_PLUS_ONE'] = True
+    user = User(username='test_user', email='test@example.com', password='pw')
+    db.session.add(user)
+    for i in range(5):
+        task = Task(title=f"Task {i}", description="Fan-out", deadline=datetime.now(), status="Incomplete", created_by_user=1)
+        task.assignees.append(user)
+        db.session.add(task)
+    db.session.commit()
+    db.session.expire_all()
+
+    # a test-only view that lazy-loads the assignees of each task separately
+    @app.route('/n_plus_one')
+    def n_plus_one():
+        return {'tasks': [[u.id for u in task.assignees] for task in Task.query.all()]}
+
+    with caplog.at_level('WARNING', logger='src.instrumentation'):
+        client.get(f'/users/{user.id}/tasks_assigned')  # batched: nothing to flag
+        assert not any('Possible N+1' in message for message in caplog.messages)
+        client.get('/n_plus_one')
+    assert any('Possible N+1' in message for message in caplog.messages)
+
+def test_task_index_filters_and_sort(client):
+    user = User(username='test_user', email='test@example.com', password='pw')
+    db.session.add(user)
+    db.session.commit()
+    deadlines = [datetime(2024, 3, 1), None, datetime(2024, 1, 1), datetime(2024, 2, 1), None]
+    statuses = ['pending', 'pending', 'completed', 'review', 'pending']
+    for i, (deadline, status) in enumerate(zip(deadlines, statuses)):
+        task = Task(title=f"Task {i}", description="Filtered", deadline=deadline, status=status, created_by_user=user.id)
+        if i % 2 == 0:
+            task.assignees.append(user)
+        db.session.add(task)
+    db.session.commit()
+
+    def titles(url):
+        return [t['title'] for t in client.get(url).json['tasks']]
+
+    assert titles('/tasks?status=pending,review') == ['Task 0', 'Task 1', 'Task 3', 'Task 4']
+    assert titles('/tasks?deadline_from=2024-01-15&deadline_to=2024-03-01') == ['Task 0', 'Task 3']
+    assert titles(f'/tasks?assignee={user.id}&status=pending') == ['Task 0', 'Task 4']
+
+    # Walk a descending deadline sort one row at a time: NULL deadlines come first, ties ordered by id
+    seen, cursor = [], None
+    while True:
+        url = '/tasks?sort=-deadline&limit=1' + (f'&after={cursor}' if cursor else '')
+        page = client.get(url).json
+        seen.extend(t['title'] for t in page['tasks'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert seen == ['Task 4', 'Task 1', 'Task 0', 'Task 3', 'Task 2']
+
+def test_task_index_invalid_filters(client):
+    assert client.get('/tasks?sort=priority').status_code == 400
+    assert client.get('/tasks?deadline_from=tomorrow').status_code == 400
+    assert client.get('/tasks?assignee=me').status_code == 400
+
+def test_task_summary_counts_and_invalidation(client):
+    users = [User(username=f'user{i}', email=f'user{i}@example.com', password='pw') for i in range(2)]
+    db.session.add_all(users)
+    db.session.commit()
+    past, future = datetime(2000, 1, 1), datetime(2100, 1, 1)
+    for i, (status, deadline, assignees) in enumerate([('pending', past, users), ('pending', future, users[:1]),
+                                                       ('completed', past, users[1:]), (None, past, [])]):
+        task = Task(title=f"Counted {i}", description="Summary", deadline=deadline, status=status, created_by_user=users[0].id)
+        task.assignees.extend(assignees)
+        db.session.add(task)
+    db.session.commit()
+
+    body = client.get('/tasks/summary').json
+    assert body['total'] == {'tasks': 4, 'open': 3, 'overdue': 2}
+    assert body['by_status'] == [{'status': 'completed', 'tasks': 1, 'open': 0, 'overdue': 0},
+                                 {'status': 'pending', 'tasks': 2, 'open': 2, 'overdue': 1},
+                                 {'status': None, 'tasks': 1, 'open': 1, 'overdue': 1}]
+    assert body['by_creator'] == [{'created_by_user': 1, 'tasks': 4, 'open': 3, 'overdue': 2}]
+    assert body['by_assignee'] == [{'user_id': 1, 'tasks': 2, 'open': 2, 'overdue': 1},
+                                   {'user_id': 2, 'tasks': 2, 'open': 1, 'overdue': 1}]
+    assert client.get('/tasks/summary?assignee=2').json['total'] == {'tasks': 2, 'open': 1, 'overdue': 1}
+
+    # served from the cache until a write in either blueprint changes the counts
+    etag = client.get('/tasks/summary').headers['ETag']
+    assert client.get('/tasks/summary', headers={'If-None-Match': etag}).status_code == 304
+    client.patch('/tasks/1', json={'title': 'Counted 0', 'status': 'completed'})
+    assert client.get('/tasks/summary').json['total'] == {'tasks': 4, 'open': 2, 'overdue': 1}
+    client.delete('/users/2/tasks_assigned', json={'task_ids': [1, 3]})
+    assert client.get('/tasks/summary').json['by_assignee'] == [{'user_id': 1, 'tasks': 2, 'open': 1, 'overdue': 0}]
+
+def test_search_tasks(client, monkeypatch):
+    user = User(username='test_user', email='test@example.com', password='test_password')
+    db.session.add(user)
+    db.session.commit()
+    for title, description in [('Fix login bug', 'Users cannot log in after the password reset'),
+                               ('Write report', 'Quarterly report about the login service'),
+                               ('Plan offsite', 'Book a venue')]:
+        client.post('/tasks', json={'created_by_user': user.id, 'title': title, 'description': description,
+                                    'deadline': '2024-05-01', 'status': 'pending'})
+
+    # title matches outrank description matches
+    response = client.get('/tasks/search?q=login&snippet=1')
+    assert response.status_code == 200
+    results = response.json['results']
+    assert [r['task']['title'] for r in results] == ['Fix login bug', 'Write report']
+    assert '<mark>login</mark>' in results[0]['snippet']
+
+    # paging follows the rank order
+    page = client.get('/tasks/search?q=login&limit=1').json
+    assert [r['task']['title'] for r in page['results']] == ['Fix login bug']
+    page = client.get(f"/tasks/search?q=login&limit=1&after={page['next_cursor']}").json
+    assert [r['task']['title'] for r in page['results']] == ['Write report']
+
+    # the index follows deletes
+    task_id = results[0]['task']['task_id']
+    client.delete(f'/tasks/{task_id}')
+    assert [r['task']['title'] for r in client.get('/tasks/search?q=login').json['results']] == ['Write report']
+
+    # a task deleted between the match query and the task read is left out
+    monkeypatch.setattr('src.api.tasks.search_task_ids', lambda *args: [(task_id, 1.0), (results[1]['task']['task_id'], 0.5)])
+    response = client.get('/tasks/search?q=login&snippet=1')
+    assert response.status_code == 200
+    assert [r['task']['title'] for r in response.json['results']] == ['Write report']
+    monkeypatch.undo()
+
+    assert client.get('/tasks/search?q=').status_code == 400
+
+def test_search_pages_through_tied_scores(client):
+    user = User(username='test_user', email='test@example.com', password='test_password')
+    db.session.add(user)
+    db.session.commit()
+    for i in range(5):  # same length and words: every match has the same score
+        client.post('/tasks', json={'created_by_user': user.id, 'title': f'Login task {i}', 'description': 'Same text',
+                                    'deadline': '2024-05-01', 'status': 'pending'})
+    for title, description in [('Login login', 'Same text'), ('Other task', 'Mentions login')]:  # a better and a worse match
+        client.post('/tasks', json={'created_by_user': user.id, 'title': title, 'description': description,
+                                    'deadline': '2024-05-01', 'status': 'pending'})
+    ranks = [r['rank'] for r in client.get('/tasks/search?q=login').json['results']]
+    assert ranks[0] > ranks[1] == ranks[5] > ranks[6]
+
+    # page boundaries fall inside the tie: every match comes back once, best first, ties by id
+    seen, cursor = [], None
+    while True:
+        page = client.get('/tasks/search?q=login&limit=2' + (f'&after={cursor}' if cursor else '')).json
+        seen += [r['task']['task_id'] for r in page['results']]
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert seen == [6, 1, 2, 3, 4, 5, 7]
+
+def test_status_rollups_timeline_and_estimates(app, client):
+    app.config['ROLLUP_REFRESH_INTERVAL'] = 0  # refresh on every read
+    user = User(username='test_user', email='test@example.com', password='test_password')
+    db.session.add(user)
+    db.session.commit()
+    # no status, so the app-side writer logs nothing and the log rows below are the whole history
+    a, b, c = (Task(title=f"Task {n}", description="Timed", deadline=None, status=None, created_by_user=user.id)
+               for n in 'abc')
+    a.assignees.append(user)
+    db.session.add_all([a, b, c])
+    db.session.commit()
+
+    t0, now = datetime(2024, 1, 1), datetime.utcnow()
+    def log(*rows):
+        db.session.execute(task_progress_table.insert(), [
+            {'task_id': task.id, 'status': status, 'timestamp': ts} for task, status, ts in rows
+        ])
+        db.session.commit()
+
+    # The rollups are refreshed between the two halves of the log and must come out as if read at once
+    log((a, 'pending', t0), (a, 'in_progress', t0 + timedelta(hours=1)), (b, 'pending', t0))
+    assert client.get('/tasks/stats/durations').json['groups'] == [
+        {'status': 'pending', 'tasks': 1, 'visits': 1, 'total_seconds': 3600.0, 'mean_seconds': 3600.0,
+         'p50_seconds': 3600.0, 'p90_seconds': 3600.0}
+    ]
+    log((a, 'completed', t0 + timedelta(hours=3)), (b, 'completed', t0 + timedelta(hours=5)),
+        (c, 'pending', now - timedelta(hours=2)))
+
+    groups = {g['status']: g for g in client.get('/tasks/stats/durations').json['groups']}
+    assert groups['pending']['tasks'] == 2
+    assert groups['pending']['total_seconds'] == 6 * 3600
+    assert groups['pending']['p50_seconds'] == 3 * 3600  # halfway between 1h and 5h
+    assert groups['in_progress']['total_seconds'] == 2 * 3600
+
+    by_user = client.get(f'/tasks/stats/durations?group_by=user,period&user={user.id}').json['groups']
+    assert [(g['user'], g['period'], g['total_seconds']) for g in by_user] == [(user.id, '2024-01-01', 3 * 3600.0)]
+
+    timeline = client.get(f'/tasks/{a.id}/timeline').json
+    assert [i['status'] for i in timeline['intervals']] == ['pending', 'in_progress', 'completed']
+    assert timeline['time_in_status']['in_progress'] == 2 * 3600
+    assert timeline['estimate'] is None
+
+    # c has been open 2h; the tasks that took longer than that finished after 3h and 5h
+    estimate = client.get(f'/tasks/{c.id}/timeline').json['estimate']
+    assert estimate['based_on'] == 2
+    assert abs(estimate['remaining_seconds']['p50'] - 2 * 3600) < 60
+
+    assert client.get('/tasks/stats/durations?group_by=colour').status_code == 400
+    assert client.get('/tasks/999/timeline').status_code == 404
+
+def test_rollups_stop_before_unsettled_log_rows(app):
+    from src.rollups import refresh
+    db.session.add(User(username='owner', email='owner@example.com', password='pw'))
+    db.session.add(Task(title='Logged', description='Horizon', deadline=None, status=None, created_by_user=1))
+    db.session.commit()
+    t0 = datetime(2024, 1, 1)
+    db.session.execute(task_progress_table.insert(), [
+        {'task_id': 1, 'status': status, 'timestamp': t0 + timedelta(hours=n)}
+        for n, status in enumerate(['pending', 'in_progress', 'completed'])
+    ])
+    # row 3 as a Postgres refresher sees it while an older transaction that may hold a lower id is running
+    db.session.execute(update(task_progress_table).where(task_progress_table.c.id == 3).values(horizon=1))
+    db.session.commit()
+
+    def durations():
+        return {row.status: round(row.seconds) for row in db.session.execute(task_status_durations.select())}
+
+    refresh()
+    assert durations() == {'pending': 3600}  # in_progress is still open: row 3 was not folded in
+    db.session.execute(update(task_progress_table).where(task_progress_table.c.id == 3).values(horizon=None))
+    db.session.commit()
+    refresh()
+    assert durations() == {'pending': 3600, 'in_progress': 3600}
+
+def test_duration_and_completion_percentiles_over_a_known_dataset(app, client):
+    from src.rollups import completion_percentiles
+    app.config['ROLLUP_REFRESH_INTERVAL'] = -1  # read the rollup rows below as they are
+    db.session.add(User(username='owner', email='owner@example.com', password='pw'))
+    db.session.add_all(Task(title=f'Task {i}', description='Known', deadline=None, status=None, created_by_user=1)
+                       for i in range(5))
+    db.session.commit()
+    jan, feb = datetime(2024, 1, 1).date(), datetime(2024, 2, 1).date()
+    # per-task pending totals 10, 20, 30, 40 and 100 seconds; task 5's is split over two months
+    db.session.execute(task_status_durations.insert(), [
+        {'task_id': t, 'status': 'pending', 'period': jan, 'seconds': sec, 'visits': 1}
+        for t, sec in [(1, 10.0), (2, 20.0), (3, 30.0), (4, 40.0), (5, 60.0)]
+    ] + [{'task_id': 5, 'status': 'pending', 'period': feb, 'seconds': 40.0, 'visits': 1},
+         {'task_id': 1, 'status': 'review', 'period': jan, 'seconds': 7.0, 'visits': 2}])
+    db.session.execute(task_status_state.insert(), [
+        {'task_id': t, 'status': 'completed', 'entered_at': datetime(2024, 3, 1), 'first_logged_at': datetime(2024, 1, 1),
+         'completed_at': datetime(2024, 3, 1), 'completion_seconds': sec}
+        for t, sec in [(1, 100.0), (2, 200.0), (3, 300.0), (4, 400.0)]
+    ])
+    db.session.commit()
+
+    groups = client.get('/tasks/stats/durations').json['groups']
+    assert groups == [
+        {'status': 'pending', 'tasks': 5, 'visits': 6, 'total_seconds': 200.0, 'mean_seconds': 40.0,
+         'p50_seconds': 30.0, 'p90_seconds': 76.0},  # 40 + 0.6 * (100 - 40)
+        {'status': 'review', 'tasks': 1, 'visits': 2, 'total_seconds': 7.0, 'mean_seconds': 7.0,
+         'p50_seconds': 7.0, 'p90_seconds': 7.0},
+    ]
+    by_period = client.get('/tasks/stats/durations?group_by=period&status=pending').json['groups']
+    assert [(g['period'], g['tasks'], g['p50_seconds']) for g in by_period] == [('2024-01-01', 5, 30.0), ('2024-02-01', 1, 40.0)]
+
+    # completions slower than 150s: 200, 300 and 400
+    assert completion_percentiles(150.0, (50, 90)) == (3, {50: 300.0, 90: 380.0})
+    assert completion_percentiles(400.0, (50, 90)) == (0, {})
+
+def test_app_side_task_log_writer(app, client):
+    user = User(username='test_user', email='test@example.com', password='test_password')
+    db.session.add(user)
+    db.session.commit()
+    writer = app.extensions['task_log_writer']
+    writer.flush_interval, writer.batch_size = 60, 3  # buffer until three changes are waiting
+
+    def logged():
+        return [(row.task_id, row.status) for row in db.session.execute(
+            task_progress_table.select().order_by(task_progress_table.c.id))]
+
+    task_id = client.post('/tasks', json={'created_by_user': user.id, 'title': 'Logged', 'description': 'x',
+                                          'deadline': '2024-05-01', 'status': 'pending'}).json['task_id']
+    client.patch(f'/tasks/{task_id}', json={'title': 'Logged again'})  # no status change, nothing to log
+    client.patch(f'/tasks/{task_id}', json={'title': 'Logged again', 'status': 'review'})
+    assert logged() == []
+
+    # a rolled back change is never logged
+    task = db.session.get(Task, task_id)
+    task.status = 'abandoned'
+    db.session.flush()
+    db.session.rollback()
+
+    client.patch(f'/tasks/{task_id}', json={'title': 'Logged again', 'status': 'completed'})
+    assert logged() == [(task_id, 'pending'), (task_id, 'review'), (task_id, 'completed')]
+    assert writer.stats()['flushes'] == 1
+
+def test_task_log_mode_follows_the_installed_triggers(tmp_path):
+    config = {'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "logs.db"}'}
+    app = create_app(test_config=config)
+    assert 'task_log_writer' in app.extensions  # no triggers yet: 'auto' has the app log the changes
+    with app.app_context():
+        db.create_all()
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql("CREATE TRIGGER log_task_status_trigger AFTER INSERT ON tasks BEGIN "
+                                       "INSERT INTO task_logs (task_id, status) VALUES (new.id, new.status); END")
+
+    assert 'task_log_writer' not in create_app(test_config=config).extensions
+    with pytest.raises(ValueError, match='log_task_status_trigger'):
+        create_app(test_config=dict(config, TASK_LOG_MODE='app'))
+
+def _sse_events(body: str):
+    return [dict(line.split(': ', 1) for line in block.split('\n')) for block in body.split('\n\n')
+            if block and not block.startswith((':', 'retry'))]
+
+def test_task_change_feed_resume_and_reset(app, client):
+    db.session.add(User(username='owner', email='owner@example.com', password='pw'))
+    db.session.add(User(username='other', email='other@example.com', password='pw'))
+    db.session.commit()
+    client.post('/tasks', json={'created_by_user': 1, 'title': 'Watched', 'description': 'Feed', 'deadline': '2030-01-01', 'status': 'pending'})
+    client.patch('/tasks/1', json={'title': 'Watched', 'status': 'review'})
+    client.post('/tasks/1/assignees', json={'user_ids': [1, 2]})
+    client.patch('/tasks/1/unassign_user/2')
+    client.delete('/tasks/1')
+
+    response = client.get('/tasks/changes?after=0&timeout=0')
+    assert response.mimetype == 'text/event-stream'
+    events = _sse_events(response.get_data(as_text=True))
+    assert [(e['event'], json.loads(e['data'])['user_id']) for e in events] == [
+        ('create', None), ('update', None), ('assign', 1), ('assign', 2), ('unassign', 2), ('delete', None)]
+    assert all(json.loads(e['data'])['task_id'] == 1 for e in events)
+
+    # a reconnecting client gets only what it missed; a fresh one only what comes next
+    resumed = _sse_events(client.get('/tasks/changes?timeout=0', headers={'Last-Event-ID': events[3]['id']}).get_data(as_text=True))
+    assert [e['id'] for e in resumed] == [events[4]['id'], events[5]['id']]
+    assert _sse_events(client.get('/tasks/changes?timeout=0').get_data(as_text=True)) == []
+    assert client.get('/tasks/changes?timeout=0', headers={'Last-Event-ID': 'x'}).status_code == 400
+    assert client.get('/tasks/changes?timeout=9999').status_code == 400
+
+    # ids older than the retention period can no longer be resumed from
+    app.extensions['change_feed'].retention = -1
+    assert app.extensions['change_feed'].prune() == 6
+    body = client.get('/tasks/changes?timeout=0', headers={'Last-Event-ID': events[3]['id']}).get_data(as_text=True)
+    assert 'event: reset' in body
+
+def test_delta_sync_since_version(app, client):
+    db.session.add_all([User(username=f'user{i}', email=f'user{i}@example.com', password='pw') for i in range(2)])
+    db.session.commit()
+    for i in range(3):
+        client.post('/tasks', json={'created_by_user': 1, 'title': f'Synced {i}', 'description': 'Delta', 'deadline': '2030-01-01', 'status': 'pending'})
+    client.post('/tasks/1/assignees', json={'user_ids': [1]})
+    version = int(client.get('/tasks').headers['X-Change-Version'])
+    user_version = int(client.get('/users/1/tasks_assigned').headers['X-Change-Version'])
+    assert version == user_version == 4
+
+    client.patch('/tasks/2', json={'title': 'Synced 2b', 'status': 'review'})
+    client.post('/tasks/2/assignees', json={'user_ids': [1]})
+    client.delete('/tasks/3')
+    client.patch('/tasks/1/unassign_user/1')
+
+    delta = client.get(f'/tasks?since={version}').json
+    assert [t['task_id'] for t in delta['tasks']] == [1, 2] and delta['removed'] == [3]
+    assert delta['tasks'][1]['status'] == 'review' and (delta['version'], delta['more']) == (8, False)
+    assert client.get('/tasks?since=8').json == {'tasks': [], 'removed': [], 'version': 8, 'more': False}
+
+    # pages follow the version, and tasks no longer matching the filters come back as removed
+    first = client.get(f'/tasks?since={version}&limit=2').json
+    assert ([t['task_id'] for t in first['tasks']], first['removed'], first['more']) == ([2], [3], True)
+    rest = client.get(f"/tasks?since={first['version']}&limit=2").json
+    assert ([t['task_id'] for t in rest['tasks']], rest['more'], rest['version']) == ([1], False, 8)
+    filtered = client.get(f'/tasks?since={version}&status=pending').json
+    assert ([t['task_id'] for t in filtered['tasks']], filtered['removed']) == ([1], [2, 3])
+
+    # a user's list: the new assignment, plus tombstones for the removed one and the deleted task
+    mine = client.get(f'/users/1/tasks_assigned?since={user_version}').json
+    assert ([t['task_id'] for t in mine['tasks']], mine['removed'], mine['version']) == ([2], [3, 1], 8)
+
+    assert client.get('/tasks?since=-1').status_code == 400
+    assert client.get(f'/tasks?since={version}&after=WzFd').status_code == 400
+    app.extensions['change_feed'].retention = -1
+    app.extensions['change_feed'].prune()
+    assert client.get(f'/tasks?since={version}').status_code == 410
+
+def test_readers_stop_before_unsettled_events(app, client):
+    db.session.add(User(username='owner', email='owner@example.com', password='pw'))
+    db.session.commit()
+    for i in range(2):
+        client.post('/tasks', json={'created_by_user': 1, 'title': f'Settled {i}', 'description': 'Horizon', 'deadline': '2030-01-01', 'status': 'pending'})
+
+    # the newest event as a Postgres reader sees it while an older transaction that may hold a lower id is running
+    db.session.execute(update(task_events).where(task_events.c.id == 2).values(horizon=1))
+    db.session.commit()
+    assert client.get('/tasks').headers['X-Change-Version'] == '1'
+    assert client.get('/tasks?since=0').json == {'tasks': [client.get('/tasks/1').json], 'removed': [], 'version': 1, 'more': False}
+    assert [e['id'] for e in _sse_events(client.get('/tasks/changes?after=0&timeout=0').get_data(as_text=True))] == ['1']
+
+    db.session.execute(update(task_events).where(task_events.c.id == 2).values(horizon=None))
+    db.session.commit()
+    assert client.get('/tasks').headers['X-Change-Version'] == '2'
+    assert [e['id'] for e in _sse_events(client.get('/tasks/changes?after=1&timeout=0').get_data(as_text=True))] == ['2']
+
+def test_async_change_feed_wakes_idle_subscribers(tmp_path):
+    import asyncio
+    from src.aio import AsyncReadApp
+
+    app = create_app(test_config={'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "feed.db"}',
+                                  'TASK_LOG_FLUSH_INTERVAL': 0})
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(username='owner', email='owner@example.com', password='pw'))
+        db.session.commit()
+    feed = app.extensions['change_feed']
+    client = app.test_client()
+
+    async def _until(condition):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    async def subscribe():
+        asgi = AsyncReadApp(app)
+        disconnect, chunks = asyncio.Event(), []
+        async def receive():
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+        async def send(message):
+            chunks.append(message.get('body', b''))
+        scope = {'type': 'http', 'method': 'GET', 'path': '/tasks/changes', 'query_string': b'timeout=30', 'headers': []}
+        stream = asyncio.ensure_future(asgi(scope, receive, send))
+        while feed.subscribers == 0:
+            await asyncio.sleep(0.01)
+        # a write on another thread wakes the subscriber long before its 15 second heartbeat
+        await asyncio.get_running_loop().run_in_executor(None, lambda: client.post('/tasks', json={
+            'created_by_user': 1, 'title': 'Live', 'description': 'Feed', 'deadline': '2030-01-01', 'status': 'pending'}))
+        await asyncio.wait_for(_until(lambda: b'event: create' in b''.join(chunks)), 5)
+        disconnect.set()
+        await asyncio.wait_for(stream, 5)
+        await asgi.engine.dispose()
+
+    asyncio.run(subscribe())
+    assert feed.subscribers == 0
+
+def test_async_read_app_matches_flask_views(tmp_path):
+    import asyncio
+    from src.aio import AsyncReadApp, create_asgi_app
+
+    app = create_app(test_config={'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "async.db"}'})
+    with app.app_context():
+        db.create_all()
+        users = [User(username=f'user_{i}', email=f'user_{i}@example.com', password='x') for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        for i in range(5):
+            task = Task(title=f"Task {i}", description="Async", deadline=datetime(2024, 1, 1 + i), status='pending',
+                        created_by_user=users[0].id)
+            task.assignees.extend(users[:i % 3])
+            db.session.add(task)
+        db.session.commit()
+
+    paths = ['/tasks', '/tasks?limit=2&sort=-deadline', '/tasks?status=pending&assignee=1', '/users?limit=2',
+             '/tasks?sort=colour', '/tasks?since=0&limit=2', '/tasks/2', '/tasks/export']
+    client = app.test_client()
+    client.patch('/tasks/2', json={'title': 'Task 2', 'status': 'review'})  # changes for the ?since= deltas
+    client.post('/tasks/4/assignees', json={'user_ids': [2, 3]})
+    client.delete('/tasks/5')
+    expected = [(r.status_code, r.get_data()) for r in (client.get(p) for p in paths)]
+
+    async def fetch_all():
+        asgi = AsyncReadApp(app)
+        results = []
+        for path in paths:
+            raw_path, _, query = path.partition('?')
+            sent = []
+            async def send(message):
+                sent.append(message)
+            scope = {'type': 'http', 'method': 'GET', 'path': raw_path, 'query_string': query.encode(), 'headers': []}
+            await asgi(scope, None, send)
+            results.append((sent[0]['status'], sent[1]['body']))
+        await asgi.engine.dispose()
+        return results
+
+    # identical bodies; the cached /tasks/<id> and /tasks/export have no async variant (404 without a fallback)
+    results = asyncio.run(fetch_all())
+    assert results[:-2] == expected[:-2]
+    assert [status for status, _ in results[-2:]] == [404, 404]
+
+    # with the Flask app as the fallback, cached views keep their ETags and answer If-None-Match with 304
+    async def revalidate():
+        asgi = create_asgi_app(app)
+        statuses = []
+        headers = []
+        for _ in range(2):
+            sent = []
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+            async def send(message):
+                sent.append(message)
+            await asgi({'type': 'http', 'method': 'GET', 'path': '/tasks/2', 'query_string': b'', 'headers': headers}, receive, send)
+            response_headers = dict(sent[0]['headers'])
+            statuses.append(sent[0]['status'])
+            headers = [(b'if-none-match', response_headers[b'etag'])]
+        await asgi.dispose()
+        return statuses, b''.join(m.get('body', b'') for m in sent[1:])
+    assert asyncio.run(revalidate()) == ([200, 304], b'')
+
+    # the async views are admitted like the Flask ones: with every expensive slot taken both lists are shed
+    gate = app.extensions['admission'].gates['expensive']
+    async def shed_while_busy():
+        asgi = AsyncReadApp(app)
+        statuses = []
+        for path in ['/tasks', '/users']:
+            sent = []
+            async def send(message):
+                sent.append(message)
+            scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': [], 'client': ('10.0.0.1', 1)}
+            await asgi(scope, None, send)
+            statuses.append(sent[0]['status'])
+        await asgi.engine.dispose()
+        return statuses
+
+    app.extensions['admission'].queue_budget = 0.02
+    for _ in range(gate.limit):
+        assert gate.enter(0)
+    assert asyncio.run(shed_while_busy()) == [503, 503]
+    for _ in range(gate.limit):
+        gate.leave()
+    assert gate.active == 0 and app.extensions['admission'].gates['cheap'].active == 0
+
+def test_wsgi_fallback_streams_the_response():
+    import asyncio
+    from src.aio import WsgiFallback
+
+    released = threading.Event()
+    def export(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'application/x-ndjson')])
+        yield b'{"task_id": 1}\n'
+        # only the client having the first line lets the rest be produced
+        assert released.wait(5), 'the first line was held back until the body was complete'
+        yield b'{"task_id": 2}\n'
+
+    async def fetch():
+        sent = []
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+        async def send(message):
+            sent.append(message)
+            if message.get('body') == b'{"task_id": 1}\n':
+                released.set()
+        await WsgiFallback(export)({'type': 'http', 'method': 'GET', 'path': '/tasks/export', 'headers': []}, receive, send)
+        return sent
+
+    sent = asyncio.run(fetch())
+    assert (sent[0]['type'], sent[0]['status']) == ('http.response.start', 200)
+    assert [(m['body'], m.get('more_body', False)) for m in sent[1:]] == [
+        (b'{"task_id": 1}\n', True), (b'{"task_id": 2}\n', True), (b'', False)]
+
+def test_single_assignment_is_keyed(client, max_queries):
+    users = [User(username=f'user{i}', email=f'user{i}@example.com', password='pw') for i in range(20)]
+    db.session.add_all(users)
+    task = Task(title="Crowded", description="Keyed", deadline=datetime.now(), status="Incomplete", created_by_user=1)
+    task.assignees.extend(users[1:])
+    db.session.add(task)
+    db.session.commit()
+    db.session.expire_all()
+
+    # the task, the user, one keyed INSERT or DELETE and the change event; the other assignees are never loaded
+    with max_queries(4):
+        assert client.post('/tasks/1/assign_to/1').status_code == 200
+    with max_queries(4):
+        assert client.post('/tasks/1/assign_to/1').status_code == 400
+    with max_queries(4):
+        assert client.patch('/tasks/1/unassign_user/2').status_code == 200
+    with max_queries(4):
+        assert client.patch('/tasks/1/unassign_user/2').status_code == 400
+    assert [u['user_id'] for u in client.get('/tasks/1').json['assigned_users']] == [1] + list(range(3, 21))
+
+def test_heavy_deletes_run_as_background_jobs(app, client, monkeypatch):
+    from src import jobs
+    app.config.update(JOB_INLINE_LIMIT=5, JOB_BATCH_SIZE=2, JOB_RETRY_DELAY=0)
+    users = [User(username=f'user{i}', email=f'user{i}@example.com', password='pw') for i in range(2)]
+    db.session.add_all(users)
+    db.session.commit()
+    owner, other = users[0].id, users[1].id
+    for i in range(4):
+        task = Task(title=f"Task {i}", description="Owned", deadline=None, status="pending", created_by_user=owner)
+        task.assignees.extend(users)
+        db.session.add(task)
+    db.session.commit()
+
+    # 4 assignments and 4 tasks to leave without a creator: too many rows for the request, so it is queued;
+    # asking again joins the same job
+    response = client.delete(f'/users/{owner}')
+    assert response.status_code == 202
+    job_id = response.json['job_id']
+    assert response.headers['Location'] == f'/jobs/{job_id}'
+    assert client.delete(f'/users/{owner}').json['job_id'] == job_id
+    assert client.get(f'/jobs/{job_id}').json['status'] == 'queued'
+
+    # the first attempt fails after its first committed batch; the retry finishes the rest
+    handler, calls = jobs.HANDLERS['delete_user'], []
+    def flaky(payload, batch_size):
+        for i, counts in enumerate(handler(payload, batch_size)):
+            if i == 1 and not calls:
+                calls.append(i)
+                raise RuntimeError('connection lost')
+            yield counts
+    monkeypatch.setitem(jobs.HANDLERS, 'delete_user', flaky)
+    assert jobs.work(app, burst=True) == 2
+
+    job = client.get(f'/jobs/{job_id}').json
+    assert (job['status'], job['attempts'], job['error']) == ('done', 2, None)
+    assert job['progress'] == {'task_assignees': 4, 'tasks_creator_cleared': 4, 'users': 1}
+    assert client.get(f'/users/{owner}').status_code == 404
+    # the tasks stay, with their other assignee and no creator
+    tasks = client.get('/tasks').json['tasks']
+    assert [(t['created_by_user'], [u['user_id'] for u in t['assigned_users']]) for t in tasks] == [(None, [other])] * 4
+    assert client.get(f'/users/{other}').status_code == 200
+
+    # a worker that dies leaves its lease to run out; after the last attempt the job is failed
+    with app.app_context():
+        db.session.execute(db.insert(db.metadata.tables['jobs']).values(
+            kind='delete_task', key='delete_task:9', payload={'task_id': 9}, status='queued', attempts=0,
+            max_attempts=1, visible_at=datetime.utcnow(), created_at=datetime.utcnow()))
+        db.session.commit()
+        abandoned = jobs.claim(visibility=-1)
+        assert jobs.claim(visibility=60) is None and jobs.fail_expired() == 1
+    assert client.get(f'/jobs/{abandoned.id}').json['status'] == 'failed'
+    assert client.get('/jobs/999').status_code == 404
+
+def test_admission_control_sheds_and_throttles(app, client):
+    control = app.extensions['admission']
+    db.session.add(User(username='test_user', email='test@example.com', password='pw'))
+    db.session.commit()
+
+    # every expensive slot is taken: GET /tasks is shed at once, GET /users/<id> is still served
+    control.queue_budget = 0.05
+    gate = control.gates['expensive']
+    for _ in range(gate.limit):
+        assert gate.enter(0)
+    response = client.get('/tasks')
+    assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+    assert client.get('/users/1').status_code == 200
+    for _ in range(gate.limit):
+        gate.leave()
+    assert client.get('/tasks').status_code == 200
+
+    # a request that already waited longer than the budget in front of the app is not served
+    assert client.get('/users/1', headers={'X-Request-Start': f't={time.time() - 5:.3f}'}).status_code == 503
+
+    # per-client token buckets: a burst of two, then 429 until a token is refilled
+    control.buckets['cheap'] = TokenBuckets(rate=0.5, burst=2)
+    assert [client.get('/users/1').status_code for _ in range(3)] == [200, 200, 429]
+    assert client.get('/users/1').headers['Retry-After'] == '2'
+    assert client.get('/users/1', environ_base={'REMOTE_ADDR': '10.0.0.2'}).status_code == 200
+
+    stats = client.get('/stats/admission').json['classes']
+    assert (stats['expensive']['shed_busy'], stats['expensive']['admitted'], stats['expensive']['active']) == (1, 1, 0)
+    assert (stats['cheap']['shed_late'], stats['cheap']['throttled']) == (1, 2)
+
+def test_reads_go_to_replicas_and_writers_read_their_writes(tmp_path):
+    (tmp_path / 'replica').mkdir()
+    app = create_app(test_config={
+        'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "primary.db"}', 'PASSWORD_PBKDF2_ITERATIONS': 1000,
+        'TASK_LOG_FLUSH_INTERVAL': 0, 'REPLICA_CHECK_INTERVAL': 0,
+        'DATABASE_REPLICA_URIS': [f'sqlite:///{tmp_path / "replica" / "tasks.db"}', f'sqlite:///{tmp_path / "missing" / "tasks.db"}'],
+    })
+    with app.app_context():
+        # two SQLite files stand in for the primary and a replica; their data differs so each read shows where it went
+        db.create_all(bind_key=None)
+        db.metadata.create_all(db.engines['replica_0'])
+        db.session.add(User(username='on_primary', email='user@example.com', password='pw'))
+        db.session.commit()
+        task = {'id': 1, 'title': 'Shared', 'description': 'Replicated', 'status': 'pending', 'created_by_user': 1}
+        assignment = {'task_id': 1, 'user_id': 1, 'created_at': datetime(2024, 1, 1)}
+        for engine in (db.engines[None], db.engines['replica_0']):
+            with engine.begin() as connection:
+                if engine is db.engines['replica_0']:
+                    connection.execute(User.__table__.insert().values(id=1, username='on_replica', email='user@example.com', password='pw'))
+                connection.execute(Task.__table__.insert().values(**task))
+                connection.execute(assignees_table.insert().values(**assignment))
+
+        writer, reader = app.test_client(), app.test_client()
+        assert reader.get('/users/1').json['username'] == 'on_replica'
+        assert reader.get('/users').json['users'][0]['username'] == 'on_replica'
+
+        # the client that wrote reads from the primary for a while; other clients keep using the replica
+        response = writer.patch('/users/1', json={'username': 'renamed', 'email': 'user@example.com'})
+        assert response.status_code == 200 and 'read_primary_until' in response.headers['Set-Cookie']
+        assert writer.get('/users').json['users'][0]['username'] == 'renamed'
+        assert reader.get('/users').json['users'][0]['username'] == 'on_replica'
+
+        # a replica read right after an invalidation is served but not cached
+        entries = app.extensions['response_cache'].stats()['entries']
+        assert reader.get('/users/1?fields=all').json['username'] == 'on_replica'
+        assert app.extensions['response_cache'].stats()['entries'] == entries
+
+        # writes issued while a request reads from a replica still go to the primary
+        with app.test_request_context('/users/1'):
+            from flask import g
+            g.read_replica = 'replica_0'
+            assert db.session.get_bind(mapper=User) is db.engines['replica_0']
+            assert db.session.get_bind(clause=User.__table__.update()) is db.engines[None]
+
+        # the unreachable replica is skipped; with no healthy replica left, reads fall back to the primary
+        stats = reader.get('/stats/replicas').json
+        assert stats['replicas'] == {'replica_0': {'healthy': True}, 'replica_1': {'healthy': False}}
+        assert stats['reads']['replica_1'] == 0 and stats['reads']['replica_0'] == 5
+
+        # nor are user records read from the replica stored in the shared user cache, which the writer would read next
+        assert reader.get('/tasks/1/users_assigned_task').json[0]['username'] == 'on_replica'
+        assert writer.get('/tasks/1/users_assigned_task').json[0]['username'] == 'renamed'
+
+        # asgi.py's async views go through the same router, and honour the writer's cookie
+        import asyncio
+        from src.aio import AsyncReadApp
+        cookie = response.headers['Set-Cookie'].split(';')[0]
+        async def fetch(headers):
+            asgi = AsyncReadApp(app)
+            sent = []
+            async def send(message):
+                sent.append(message)
+            await asgi({'type': 'http', 'method': 'GET', 'path': '/users', 'query_string': b'', 'headers': headers}, None, send)
+            await asgi.dispose()
+            return json.loads(sent[1]['body'])['users'][0]['username']
+        assert asyncio.run(fetch([])) == 'on_replica'
+        assert asyncio.run(fetch([(b'cookie', cookie.encode())])) == 'renamed'
+
+        db.engines['replica_0'].dispose()
+        (tmp_path / 'replica').rename(tmp_path / 'gone')
+        assert reader.get('/users').json['users'][0]['username'] == 'renamed'
+        assert reader.get('/stats/replicas').json['replicas']['replica_0'] == {'healthy': False}
+        db.session.remove()
+
+def test_shared_user_cache_fills_assignees(app, client, max_queries, tmp_path):
+    cache = app.extensions['user_cache']
+    users = [User(username=f'user{i}', email=f'user{i}@example.com', password='pw') for i in range(3)]
+    db.session.add_all(users)
+    task = Task(title="Cached", description=None, deadline=None, status="Incomplete", created_by_user=1)
+    task.assignees.extend(users)
+    db.session.add(task)
+    db.session.commit()
+
+    client.get('/tasks')
+    with max_queries(2) as statements:  # the task and its assignee ids; the users are all cached
+        assert [u['username'] for u in client.get('/tasks/1/users_assigned_task').json] == ['user0', 'user1', 'user2']
+    assert not any('FROM users' in statement for statement in statements)
+
+    # a process forked after create_app (a gunicorn worker) reads the same records, and its invalidations reach us
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    child = context.Process(target=lambda: (results.put(sorted(cache.get_many([1, 2, 3]))), cache.invalidate(3)))
+    child.start()
+    assert results.get(timeout=10) == [1, 2, 3]
+    child.join()
+    assert sorted(cache.get_many([1, 2, 3])) == [1, 2]
+
+    # updating a user invalidates its record; rows read before an invalidation are not stored
+    assert client.patch('/users/2', json={'username': 'renamed', 'email': 'user1@example.com'}).status_code == 200
+    assert [u['username'] for u in client.get('/tasks?limit=5').json['tasks'][0]['assigned_users']] == ['user0', 'renamed', 'user2']
+    generation = cache.generation
+    cache.invalidate(1)
+    assert cache.put_many([(1, 'stale', 'stale@example.com')], generation) == 0
+
+    stats = client.get('/stats/user_cache').json
+    assert stats['enabled'] and stats['bytes'] == 64 + 4096 * 288 and stats['entries'] == 2
+    assert stats['hits'] > 0 and 0 < stats['hit_rate'] < 1
+
+    # with USER_CACHE_PATH every process maps the same file; slots are fixed, so a colliding id replaces the older record
+    path = str(tmp_path / 'users.bin')
+    first, second = UserRecordCache(slots=2, path=path), UserRecordCache(slots=2, path=path)
+    first.put_many([(1, 'one', 'one@example.com')], first.generation)
+    assert second.get_many([1]) == {1: {'user_id': 1, 'username': 'one', 'email': 'one@example.com'}}
+    second.put_many([(3, 'three', 'three@example.com'), (2, 'x' * 129, 'long@example.com')], second.generation)
+    assert first.get_many([1, 3]).keys() == {3} and (second.evictions, second.oversize) == (1, 1)